@@ -0,0 +1,345 @@
+#!/usr/bin/python3
+
+# Copyright (C) 2025 LightDig
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+# SOFTWARE.
+
+from argparse import ArgumentParser
+import itertools
+import json
+import os
+from pathlib import Path
+import re
+import shlex
+import shutil
+import subprocess
+import sys
+import threading
+import time
+
+# lines of the serial console that mark the stages of a boot
+# systemd only prints its status lines with quiet when show_status is given
+show_status = "systemd.show_status=1"
+markers = {
+	"new_root": re.compile(r"Mounted the system on /new_root"),
+	"multi_user": re.compile(r"Reached target .*Multi-User System")
+}
+
+# line the squashfs hook prints with sfs_report_upper, shortly after multi-user.target
+upper_report = re.compile(r":: Overlay upper layer: ([0-9]+) bytes")
+# seconds to wait for it, initramfs images with an older squashfs hook never print it
+upper_wait = 30
+
+# the kernel keeps this many bytes of the command line on x86, including the terminating null
+cmdline_size = 2048
+# names the kernel can split from the value of an option
+option_name = re.compile(r'^[^\s="]+$')
+
+# how the image is attached and which device the squashfs hook finds it as
+buses = {
+	"usb": (("-device","qemu-xhci","-device","usb-storage,drive=system"),"/dev/sda"),
+	"sata": (("-device","ahci,id=ahci","-device","ide-hd,drive=system,bus=ahci.0"),"/dev/sda"),
+	"virtio": (("-device","virtio-blk-pci,drive=system"),"/dev/vda")
+}
+
+# ### ARGUMENTS ###
+parser = ArgumentParser(
+	prog='bootbench.py',
+	description="Boot time benchmark\n\nBoots a built system.sfs and initramfs.img in QEMU for every combination of kernel command line options and records the time until /new_root is mounted, the time until multi-user.target is reached, the bytes the boot wrote to the overlay upper layer and the peak memory of the virtual machine.",
+	epilog="The initramfs must contain the drivers of the virtual device, build it without the autodetect hook or add the modules of the bus to --MM (usb: xhci_pci usb_storage, sata: ahci, virtio: virtio_pci virtio_blk)."
+)
+parser.add_argument('output_dir',
+	type=str,
+	help="Output directory of a build"
+)
+parser.add_argument('-O','--option',
+	nargs='+',
+	action='append',
+	default=[],
+	help="An option and the values to try, - leaves the option out, e.g. -O sfs_overlay 'tmpfs' '1G;zstd' -O sfs_copy - auto",
+	metavar=("OPTION","VALUE")
+)
+parser.add_argument('-m','--matrix',
+	type=str,
+	default=None,
+	help="JSON file of options and the lists of values to try, combined with --option"
+)
+parser.add_argument('-b','--bus',
+	type=str,
+	choices=buses,
+	default="usb",
+	help="How the image is attached (Default = usb)"
+)
+parser.add_argument('-r','--read-limit',
+	type=str,
+	default=None,
+	help="Read throughput limit of the device, e.g. 30M for 30MB/s (Default = no limit)"
+)
+parser.add_argument('--memory',
+	type=str,
+	default="2G",
+	help="Memory of the virtual machine (Default = 2G)"
+)
+parser.add_argument('--cpus',
+	type=int,
+	default=2,
+	help="CPUs of the virtual machine (Default = 2)"
+)
+parser.add_argument('-n','--repeat',
+	type=int,
+	default=1,
+	help="How often to boot every combination (Default = 1)"
+)
+parser.add_argument('-t','--timeout',
+	type=int,
+	default=300,
+	help="Seconds to wait for multi-user.target (Default = 300)"
+)
+parser.add_argument('-a','--append',
+	type=str,
+	default="",
+	help="Options added to the command line of every boot"
+)
+parser.add_argument('--kernel',
+	type=str,
+	default=None,
+	help="Kernel to boot (Default = vmlinuz in the output directory)"
+)
+parser.add_argument('-o','--output',
+	type=str,
+	default=None,
+	help="Where to write the results (Default = bootbench.json in the output directory)"
+)
+parser.add_argument('-c','--compare',
+	type=str,
+	default=None,
+	help="Results of an earlier run to compare against"
+)
+parser.add_argument('--log',
+	action='store_true',
+	help="Keep the serial console of every boot next to the results"
+)
+parser.add_argument('--dry-run',
+	action='store_true',
+	help="Check and print the qemu command of every boot without booting"
+)
+
+# ### FUNCTIONS ###
+# function for turning a size with an optional K/M/G suffix into bytes
+def to_bytes(s):
+	units = {"K": 1024, "M": 1048576, "G": 1073741824}
+	if s[-1:].upper() in units:
+		return int(float(s[:-1]) * units[s[-1:].upper()])
+	return int(s)
+
+# function that lists every combination of option values as dictionaries
+# options with the value - are left out of the command line
+def combinations(options):
+	keys = list(options)
+	for values in itertools.product(*(options[x] for x in keys)):
+		yield {x: y for x,y in zip(keys,values) if y != "-"}
+
+# function that turns options into kernel command line arguments
+# options without a value, like sfs_copy_background, are given as true
+def cmdline_args(options):
+	args = []
+	for i,x in options.items():
+		if x == "true":
+			args.append(i)
+		elif re.search(r"\s",x):
+			args.append("".join((i,'="',x,'"')))
+		else:
+			args.append("".join((i,"=",x)))
+	return args
+
+# function that lists the variables the initcpio hooks read
+def hook_variables():
+	names = set()
+	for x in (Path(__file__).resolve().parent / "initcpio").glob("*/*"):
+		names.update(re.findall(r"\$\{?([A-Za-z_][A-Za-z0-9_]*)",x.read_text(errors="replace")))
+	return names
+
+# function that returns the problems of the options and command line of a boot
+def check_cmdline(options,cmdline):
+	errors = []
+	for i,x in options.items():
+		if not option_name.match(i):
+			errors.append("".join(("'",i,"' is not a valid option name")))
+		if '"' in x:
+			errors.append("".join(("the value of ",i," contains a \", which the kernel can not pass on")))
+	if len(cmdline.encode()) >= cmdline_size:
+		errors.append("".join(("the command line is ",str(len(cmdline.encode()))," bytes long, the kernel keeps ",str(cmdline_size - 1))))
+	return errors
+
+# function that builds the qemu command of a boot
+def qemu_command(args,kernel,initramfs,image,cmdline):
+	drive = "".join(("file=",str(image),",format=raw,if=none,id=system,readonly=on"))
+	if args.read_limit:
+		drive = "".join((drive,",throttling.bps-read=",str(to_bytes(args.read_limit))))
+	if os.access("/dev/kvm",os.R_OK | os.W_OK):
+		accel = ("-accel","kvm","-cpu","host")
+	else:
+		accel = ("-accel","tcg")
+	return (
+		"qemu-system-x86_64",*accel,
+		"-m",args.memory,"-smp",str(args.cpus),
+		"-nographic","-no-reboot",
+		"-kernel",str(kernel),"-initrd",str(initramfs),
+		"-append",cmdline,
+		"-drive",drive,*buses[args.bus][0]
+	)
+
+# function that reads the serial console of a boot and records when markers appear
+def read_console(process,start,times,log):
+	for line in process.stdout:
+		line = line.decode(errors="replace")
+		log.append(line)
+		for name,marker in markers.items():
+			if name not in times and marker.search(line):
+				times[name] = round(time.time() - start,3)
+		match = upper_report.search(line)
+		if match:
+			times["upper_bytes"] = int(match.group(1))
+		if "multi_user" in times and "upper_bytes" in times:
+			return
+
+# function that boots once and returns the measurements
+def boot(command,timeout):
+	times = {}
+	log = []
+	start = time.time()
+	process = subprocess.Popen(command,stdin=subprocess.DEVNULL,stdout=subprocess.PIPE,stderr=subprocess.STDOUT)
+	reader = threading.Thread(target=read_console,args=(process,start,times,log),daemon=True)
+	reader.start()
+	while reader.is_alive() and time.time() - start < timeout:
+		if "multi_user" in times and time.time() - start > times["multi_user"] + upper_wait:
+			break
+		reader.join(0.5)
+	if "multi_user" in times:
+		result = "ok"
+	elif reader.is_alive():
+		result = "timeout"
+	else:
+		result = "failed" # qemu exited, e.g. because the guest panicked
+	process.kill()
+	# the peak resident memory of qemu is the memory the guest touched, plus the overhead of qemu
+	pid,status,usage = os.wait4(process.pid,0)
+	process.returncode = status
+	return {"status": result, **times, "peak_rss_kib": usage.ru_maxrss},"".join(log)
+
+# function that prints how the results compare to an earlier run
+def compare(runs,earlier):
+	previous = {}
+	for run in earlier["runs"]:
+		previous.setdefault(run["cmdline"],[]).append(run)
+	print()
+	print("\33[1mCompared to the earlier run:\33[0m")
+	for run in runs:
+		old = [x for x in previous.get(run["cmdline"],[]) if x["status"] == "ok"]
+		if run["status"] != "ok" or not old:
+			continue
+		parts = []
+		for key in "new_root","multi_user","upper_bytes","peak_rss_kib":
+			if key in run and all(key in x for x in old):
+				before = sum(x[key] for x in old) / len(old)
+				change = (run[key] - before) / before * 100 if before else 0
+				colour = "\33[31m" if change > 5 else "\33[32m" if change < -5 else ""
+				parts.append("".join((key," ",colour,("+" if change >= 0 else ""),str(round(change,1)),"%\33[0m")))
+		print("".join(("  ",run["cmdline"] or "(defaults)",": ",", ".join(parts))))
+
+# ### MAIN ###
+def main():
+	args = parser.parse_args()
+	odir = Path(args.output_dir).expanduser().absolute()
+	kernel = Path(args.kernel).expanduser().absolute() if args.kernel else odir / "vmlinuz"
+	initramfs = odir / "initramfs.img"
+	image = odir / "system.sfs"
+	if not image.is_file():
+		image = odir / "system.erofs"
+	for x in kernel,initramfs,image:
+		if not x.is_file():
+			sys.exit("".join(("'",str(x),"' not found")))
+	if shutil.which("qemu-system-x86_64") is None and not args.dry_run:
+		sys.exit("qemu-system-x86_64 not found, install qemu-system-x86")
+
+	options = {}
+	if args.matrix:
+		with open(args.matrix) as file:
+			options.update({i: [str(y) for y in x] for i,x in json.load(file).items()})
+	for x in args.option:
+		if len(x) < 2:
+			sys.exit("".join(("No values given for option '",x[0],"'")))
+		options[x[0]] = x[1:]
+	known = hook_variables()
+	for x in options:
+		if x not in known:
+			print("".join(("Warning: no initcpio hook reads the option '",x,"'")),file=sys.stderr)
+
+	output = Path(args.output) if args.output else odir / "bootbench.json"
+	results = {
+		"image": str(image),
+		"image_size": image.stat().st_size,
+		"plan": (odir / "system.plan").read_text() if (odir / "system.plan").is_file() else None,
+		"date": time.strftime("%Y-%m-%dT%H:%M:%S"),
+		"bus": args.bus,
+		"read_limit": args.read_limit,
+		"memory": args.memory,
+		"cpus": args.cpus,
+		"accel": "kvm" if os.access("/dev/kvm",os.R_OK | os.W_OK) else "tcg",
+		"runs": []
+	}
+
+	# check every command line before the first boot, a sweep can take hours
+	combos = list(combinations(options))
+	cmdlines = []
+	errors = 0
+	for n,combo in enumerate(combos):
+		extra = cmdline_args(combo)
+		cmdline = " ".join(("console=ttyS0","".join(("squashfs=",buses[args.bus][1])),"sfs_report_upper",show_status,*extra,args.append)).strip()
+		cmdlines.append((extra,cmdline))
+		for x in check_cmdline(combo,cmdline):
+			print("".join(("[",str(n + 1),"/",str(len(combos)),"] ",x)),file=sys.stderr)
+			errors += 1
+		if args.dry_run:
+			print("".join(("[",str(n + 1),"/",str(len(combos)),"] ",shlex.join(qemu_command(args,kernel,initramfs,image,cmdline)))))
+	if errors:
+		sys.exit("".join((str(errors)," problems found in the command lines")))
+	if args.dry_run:
+		return
+
+	for n,(combo,(extra,cmdline)) in enumerate(zip(combos,cmdlines)):
+		for i in range(args.repeat):
+			print("".join(("[",str(n + 1),"/",str(len(combos)),"] ",cmdline)))
+			run,log = boot(qemu_command(args,kernel,initramfs,image,cmdline),args.timeout)
+			run.update({"cmdline": " ".join(extra), "options": combo})
+			results["runs"].append(run)
+			print("".join(("  ",run["status"],
+				", /new_root ",str(run.get("new_root","-")),"s",
+				", multi-user ",str(run.get("multi_user","-")),"s",
+				", upper layer ",str(run["upper_bytes"] // 1024) if "upper_bytes" in run else "-","KiB",
+				", peak memory ",str(run["peak_rss_kib"] // 1024),"MiB")))
+			if args.log:
+				output.with_name("".join((output.stem,"-",str(n),"-",str(i),".log"))).write_text(log)
+			# write after every boot, so an interrupted sweep keeps its results
+			with open(output,'w') as file:
+				json.dump(results,file,indent=2,allow_nan=False)
+
+	print("".join(('Results written to "',str(output),'"')))
+	if args.compare:
+		with open(args.compare) as file:
+			compare(results["runs"],json.load(file))
+
+if __name__ == "__main__":
+	main()
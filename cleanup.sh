@@ -27,8 +27,21 @@ fi
 
 case "$1" in
 	fetch) # function for moving the system and/or initramfs to folder
-		[[ -f "$odir/system.sfs" ]] && mv "$odir/system.sfs" ./ || exit 1
+		if [[ -f "$odir/system.sfs" ]]; then
+			mv "$odir/system.sfs" ./
+		else
+			[[ -f "$odir/system.erofs" ]] && mv "$odir/system.erofs" ./ || exit 1
+		fi
 		[[ -f "$odir/initramfs.img" ]] && mv "$odir/initramfs.img" ./ || exit 1
+		for x in system.manifest system.options system.plan delta.sfs delta.erofs vmlinuz \
+			system.sfs.verity system.sfs.roothash system.erofs.verity system.erofs.roothash \
+			system.sfs.index system.erofs.index; do
+			[[ -f "$odir/$x" ]] && mv "$odir/$x" ./
+		done
+		# initramfs variants and the kernels they were built for
+		for x in "$odir"/initramfs-*.img "$odir"/vmlinuz-*; do
+			[[ -f $x ]] && mv "$x" ./
+		done
 	;;
 	mv|cp)
 		[[ $2 ]] || err "don't know what to move."
@@ -36,15 +49,41 @@ case "$1" in
 		[[ $3 ]] || err "don't know where to move $2."
 
 		# get path of file
-		case $2 in system) mvfrom="$odir/system.sfs"; ;; initramfs) mvfrom="$odir/initramfs.img"; ;; esac
+		case $2 in
+			system) mvfrom="$odir/system.sfs"; [[ -f $mvfrom ]] || mvfrom="$odir/system.erofs" ;;
+			initramfs) mvfrom="$odir/initramfs.img" ;;
+		esac
 
 		# move file
 		mv "$mvfrom" "$3" || exit 1
+
+		# the verity hash tree, root hash and chunk index are named after the image
+		if [[ $2 = system ]]; then
+			mvto=$3
+			[[ -d $3 ]] && mvto="$3/$(basename "$mvfrom")"
+			for x in verity roothash index; do
+				[[ -f "$mvfrom.$x" ]] && { mv "$mvfrom.$x" "$mvto.$x" || exit 1; }
+			done
+		fi
+
+		# keep the manifest and memory plan with the image
+		if [[ $2 = system ]]; then
+			for x in system.manifest system.options system.plan; do
+				[[ -f "$odir/$x" ]] || continue
+				if [[ -d $3 ]]; then
+					mv "$odir/$x" "$3/"
+				else
+					mv "$odir/$x" "$(dirname "$3")/"
+				fi
+			done
+		fi
 	;;
 	*)
 		umount /tmp/recovery/mount
-		umount /etc/initcpio
-		umount "$wdir/initcpio"
+		umount "$wdir/mount"
+		# release a workspace in memory
+		mountpoint -q "$wdir/system" && umount "$wdir/system"
+		[[ -f "$wdir/workspace.zram" ]] && zramctl --reset "$(cat "$wdir/workspace.zram")"
 		rm -rf "$wdir"
 		echo finished
 	;;
@@ -67,6 +67,188 @@ opt_dependency() { pacman -Q "$1" &> /dev/null; }
 default() { eval "[[ \$$1 ]] || $1='${*:2}'"; } # function for setting default values
 default_arr() { eval "[[ \$$1 ]] || $1=(${*:2})"; } # function for setting default array value
 
+# function for turning a size with an optional K/M/G/T suffix into kibibytes
+# values without a suffix are treated as bytes
+to_kib() {
+	case $1 in
+		*K) echo "${1%K}" ;;
+		*M) echo $((${1%M} * 1024)) ;;
+		*G) echo $((${1%G} * 1048576)) ;;
+		*T) echo $((${1%T} * 1073741824)) ;;
+		*) echo $(($1 / 1024)) ;;
+	esac
+}
+
+# ### TRACING ###
+# the start and end of every build step are appended to $odir/build-trace.events
+# together with the cpu time and I/O of the shell, which includes all of its
+# finished child processes. starchy.py turns these events into build-trace.json
+span_path=""
+
+trace_event() {
+	local stat key value rchar wchar read_bytes write_bytes
+	read -ra stat < "/proc/$BASHPID/stat"
+	while read -r key value; do
+		case $key in
+			rchar:) rchar=$value ;;
+			wchar:) wchar=$value ;;
+			read_bytes:) read_bytes=$value ;;
+			write_bytes:) write_bytes=$value ;;
+		esac
+	done < "/proc/$BASHPID/io"
+	# cpu time in clock ticks: utime + stime + cutime + cstime
+	printf '%s\t%s\t%s\t%s\t%s\t%s\t%s\t%s\t%s\n' "$1" "$2" "$BASHPID" "$EPOCHREALTIME" \
+		$((stat[13] + stat[14] + stat[15] + stat[16])) "$rchar" "$wchar" "$read_bytes" "$write_bytes" \
+		>> "$odir/build-trace.events"
+}
+
+# spans can be nested, the name of a span is the path of all open spans separated by ;
+span_begin() {
+	span_path="${span_path:+$span_path;}$1"
+	trace_event begin "$span_path"
+}
+
+span_end() {
+	trace_event end "$span_path"
+	if [[ $span_path = *\;* ]]; then
+		span_path="${span_path%;*}"
+	else
+		span_path=""
+	fi
+}
+
+# usage: span <name> <command> [arguments]
+span() {
+	local status
+	span_begin "$1"
+	"${@:2}"
+	status=$?
+	span_end
+	return $status
+}
+
+# ### STAGES ###
+# independent parts of the build run as named stages in the background
+# at most $jobs stages run at the same time and their output is prefixed with their name
+# when a stage fails, all other stages are stopped and the build exits
+declare -A stage_pid
+
+# kill a process and all of its descendants
+kill_tree() {
+	local child
+	for child in $(pgrep -P "$1"); do
+		kill_tree "$child"
+	done
+	kill "$1" 2> /dev/null
+}
+
+# stop every stage that is still running, except the calling one
+stop_stages() {
+	local x
+	for x in "$wdir"/stages/*.pid; do
+		[[ -f $x ]] || continue
+		[[ $(cat "$x") = "$BASHPID" ]] && continue
+		kill_tree "$(cat "$x")"
+		rm -f "$x"
+	done
+}
+
+running_stages() {
+	local n=0 x
+	for x in "${stage_pid[@]}"; do
+		kill -0 "$x" 2> /dev/null && ((n+=1))
+	done
+	echo $n
+}
+
+# usage: stage <name> <command> [arguments]
+# stages can not read from stdin, so they must not prompt
+stage() {
+	local name=$1 status
+	shift
+	mkdir -p "$wdir/stages"
+	# wait for a free worker
+	while [[ $(running_stages) -ge $jobs ]]; do
+		wait -n
+	done
+	(
+		echo $BASHPID > "$wdir/stages/$name.pid"
+		span_path=""
+		span "$name" "$@"
+		status=$?
+		echo $status > "$wdir/stages/$name"
+		rm -f "$wdir/stages/$name.pid"
+		if [[ ! $status -eq 0 ]]; then
+			echo "stage failed with exit code $status"
+			stop_stages
+			kill -USR1 $$
+		fi
+		exit $status
+	) < /dev/null > >(sed -u "s/^/[$name] /") 2>&1 &
+	stage_pid[$name]=$!
+}
+
+# wait for a stage to finish, returns the exit code of the stage
+wait_stage() {
+	[[ ${stage_pid[$1]} ]] || return 0
+	wait "${stage_pid[$1]}" 2> /dev/null
+	return "$(cat "$wdir/stages/$1" 2> /dev/null || echo 1)"
+}
+
+# wait for every stage
+wait_stages() {
+	local x
+	for x in "${!stage_pid[@]}"; do
+		wait_stage "$x" || return 1
+	done
+}
+
+# ### SHARED RESOURCES ###
+# builds that run at the same time, like the builds of a matrix, coordinate
+# through lock files in $lock_dir
+
+# usage: with_lock <name> <command> [arguments]
+# run a command while no other build holds the same lock
+with_lock() {
+	local fd status
+	mkdir -p "$lock_dir"
+	exec {fd}> "$lock_dir/$1.lock"
+	flock "$fd"
+	"${@:2}"
+	status=$?
+	exec {fd}>&-
+	return $status
+}
+
+# usage: with_slot <resource> <slots> <command> [arguments]
+# run a command once one of the slots of a resource is free
+with_slot() {
+	local fd status i
+	mkdir -p "$lock_dir"
+	while true; do
+		for ((i = 0; i < $2; i++)); do
+			exec {fd}> "$lock_dir/$1.$i.slot"
+			if flock -n "$fd"; then
+				"${@:3}"
+				status=$?
+				exec {fd}>&-
+				return $status
+			fi
+			exec {fd}>&-
+		done
+		sleep 1
+	done
+}
+
+default lock_dir /run/lock/starchy
+default squash_slots 1
+default download_slots 2
+
+trap 'err "a build stage failed"' USR1
+trap stop_stages EXIT
+
+default jobs "$(nproc)"
+
 shopt -s extglob # enable extended globbing
 
 # build options
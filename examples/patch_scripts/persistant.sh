@@ -26,6 +26,9 @@
 # additionally it also symlinks the NetworkManager config to enable
 # remembering network connections
 
+# to keep every change to the system instead, boot with
+# sfs_overlay=persist:<device> (see mkinitcpio -H squashfs)
+
 mkdir /new_root/persistant
 [[ ! -d $patch/persistant/home ]] && mkdir -p "$patch/persistant/home"
 [[ ! -d $patch/persistant/NetworkManager ]] && mkdir -p "$patch/persistant/NetworkManager"
@@ -0,0 +1,38 @@
+#!/usr/bin/bash
+
+# Copyright (C) 2025 LightDig
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+# SOFTWARE.
+
+# hardware profile collector
+# run on a target machine, preferably while booted from the medium the image
+# will be used from, and pass the profile to starchy.py --hw-profile.
+# usage: hwprofile.sh [output file]
+
+# make sure we are running in bash
+if [ -z "$BASH_VERSION" ]
+then
+	echo "Please use bash. Other shells may result in undefined behaviour."
+	exit 1
+fi
+
+{
+	echo "# hardware profile of $(uname -n), $(date -u +%F)"
+	echo "kernel $(uname -r)"
+	# modules that are loaded right now
+	awk '{print "module", $1}' /proc/modules 2> /dev/null | sort
+	# every device the kernel knows about, including those without a loaded driver
+	find /sys/devices -name modalias -exec cat {} + 2> /dev/null | sort -u | sed 's/^/alias /'
+} > "${1:-/dev/stdout}"
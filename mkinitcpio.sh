@@ -40,69 +40,200 @@ default mkinitcpio_modules vfat
 default mkinitcpio_hooks "base microcode keyboard keymap autodetect udev block squashfs patch"
 # default mkinitcpio_passwd
 # default mkinitcpio_cmdline_blacklist
+# default verity_roothash # dm-verity root hash the squashfs hook requires the image to match
 default mkinitcpio_compression zstd
 
+## initramfs cache
+# initramfs images are cached by a hash of everything that goes into them,
+# set no_cache to true to neither use nor fill the cache
+default initramfs_cache_dir /var/cache/starchy/initramfs
+default initramfs_cache_keep 10
+
+## initramfs variants
+# every variant is built next to initramfs.img as initramfs-<name>.img, e.g.
+# default_arr initramfs_variants "fallback,compression=xz" "nopasswd,no_passwd,no_blacklist" "lts,kernel=6.6.30-1-lts"
+# options: compression=<compression> kernel=<path or version> no_passwd no_blacklist
+
+# lists passed by the wrapper are seperated by 0x1b, mkinitcpio.conf wants spaces
+for x in mkinitcpio_modules mkinitcpio_binaries mkinitcpio_hooks mkinitcpio_cmdline_blacklist; do
+	eval "$x=\${$x//\$'\\e'/ }"
+done
+[[ -v initramfs_variants_arr ]] && IFS=$'\e' read -ra initramfs_variants <<< "$initramfs_variants_arr"
+
+# a sha512sum of the boot password may be given instead of asking for it
+[[ $mkinitcpio_passwd =~ ^[0-9a-f]{128}$ ]] && mkinitcpio_passwd_hash=$mkinitcpio_passwd
+[[ -z $verity_roothash ]] || [[ $verity_roothash =~ ^[0-9a-f]{64}$ ]] || err "verity_roothash is not a sha256 root hash"
+
 # if kernel from local device is specified
 # as an argument then use that one.
 if [[ $1 ]]; then
 	kernel="$1"
 fi
 
-# ### INITRAMFS GENERATION ###
+# ### FUNCTIONS ###
+# usage: find_kernel <path or version>
+# versions are looked up in the modules of $moduleroot, like mkinitcpio does
+find_kernel() {
+	if [[ -f $1 ]]; then
+		echo "$1"
+	elif [[ -f "$moduleroot/usr/lib/modules/$1/vmlinuz" ]]; then
+		echo "$moduleroot/usr/lib/modules/$1/vmlinuz"
+	else
+		echo "kernel '$1' not found" >&2
+		return 1
+	fi
+}
+
+# usage: initramfs_key
+# hash of the kernel, the configuration, the hooks in use and the modules they
+# can pick from. autodetect also depends on the hardware of this machine
+initramfs_key() {
+	local x d
+	{
+		sha256sum < "$variant_kernel"
+		cat "$dir/mkinitcpio.conf"
+		mkinitcpio --version
+		for x in "${hooks[@]}"; do
+			for d in "${hookdirs[@]}"; do
+				[[ -f "$d/install/$x" ]] || continue
+				cat "$d/install/$x" "$d/hooks/$x" 2> /dev/null | sha256sum
+				break
+			done
+		done
+		[[ -d "$dir/lib" ]] && cat "$dir"/lib/* | sha256sum
+		cat "$moduleroot"/usr/lib/modules/*/modules.dep 2> /dev/null | sha256sum
+		for x in $mkinitcpio_binaries; do
+			type -P "$x" | xargs -r cat | sha256sum
+		done
+		for x in $mkinitcpio_files; do
+			cat "${x%%:*}" 2> /dev/null | sha256sum
+		done
+		if [[ " ${hooks[*]} " = *" autodetect "* ]]; then
+			find /sys/devices -name modalias -exec cat {} + 2> /dev/null | sort -u | sha256sum
+			findmnt -no FSTYPE /
+		fi
+	} | sha256sum | cut -d' ' -f1
+}
+
+# generate an initramfs and store it in the cache, unless another build just did
+generate_initramfs() {
+	if [[ ! $no_cache = true ]] && [[ -f "$initramfs_cache_dir/$key.img" ]]; then
+		return
+	fi
+	local args=() d
+	for d in "${hookdirs[@]}"; do
+		args+=(--hookdir "$d")
+	done
+	span "mkinitcpio_$name" mkinitcpio --config "$dir/mkinitcpio.conf" "${args[@]}" \
+		--generate "$dir/initramfs.img" --kernel "$variant_kernel" \
+		${moduleroot:+--moduleroot "$moduleroot"} || return 1
+	[[ $no_cache = true ]] && return
+	mkdir -p "$initramfs_cache_dir"
+	cp --reflink=auto "$dir/initramfs.img" "$initramfs_cache_dir/$key.img.tmp" &&
+		mv "$initramfs_cache_dir/$key.img.tmp" "$initramfs_cache_dir/$key.img"
+}
+
+# usage: build_initramfs <name> [option]...
+# every variant is built in a directory of its own, so variants and builds can
+# run at the same time without touching /etc/initcpio
+build_initramfs() {
+	local name=$1 dir="$wdir/initcpio/$1" out=initramfs.img
+	local compression=$mkinitcpio_compression variant_kernel=$kernel
+	local passwd=$mkinitcpio_passwd_hash blacklist=$mkinitcpio_cmdline_blacklist
+	local hooks=() hookdirs=() anchor=keyboard x key
+	for x in "${@:2}"; do
+		case $x in
+			compression=*) compression=${x#*=} ;;
+			kernel=*) variant_kernel=$(find_kernel "${x#*=}") || return 1 ;;
+			no_passwd) passwd="" ;;
+			no_blacklist) blacklist="" ;;
+			*) echo "unknown option '$x' of initramfs variant '$name'"; return 1 ;;
+		esac
+	done
+	[[ $name = default ]] || out="initramfs-$name.img"
+	mkdir -p "$dir"
+
+	if [[ $mkinitcpio_vanilla_hooks = true ]]; then
+		hooks=($mkinitcpio_hooks)
+	else
+		cp -r "$mdir"/. "$dir/"
+		hookdirs=("$dir")
+		# the boot password and blacklist are asked for after keymap if it is present, otherwise after keyboard
+		[[ " $mkinitcpio_hooks " = *" keymap "* ]] && anchor=keymap
+		for x in $mkinitcpio_hooks; do
+			hooks+=("$x")
+			if [[ $x = "$anchor" ]]; then
+				[[ $blacklist ]] && hooks+=(cmdline-blacklist)
+				[[ $passwd ]] && hooks+=(passwd)
+			fi
+		done
+		[[ $passwd ]] && sed -i "s/PASSWD_HASH/$passwd/" "$dir/hooks/passwd"
+		[[ $verity_roothash ]] && sed -i "s/VERITY_ROOTHASH/$verity_roothash/" "$dir/hooks/squashfs"
+		[[ $blacklist ]] && sed -i "s/CMDLINE_BLACKLIST/$(sed 's/[\/&]/\\&/g' <<< "$blacklist")/" "$dir/hooks/cmdline-blacklist"
+	fi
+	hookdirs+=(/etc/initcpio /usr/lib/initcpio)
 
-# variable containing mkinitcpio.conf
-# do not set if sourced script already provides this
-[[ -z $mkinitcpio_conf ]] && mkinitcpio_conf=$(cat <<EOF
-MODULES=(${mkinitcpio_modules[*]})
-BINARIES=(${mkinitcpio_binaries[*]})
-FILES=(${mkinitcpio_files[*]})
-HOOKS=(${mkinitcpio_hooks[*]})
-COMPRESSION="$mkinitcpio_compression"
+	# do not change the configuration if sourced script already provides it
+	if [[ $mkinitcpio_conf ]]; then
+		echo "$mkinitcpio_conf" > "$dir/mkinitcpio.conf"
+		[[ $compression = "$mkinitcpio_compression" ]] || echo "COMPRESSION=\"$compression\"" >> "$dir/mkinitcpio.conf"
+	else
+		cat <<EOF > "$dir/mkinitcpio.conf"
+MODULES=($mkinitcpio_modules)
+BINARIES=($mkinitcpio_binaries)
+FILES=($mkinitcpio_files)
+HOOKS=(${hooks[*]})
+COMPRESSION="$compression"
 EOF
-)
+	fi
 
-# the hooks are overlayed to prevent any chance of accidentally messing
-# with the users system. This script is supposed to be able to run without
-# any changes to the system, other than at the pwd, if it is configured correctly.
+	key=$(initramfs_key)
+	if [[ ! $no_cache = true ]] && [[ -f "$initramfs_cache_dir/$key.img" ]]; then
+		echo "Using cached initramfs $key"
+	else
+		with_lock "initramfs-$key" generate_initramfs || return 1
+	fi
 
-# create temporary filesystem for working on mkinitcpio hooks
-mount -t tmpfs initcpio "$wdir/initcpio"
+	if [[ $no_cache = true ]]; then
+		mv "$dir/initramfs.img" "$odir/$out"
+	else
+		cp --reflink=auto "$initramfs_cache_dir/$key.img" "$odir/$out" || return 1
+		touch "$initramfs_cache_dir/$key.img" # the least recently used images are removed first
+	fi
+	# a variant with its own kernel gets a copy of it
+	[[ $variant_kernel = "$kernel" ]] || cp "$variant_kernel" "$odir/vmlinuz-$name"
+	rm -rf "$dir"
+}
 
-# copy mkinitcpio hooks into temporary directory
-cp -r "$mdir"/{hooks,install,post} "$wdir/initcpio/"
+# keep only the most recently used images in the initramfs cache
+prune_initramfs_cache() {
+	[[ -d $initramfs_cache_dir ]] || return 0
+	ls -t "$initramfs_cache_dir"/*.img 2> /dev/null | tail -n +$((initramfs_cache_keep + 1)) | xargs -r rm -f
+}
 
-if [[ ! $mkinitcpio_vanilla_hooks = true ]]; then # skip the following section for $mkinitcpio_vanilla_hooks = true
-# check if password hash has been provided, set up password hook with hash
-if [[ $mkinitcpio_passwd_hash ]]; then
-	# place the hash in the file
-	sed -Ei "s/$(sed 's/  -//' <<< "$mkinitcpio_passwd_hash")/PASSWD_HASH" "$wdir/initcpio/hooks/passwd"
-# if no hash is provided, but password is desired, request entering password
-elif [[ $mkinitcpio_passwd ]]; then
+# ### INITRAMFS GENERATION ###
+
+# the boot password is asked for once, before the variants are built
+span_begin passwd
+if [[ ! $mkinitcpio_vanilla_hooks = true ]] && [[ $mkinitcpio_passwd ]] && [[ ! $mkinitcpio_passwd_hash ]]; then
+	# without a terminal both prompts read nothing, and nothing can unlock the hook
+	[[ -t 0 ]] || err "no terminal to ask for the boot password, set mkinitcpio_passwd to its sha512sum"
 	while true; do
 		read -rsp 'Enter boot password > ' pass1 # set password
+		echo
 		read -rsp 'Confirm password > ' pass2 # confirm password
+		echo
 		[[ "$pass1" = "$pass2" ]] && break # if they match, break loop
 		echo "Passwords don't match! Try again."
 	done
-	pass1=$(sed -E 's/\\/\\\\/g;s/  -$//' <<< "$pass1") # fix backslashes for sed and clean output
-	sed -Ei "s/PASSWD_HASH/$pass1/" "$wdir/initcpio/hooks/passwd" # place hash in hook
-fi
-
-# if cmdline parameter blacklist is provided
-if [[ $mkinitcpio_cmdline_blacklist ]]; then
-	mkinitcpio_cmdline_blacklist=$(sed 's/\\/\\\\/g' <<< "$mkinitcpio_cmdline_blacklist")
-	sed -Ei "s/CMDLINE_BLACKLIST/$mkinitcpio_cmdline_blacklist/" "$wdir/initcpio/hooks/cmdline-blacklist"
+	# the hook compares against the hash of what is entered at boot
+	mkinitcpio_passwd_hash=$(echo "$pass1" | sha512sum | cut -d' ' -f1)
+	unset pass1 pass2
 fi
-
-mount -t overlay hooks -o "lowerdir=/etc/initcpio:$wdir/initcpio" /etc/initcpio
-
-echo "$mkinitcpio_conf" > "$wdir/initcpio/mkinitcpio.conf"
-
-fi # end if for $mkinitcpio_vanilla_hooks != true
-
-# mkinitcpio --config "$wdir/initcpio/mkinitcpio.conf" --generate "$odir/initramfs.img"
+span_end
 
 back="$(pwd)"
+span_begin kernel_selection
 if [[ ! $kernel ]]; then
 	echo "This script hasn't been passed a kernel location yet"
 	echo "Please specify a path to your system image to fetch"
@@ -153,21 +284,35 @@ if [[ ! $kernel ]]; then
 		kernel="$(pwd)/${kernels[0]}/vmlinuz"
 	fi
 fi
+span_end
 
 if ! cd "$back"; then
 	echo "Failed to return to pwd ($back)"
 	exit 1
 fi
 
-mkinitcpio --config "$wdir/initcpio/mkinitcpio.conf" --generate "$odir/initramfs.img" --kernel "$kernel"
+# modules are taken from $moduleroot when set, e.g. the system the kernel belongs to
+# the initramfs and its variants are built at the same time
+stage initramfs_default build_initramfs default
+variants=(default)
+for x in "${initramfs_variants[@]}"; do
+	IFS=, read -ra variant <<< "$x"
+	[[ ${variant[0]} =~ ^[A-Za-z0-9_-]+$ ]] || err "initramfs variant name '${variant[0]}' may only contain letters, digits, - and _"
+	[[ " ${variants[*]} " = *" ${variant[0]} "* ]] && err "initramfs variant '${variant[0]}' is given more than once"
+	variants+=("${variant[0]}")
+	stage "initramfs_${variant[0]}" build_initramfs "${variant[@]}"
+done
+for x in "${variants[@]}"; do
+	wait_stage "initramfs_$x" || err "failed to build initramfs variant '$x'"
+done
+[[ $no_cache = true ]] || with_lock initramfs-cache prune_initramfs_cache
+# the kernel is placed next to the initramfs it was built for
+cp "$kernel" "$odir/vmlinuz"
 
 # unmount
-errs=()
-
-umount /tmp/recovery/mount; errs+=($?)
-umount /etc/initcpio; errs+=($?)
-umount "$wdir/initcpio"; err+=($?)
-
-for e in "${errs[@]}"; do
-	[[ ! $e -eq 0 ]] && echo "At least one umount failed. Try again with ./cleanup"; break
-done
+span_begin umount
+if mountpoint -q "$wdir/mount"; then
+	umount "$wdir/mount" || echo "Failed to unmount $wdir/mount. Try again with ./cleanup"
+fi
+rm -rf "$wdir/initcpio"
+span_end
@@ -0,0 +1,335 @@
+#!/usr/bin/python3
+
+# Copyright (C) 2025 LightDig
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+# SOFTWARE.
+
+from argparse import ArgumentParser
+import json
+import os
+from pathlib import Path
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+# ### ARGUMENTS ###
+parser = ArgumentParser(
+	prog='sfsbench.py',
+	description="SquashFS compression benchmark\n\nCompresses a sample of a system root or image with a matrix of mksquashfs settings and measures image size, compression time and decompression throughput.",
+	epilog="Mounting the sample images requires root. Without it, only sequential throughput is measured using unsquashfs."
+)
+parser.add_argument('source',
+	type=str,
+	help="Root directory of a built system or an existing SquashFS image"
+)
+parser.add_argument('-g','--goal',
+	type=str,
+	default="size",
+	choices=("size","usb","ram"),
+	help="What to optimise for when picking the best setting: minimal size, fastest boot from USB or fastest copy_to_ram (Default = size)"
+)
+parser.add_argument('-s','--sample-size',
+	type=str,
+	default="256M",
+	help="Amount of data to sample from the source (Default = 256M)"
+)
+parser.add_argument('-b','--block-sizes',
+	nargs='*',
+	type=str,
+	default=["128K","1M"],
+	help="Block sizes to test (Default = 128K 1M)"
+)
+parser.add_argument('-l','--zstd-levels',
+	nargs='*',
+	type=int,
+	default=[3,9,15,19,22],
+	help="zstd compression levels to test (Default = 3 9 15 19 22)"
+)
+parser.add_argument('-c','--compressors',
+	nargs='*',
+	type=str,
+	default=["gzip","lzo","lz4","xz","zstd"],
+	help="Compressors to test (Default = gzip lzo lz4 xz zstd)"
+)
+parser.add_argument('--usb-speed',
+	type=float,
+	default=30,
+	help="Read speed of the boot medium in MB/s, used for the usb and ram goals (Default = 30)"
+)
+parser.add_argument('--boot-size',
+	type=str,
+	default="256M",
+	help="Amount of data read while booting, used for the usb and ram goals (Default = 256M)"
+)
+parser.add_argument('--seed',
+	type=int,
+	default=0,
+	help="Seed for sampling files, so runs are comparable (Default = 0)"
+)
+parser.add_argument('-t','--tmp',
+	type=str,
+	default=None,
+	help="Directory for the sample and test images (Default = system temporary directory)"
+)
+parser.add_argument('-o','--output',
+	type=str,
+	default=None,
+	help="Write results as json to this file"
+)
+parser.add_argument('--select',
+	default=False,
+	action='store_true',
+	help="Only print the mksquashfs options of the best setting, for use by starchy.sh"
+)
+
+# ### FUNCTIONS ###
+# function for turning a size with an optional K/M/G suffix into bytes
+def parse_size(s):
+	units = {"K": 1024, "M": 1048576, "G": 1073741824}
+	if s[-1:].upper() in units:
+		return int(float(s[:-1]) * units[s[-1:].upper()])
+	return int(s)
+
+# function for printing progress, which goes to stderr so --select stays parseable
+def log(*msg):
+	print(*msg,file=sys.stderr,flush=True)
+
+# function that builds the list of settings to benchmark
+# every setting is a list of arguments passed after -comp
+def settings_matrix(compressors,block_sizes,levels):
+	matrix = []
+	for block in block_sizes:
+		for comp in compressors:
+			if comp == "zstd":
+				matrix += [["zstd","-Xcompression-level",str(x),"-b",block] for x in levels]
+			elif comp == "xz":
+				matrix.append(["xz","-b",block])
+				# a smaller dictionary speeds up decompression of large blocks
+				if parse_size(block) > 131072:
+					matrix.append(["xz","-Xdict-size","25%","-b",block])
+			else:
+				matrix.append([comp,"-b",block])
+	return matrix
+
+# function that lists regular files and their sizes in a directory
+def list_dir(root):
+	files = []
+	for path,dirs,names in os.walk(root):
+		for name in names:
+			x = Path(path) / name
+			if x.is_file() and not x.is_symlink():
+				files.append((x.relative_to(root),x.stat().st_size))
+	return files
+
+# function that lists regular files and their sizes in a SquashFS image
+def list_image(image):
+	out = subprocess.run(("unsquashfs","-lls","-n",image),capture_output=True,text=True,check=True).stdout
+	files = []
+	for line in out.splitlines():
+		# <permissions> <owner> <size> <date> <time> squashfs-root/<path>
+		parts = line.split(None,5)
+		if len(parts) < 6 or not parts[0].startswith("-"):
+			continue
+		files.append((Path(parts[5]).relative_to("squashfs-root"),int(parts[2])))
+	return files
+
+# function that copies a random subset of files into a sample directory
+def make_sample(source,sample,budget,seed):
+	is_image = source.is_file()
+	files = list_image(source) if is_image else list_dir(source)
+	random.Random(seed).shuffle(files)
+
+	chosen = []
+	total = 0
+	for path,size in files:
+		if total >= budget:
+			break
+		chosen.append(path)
+		total += size
+
+	if is_image:
+		extract_list = sample.parent / "extract"
+		extract_list.write_text("".join(("".join(("/",str(x),"\n")) for x in chosen)))
+		subprocess.run(("unsquashfs","-f","-q","-n","-d",sample,"-ef",extract_list,source),check=True,stdout=subprocess.DEVNULL)
+	else:
+		for x in chosen:
+			(sample / x).parent.mkdir(parents=True,exist_ok=True)
+			try: # hardlinks are free if the sample is on the same filesystem
+				os.link(source / x,sample / x)
+			except OSError:
+				shutil.copy2(source / x,sample / x)
+
+	return sum(size for path,size in list_dir(sample)),len(chosen)
+
+# function that reads every file of a tree in order and returns the time it took
+def read_sequential(root):
+	start = time.perf_counter()
+	for path,dirs,names in os.walk(root):
+		dirs.sort()
+		for name in sorted(names):
+			x = Path(path) / name
+			if x.is_file() and not x.is_symlink():
+				with open(x,'rb',buffering=0) as file:
+					while file.read(1048576):
+						pass
+	return time.perf_counter() - start
+
+# function that performs reads of random files at random offsets
+# returns the amount of reads per second
+def read_random(root,files,seed,count=2000,size=16384):
+	rng = random.Random(seed)
+	files = [x for x in files if x[1] > 0]
+	weights = [x[1] for x in files]
+	start = time.perf_counter()
+	for path,length in rng.choices(files,weights=weights,k=count):
+		with open(root / path,'rb',buffering=0) as file:
+			file.seek(rng.randrange(0,max(1,length - size)))
+			file.read(size)
+	return count / (time.perf_counter() - start)
+
+# function that benchmarks one setting
+def run_setting(setting,sample,sample_size,sample_files,tmp,seed):
+	image = tmp / "test.sfs"
+	mount = tmp / "mnt"
+	result = {"setting": " ".join(setting)}
+
+	start = time.perf_counter()
+	proc = subprocess.run(("mksquashfs",sample,image,"-noappend","-no-progress","-comp",*setting),capture_output=True,text=True)
+	if proc.returncode:
+		result["error"] = proc.stderr.strip().splitlines()[-1] if proc.stderr.strip() else "mksquashfs failed"
+		return result
+	result["compress_time"] = time.perf_counter() - start
+	result["size"] = image.stat().st_size
+	result["ratio"] = result["size"] / sample_size
+
+	mount.mkdir(exist_ok=True)
+	if subprocess.run(("mount","-t","squashfs","-o","loop,ro",image,mount),capture_output=True).returncode == 0:
+		try:
+			result["seq_throughput"] = sample_size / read_sequential(mount)
+			# remount so the random reads start with an empty cache
+			subprocess.run(("umount",mount),check=True)
+			subprocess.run(("mount","-t","squashfs","-o","loop,ro",image,mount),check=True)
+			result["random_reads"] = read_random(mount,sample_files,seed)
+		finally:
+			subprocess.run(("umount",mount))
+	else: # fall back to unsquashfs when not able to mount
+		out = tmp / "out"
+		start = time.perf_counter()
+		subprocess.run(("unsquashfs","-f","-q","-n","-d",out,image),check=True,stdout=subprocess.DEVNULL)
+		result["seq_throughput"] = sample_size / (time.perf_counter() - start)
+		shutil.rmtree(out)
+
+	image.unlink()
+	return result
+
+# function that estimates a score in seconds (or bytes for size) for a goal; lower is better
+# usb: reading the boot working set with random reads, each fetching a whole compressed block
+# ram: copying the whole image to RAM, then reading the boot working set from RAM
+def score(result,goal,source_size,usb_speed,boot_size,read_size=16384):
+	if goal == "size":
+		return result["size"]
+	block = parse_size(result["setting"].split("-b ")[-1].split()[0])
+	reads = boot_size / read_size
+	if result.get("random_reads"):
+		decompress = reads / result["random_reads"]
+	else:
+		decompress = boot_size / result["seq_throughput"] * block / read_size
+	if goal == "usb":
+		return reads * block * result["ratio"] / usb_speed + decompress
+	return source_size * result["ratio"] / usb_speed + decompress
+
+# function for formatting a number of bytes
+def human_size(n):
+	for unit in ("B","KiB","MiB","GiB"):
+		if abs(n) < 1024:
+			break
+		n /= 1024
+	return "".join((str(round(n,1)),unit))
+
+# function that prints the results as a table
+def print_table(results,best):
+	log("".join(("setting".ljust(44),"size".rjust(10),"ratio".rjust(7),"comp s".rjust(8),"seq/s".rjust(11),"rand/s".rjust(8))))
+	for x in results:
+		if "error" in x:
+			log("".join((x["setting"].ljust(44)," error: ",x["error"])))
+			continue
+		log("".join((
+			("* " if x is best else "  "),x["setting"].ljust(42),
+			human_size(x["size"]).rjust(10),
+			str(round(x["ratio"],3)).rjust(7),
+			str(round(x["compress_time"],1)).rjust(8),
+			human_size(x["seq_throughput"]).rjust(11),
+			(str(int(x["random_reads"])) if x.get("random_reads") else "-").rjust(8)
+		)))
+
+# ### MAIN ###
+def main():
+	args = parser.parse_args()
+	if not shutil.which("mksquashfs"):
+		sys.exit("mksquashfs not found, please install squashfs-tools")
+	source = Path(args.source).expanduser().absolute()
+	if not source.exists():
+		sys.exit("".join(("Source '",str(source),"' does not exist")))
+
+	usb_speed = args.usb_speed * 1000000
+	boot_size = parse_size(args.boot_size)
+	if source.is_file():
+		source_size = sum(size for path,size in list_image(source))
+	else:
+		source_size = sum(size for path,size in list_dir(source))
+
+	with tempfile.TemporaryDirectory(prefix="sfsbench.",dir=args.tmp) as tmp:
+		tmp = Path(tmp)
+		sample = tmp / "sample"
+		sample.mkdir()
+		log("Sampling",args.sample_size,"from",str(source))
+		sample_size,count = make_sample(source,sample,parse_size(args.sample_size),args.seed)
+		sample_files = list_dir(sample)
+		log("".join(("Sampled ",str(count)," files (",human_size(sample_size),")")))
+
+		results = []
+		for setting in settings_matrix(args.compressors,args.block_sizes,args.zstd_levels):
+			log("Testing:"," ".join(setting))
+			results.append(run_setting(setting,sample,sample_size,sample_files,tmp,args.seed))
+
+	valid = [x for x in results if "error" not in x]
+	if not valid:
+		sys.exit("No setting could be benchmarked")
+	for x in valid:
+		x["score"] = score(x,args.goal,source_size,usb_speed,boot_size)
+	best = min(valid,key=lambda x: x["score"])
+
+	print_table(results,best)
+	if args.output:
+		with open(args.output,'w') as file:
+			json.dump({
+				"source": str(source),
+				"source_size": source_size,
+				"sample_size": sample_size,
+				"goal": args.goal,
+				"best": best["setting"],
+				"results": results
+			},file,indent=2,allow_nan=False)
+
+	if args.select:
+		print(best["setting"])
+	else:
+		log("".join(("Best setting for goal '",args.goal,"': ",best["setting"])))
+
+if __name__ == "__main__":
+	main()
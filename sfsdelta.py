@@ -0,0 +1,282 @@
+#!/usr/bin/python3
+
+# Copyright (C) 2025 LightDig
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+# SOFTWARE.
+
+from argparse import ArgumentParser
+import hashlib
+import json
+import os
+from pathlib import Path
+import sys
+import tempfile
+import time
+from urllib.parse import urljoin
+from urllib.request import urlopen
+
+# chunk boundaries are placed after every occurrence of a marker, so an
+# unchanged part of an image is cut the same way wherever it moved to.
+# images are mostly compressed data, in which a two byte marker occurs about
+# every 64KiB. Searching for it with bytes.find is far faster in python than a
+# rolling hash, min_chunk and max_chunk bound the chunks of uncompressed data
+marker = b"\x8d\x35"
+min_chunk = 16384
+max_chunk = 262144
+read_size = 8388608
+
+# ### ARGUMENTS ###
+parser = ArgumentParser(
+	prog='sfsdelta.py',
+	description="Chunk index and delta updater for system images\n\nIndexes an image into content defined chunks stored by their hash, and rebuilds a new image from an old one plus only the chunks it is missing.",
+)
+subparsers = parser.add_subparsers(dest="command",required=True)
+
+index_parser = subparsers.add_parser('index',
+	help="Write the chunk index of an image and store its chunks"
+)
+index_parser.add_argument('image',
+	type=str,
+	help="Image to index, e.g. system.sfs"
+)
+index_parser.add_argument('-o','--output',
+	type=str,
+	default=None,
+	help="Where to write the index (Default = <image>.index)"
+)
+index_parser.add_argument('-s','--store',
+	type=str,
+	default=None,
+	help="Directory in which chunks are stored, may be shared by many images (Default = system.chunks next to the image)"
+)
+index_parser.add_argument('-u','--store-url',
+	type=str,
+	default=None,
+	help="URL at which the store is served, recorded in the index when the store is not inside the directory of the index (Default = the absolute path of the store)"
+)
+
+update_parser = subparsers.add_parser('update',
+	help="Build a new image from an old image and the chunks it is missing"
+)
+update_parser.add_argument('index',
+	type=str,
+	help="Path or http(s) URL of the index of the new image"
+)
+update_parser.add_argument('output',
+	type=str,
+	help="Where to write the new image. An interrupted update continues from <output>.part"
+)
+update_parser.add_argument('-O','--old',
+	nargs='*',
+	type=str,
+	default=[],
+	help="Old images to reuse chunks from"
+)
+update_parser.add_argument('-s','--store',
+	type=str,
+	default=None,
+	help="Path or http(s) URL of the chunk store (Default = the store named in the index, relative to the index). python3 -m http.server in the output directory of a build serves both."
+)
+
+# ### FUNCTIONS ###
+# function for formatting a number of bytes
+def human_size(n):
+	for unit in ("B","KiB","MiB","GiB"):
+		if abs(n) < 1024:
+			break
+		n /= 1024
+	return "".join((str(round(n,1)),unit))
+
+# function that yields the content defined chunks of a file
+def chunks(file):
+	buf = b""
+	pos = 0
+	eof = False
+	while True:
+		if not eof and len(buf) - pos < max_chunk:
+			data = file.read(read_size)
+			eof = not data
+			buf = b"".join((buf[pos:],data))
+			pos = 0
+			continue
+		if pos == len(buf):
+			return
+		end = buf.find(marker,pos + min_chunk,pos + max_chunk)
+		if end != -1:
+			end += len(marker)
+		else:
+			end = min(pos + max_chunk,len(buf)) # uncompressed data or the end of the file
+		yield buf[pos:end]
+		pos = end
+
+# function for the path of a chunk in a store, stores are split by the first two characters
+def chunk_path(digest):
+	return "".join((digest[:2],"/",digest))
+
+# function that opens a path or an http(s) URL for reading
+def open_location(location):
+	if location.startswith(("http://","https://")):
+		return urlopen(location)
+	return open(location,'rb')
+
+# function for where an index finds its store: relative to the index when the
+# store is inside its directory, so both can be served together, otherwise the
+# URL of the store or its absolute path
+def store_location(store,output,store_url=None):
+	if store.is_relative_to(output.parent):
+		return os.path.relpath(store,output.parent)
+	return store_url or str(store)
+
+# function that writes a chunk into the store, which builds may fill at the same time
+# every writer renames its own temporary file, a chunk that is already there has the same data
+def store_chunk(path,chunk):
+	path.parent.mkdir(parents=True,exist_ok=True)
+	fd,tmp = tempfile.mkstemp(prefix=".",suffix=".tmp",dir=path.parent)
+	try:
+		with os.fdopen(fd,'wb') as file:
+			file.write(chunk)
+		os.chmod(tmp,0o644)
+		os.replace(tmp,path)
+	except BaseException:
+		Path(tmp).unlink(missing_ok=True)
+		raise
+
+# function that indexes an image and stores the chunks that are not yet in the store
+def index_image(image,output,store,store_url=None):
+	entries = []
+	total = hashlib.sha256()
+	new = 0
+	with open(image,'rb') as file:
+		for chunk in chunks(file):
+			digest = hashlib.sha256(chunk).hexdigest()
+			total.update(chunk)
+			entries.append((digest,len(chunk)))
+			path = store / chunk_path(digest)
+			if not path.is_file():
+				store_chunk(path,chunk)
+				new += len(chunk)
+	index = {
+		"version": 1,
+		"size": sum(x[1] for x in entries),
+		"sha256": total.hexdigest(),
+		"store": store_location(store,output,store_url),
+		"chunks": entries
+	}
+	with open(output,'w') as file:
+		json.dump(index,file,allow_nan=False)
+	print("".join(("Indexed ",str(len(entries))," chunks of ",human_size(index["size"]),", ",human_size(new)," new in the store")))
+
+# function that maps the chunks of old images to where they can be read
+def index_old(images):
+	known = {}
+	for image in images:
+		offset = 0
+		with open(image,'rb') as file:
+			for chunk in chunks(file):
+				known.setdefault(hashlib.sha256(chunk).hexdigest(),(image,offset,len(chunk)))
+				offset += len(chunk)
+	return known
+
+# function that reads a chunk from an old image or the partial new image
+def read_local(image,offset,length):
+	with open(image,'rb') as file:
+		file.seek(offset)
+		return file.read(length)
+
+# function that rebuilds a new image from old images and missing chunks
+# chunks already in the partial output are checked and kept, so an
+# interrupted update continues where it stopped
+def update_image(index_location,output,old,store):
+	with open_location(index_location) as file:
+		index = json.load(file)
+	if store is None:
+		if index["store"].startswith(("http://","https://")):
+			store = index["store"]
+		elif index_location.startswith(("http://","https://")):
+			if os.path.isabs(index["store"]):
+				sys.exit("".join(("The index names the local store '",index["store"],"', pass the URL of the store with --store")))
+			store = urljoin(index_location,"".join((index["store"],"/")))
+		else:
+			store = str(Path(index_location).parent / index["store"])
+	partial = Path("".join((str(output),".part")))
+	known = index_old(old)
+	reused = fetched = resumed = 0
+	start = time.time()
+
+	with open(partial,'a+b') as out:
+		# keep the chunks of an earlier attempt for as long as they are correct
+		out.seek(0)
+		offset = 0
+		done = 0
+		for digest,length in index["chunks"]:
+			data = out.read(length)
+			if len(data) != length or hashlib.sha256(data).hexdigest() != digest:
+				break
+			known.setdefault(digest,(partial,offset,length))
+			offset += length
+			done += 1
+		resumed = offset
+		out.truncate(offset)
+		out.seek(offset)
+
+		for digest,length in index["chunks"][done:]:
+			if digest in known:
+				out.flush()
+				data = read_local(*known[digest])
+				reused += length
+			else:
+				with open_location("".join((store.rstrip("/"),"/",chunk_path(digest)))) as file:
+					data = file.read()
+				fetched += len(data)
+			if hashlib.sha256(data).hexdigest() != digest:
+				sys.exit("".join(("Chunk ",digest," is corrupt")))
+			known.setdefault(digest,(partial,offset,length))
+			out.write(data)
+			offset += length
+
+	# verify the whole image before replacing the output
+	total = hashlib.sha256()
+	with open(partial,'rb') as file:
+		while data := file.read(read_size):
+			total.update(data)
+	if total.hexdigest() != index["sha256"]:
+		partial.unlink()
+		sys.exit("Image hash does not match the index, the partial image was removed")
+	partial.rename(output)
+
+	size = index["size"]
+	print("".join(("Updated ",str(output)," (",human_size(size),") in ",str(round(time.time() - start,1)),"s")))
+	if resumed:
+		print("".join(("Resumed after ",human_size(resumed))))
+	print("".join(("Reused ",human_size(reused)," (",str(round(reused / size * 100 if size else 0,1)),"%), downloaded ",human_size(fetched))))
+
+# ### MAIN ###
+def main():
+	args = parser.parse_args()
+	if args.command == "index":
+		image = Path(args.image).expanduser().absolute()
+		if not image.is_file():
+			sys.exit("".join(("Image '",str(image),"' not found")))
+		output = Path(args.output).absolute() if args.output else image.with_name("".join((image.name,".index")))
+		store = Path(args.store).expanduser().absolute() if args.store else image.parent / "system.chunks"
+		index_image(image,output,store,args.store_url)
+	else:
+		for x in args.old:
+			if not Path(x).is_file():
+				sys.exit("".join(("Old image '",x,"' not found")))
+		update_image(args.index,Path(args.output).absolute(),args.old,args.store)
+
+if __name__ == "__main__":
+	main()
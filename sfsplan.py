@@ -0,0 +1,190 @@
+#!/usr/bin/python3
+
+# Copyright (C) 2025 LightDig
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+# SOFTWARE.
+
+from argparse import ArgumentParser
+import os
+from pathlib import Path
+import struct
+import sys
+import uuid
+
+# RAM tiers in KiB that a plan is made for; 0 means any amount of RAM
+tiers = [1048576, 2097152, 4194304, 8388608, 16777216, 0]
+
+# ### ARGUMENTS ###
+parser = ArgumentParser(
+	prog='sfsplan.py',
+	description="SquashFS memory planner\n\nWrites the metadata file that the squashfs hook uses to pick overlay, zram swap and copy_to_ram settings for the RAM of the machine it boots on, or prints the kernel command line it would pick.",
+)
+subparsers = parser.add_subparsers(dest="command",required=True)
+
+write_parser = subparsers.add_parser('write',
+	help="Write the metadata of a system root"
+)
+write_parser.add_argument('root',
+	type=str,
+	help="Root directory of the system"
+)
+write_parser.add_argument('-w','--workload-size',
+	type=str,
+	default="512M",
+	help="How much writable space the workload of the system needs (Default = 512M)"
+)
+write_parser.add_argument('-o','--output',
+	type=str,
+	default=None,
+	help="Where to write the metadata (Default = <root>/etc/starchy/image.conf)"
+)
+
+recommend_parser = subparsers.add_parser('recommend',
+	help="Print the recommended kernel command line for an amount of RAM"
+)
+recommend_parser.add_argument('plan',
+	type=str,
+	help="Metadata written by the write command, e.g. the system.plan next to system.sfs"
+)
+recommend_parser.add_argument('-r','--ram',
+	type=str,
+	required=True,
+	help="Amount of RAM of the machine, e.g. 4G"
+)
+recommend_parser.add_argument('-i','--image',
+	type=str,
+	default=None,
+	help="Image, used to decide whether it fits in RAM (Default = system.sfs or system.erofs next to the plan)"
+)
+
+# ### FUNCTIONS ###
+# function for turning a size with an optional K/M/G suffix into kibibytes
+# values without a suffix are treated as bytes, like in starchy.sh
+def to_kib(s):
+	units = {"K": 1, "M": 1024, "G": 1048576, "T": 1073741824}
+	if s[-1:].upper() in units:
+		return int(float(s[:-1]) * units[s[-1:].upper()])
+	return int(s) // 1024
+
+# function for formatting kibibytes the way the squashfs hook reads sizes
+def to_size(kib):
+	for unit in ("G","M"):
+		factor = {"G": 1048576, "M": 1024}[unit]
+		if kib >= factor:
+			return "".join((str(-(-kib // factor)),unit))
+	return "".join((str(kib),"K"))
+
+# function that adds up the size of every regular file, counting hardlinks once
+def uncompressed_size(root):
+	seen = set()
+	total = 0
+	for path,dirs,names in os.walk(root):
+		for name in names:
+			stat = os.lstat(os.path.join(path,name))
+			if (stat.st_mode & 0o170000) != 0o100000 or (stat.st_dev,stat.st_ino) in seen:
+				continue
+			seen.add((stat.st_dev,stat.st_ino))
+			total += stat.st_size
+	return total
+
+# function that reads the size of a SquashFS or EROFS image from its superblock
+def image_size(image):
+	with open(image,'rb') as file:
+		superblock = file.read(1088)
+	if superblock[:4] == b"hsqs":
+		return struct.unpack_from("<Q",superblock,40)[0]
+	if superblock[1024:1028] == struct.pack("<I",0xE0F5E1E2):
+		# block count << block size bits
+		return struct.unpack_from("<I",superblock,1060)[0] << superblock[1036]
+	sys.exit("".join(("'",str(image),"' is not a SquashFS or EROFS image")))
+
+# function that plans the overlay and zram swap for an amount of RAM in KiB
+# returns the squashfs_overlay and zram_swap values, or - for no zram swap
+# with little RAM the overlay is compressed in zram, zstd compresses most
+# writes by 2-3 times so the zram device can be larger than the workload.
+# with more RAM a tmpfs overlay is used, which only takes memory when written to
+def plan_tier(ram,workload):
+	if ram and ram < workload * 4:
+		return "".join((to_size(workload * 2),";zstd")),"".join((to_size(ram // 2),";zstd"))
+	overlay = max(workload * 2,ram // 4) if ram else workload * 4
+	if ram:
+		overlay = min(overlay,ram * 4 // 5)
+	swap = "".join((to_size(ram // 4),";lz4")) if ram and ram <= 8388608 else "-"
+	return "".join((to_size(overlay),";tmpfs")),swap
+
+# function that writes the metadata file
+def write_plan(root,workload,output):
+	lines = [
+		"# Starchy image metadata, generated by sfsplan.py",
+		"".join(("build_id=",uuid.uuid4().hex)),
+		"".join(("uncompressed_size=",str(uncompressed_size(root)))),
+		"".join(("workload_size=",str(workload))),
+		# copy_to_ram only if this much memory is left after copying the image
+		"".join(("copy_min_free=",str(max(1048576,workload * 2)))),
+		"# tier <maximum RAM in KiB, 0 = any> <squashfs_overlay> <zram_swap>"
+	]
+	for ram in tiers:
+		lines.append(" ".join(("tier",str(ram),*plan_tier(ram,workload))))
+	output.parent.mkdir(parents=True,exist_ok=True)
+	output.write_text("".join(("\n".join(lines),"\n")))
+
+# function that reads a metadata file into a dictionary and a list of tiers
+def read_plan(path):
+	values = {}
+	plan = []
+	for line in Path(path).read_text().splitlines():
+		if line.startswith("tier "):
+			plan.append(line.split()[1:])
+		elif "=" in line and not line.startswith("#"):
+			key,value = line.split("=",1)
+			values[key] = value
+	return values,plan
+
+# function that picks the same settings as the squashfs hook would
+def recommend(values,plan,ram,image):
+	for max_ram,overlay,swap in plan:
+		if max_ram == "0" or ram <= int(max_ram):
+			break
+	cmdline = ["".join(("sfs_overlay=",overlay))]
+	if swap != "-":
+		cmdline.append("".join(("zram_swap=",swap)))
+	if image is not None and ram - image // 1024 >= int(values["copy_min_free"]):
+		cmdline.append("sfs_copy=auto")
+	return " ".join(cmdline)
+
+# ### MAIN ###
+def main():
+	args = parser.parse_args()
+	if args.command == "write":
+		root = Path(args.root).expanduser().absolute()
+		if not root.is_dir():
+			sys.exit("".join(("Root '",str(root),"' is not a directory")))
+		output = Path(args.output) if args.output else root / "etc/starchy/image.conf"
+		write_plan(root,to_kib(args.workload_size),output)
+	else:
+		values,plan = read_plan(args.plan)
+		if args.image:
+			image = Path(args.image)
+		else:
+			image = Path(args.plan).with_suffix(".sfs")
+			if not image.is_file():
+				image = image.with_suffix(".erofs")
+		size = image_size(image) if image.is_file() else None
+		if size is None:
+			print("Image not found, not considering copy_to_ram",file=sys.stderr)
+		print(recommend(values,plan,to_kib(args.ram),size))
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,313 @@
+#!/usr/bin/python3
+
+# Copyright (C) 2025 LightDig
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+# SOFTWARE.
+
+from argparse import ArgumentParser
+from fnmatch import fnmatch
+import json
+import os
+import re
+from pathlib import Path
+import sys
+
+# built in rules, every rule is a list of patterns relative to the root
+# * also matches /, so patterns ending in /* match everything below a directory
+rules = {
+	"man": ["usr/share/man/*"],
+	"info": ["usr/share/info/*"],
+	"doc": ["usr/share/doc/*","usr/share/gtk-doc/*","usr/share/help/*"],
+	"locale": ["usr/share/locale/*"],
+	"static": ["usr/lib/*.a"],
+	"headers": ["usr/include/*"],
+	"pycache": ["usr/lib/python*/__pycache__","usr/lib/python*/__pycache__/*"],
+	"guile_cache": ["usr/lib/guile/*/ccache/*"]
+}
+
+# ### ARGUMENTS ###
+parser = ArgumentParser(
+	prog='sfsslim.py',
+	description="System slimming and size report\n\nRemoves files matching slimming rules from a system root, except those of kept packages, and attributes the size of a system to its packages, package groups and copy_to_root sources.",
+)
+subparsers = parser.add_subparsers(dest="command",required=True)
+
+slim_parser = subparsers.add_parser('slim',
+	help="Remove the files matching the rules"
+)
+slim_parser.add_argument('root',
+	type=str,
+	help="Root directory of the system"
+)
+slim_parser.add_argument('-r','--rules',
+	nargs='*',
+	type=str,
+	default=["locale","guile_cache"],
+	help="".join(("Rules to apply, either one of ",", ".join(rules)," or a pattern relative to the root like usr/share/fonts/* (Default = locale guile_cache)"))
+)
+slim_parser.add_argument('-l','--keep-locales',
+	nargs='*',
+	type=str,
+	default=["en","en_US"],
+	help="Locales the locale rule keeps (Default = en en_US)"
+)
+slim_parser.add_argument('-k','--keep-packages',
+	nargs='*',
+	type=str,
+	default=[],
+	help="Packages whose files are never removed"
+)
+slim_parser.add_argument('-n','--dry-run',
+	action='store_true',
+	help="Only show what would be removed and how much would be saved"
+)
+slim_parser.add_argument('--list',
+	type=str,
+	default=None,
+	help="Write every removed path to this file"
+)
+
+report_parser = subparsers.add_parser('report',
+	help="Attribute the size of a system to packages, package groups and copy_to_root sources"
+)
+report_parser.add_argument('root',
+	type=str,
+	help="Root directory of the system"
+)
+report_parser.add_argument('-g','--groups',
+	type=str,
+	default=None,
+	help="File of '<group> <package>' lines in install order, the dependencies of a package count towards the first group that needs them"
+)
+report_parser.add_argument('-s','--sources',
+	nargs='*',
+	type=str,
+	default=[],
+	help="Files listing the paths of every copy_to_root source in the order they were applied, named after the source on the first line. Paths may be followed by tab separated fields"
+)
+report_parser.add_argument('-o','--output',
+	type=str,
+	default=None,
+	help="Where to write the report as json"
+)
+report_parser.add_argument('-t','--top',
+	type=int,
+	default=15,
+	help="How many packages to show (Default = 15)"
+)
+
+# ### FUNCTIONS ###
+# function for formatting a number of bytes
+def human_size(n):
+	for unit in ("B","KiB","MiB","GiB"):
+		if abs(n) < 1024:
+			break
+		n /= 1024
+	return "".join((str(round(n,1)),unit))
+
+# function that reads which package owns every path from the pacman database of a system
+def read_owners(root):
+	owners = {}
+	for desc in (root / "var/lib/pacman/local").glob("*/desc"):
+		name = desc.read_text().split("%NAME%\n",1)[1].split("\n",1)[0]
+		files = (desc.parent / "files").read_text().split("%FILES%\n",1)
+		if len(files) < 2:
+			continue
+		for line in files[1].split("\n\n",1)[0].splitlines():
+			owners[line.rstrip("/")] = name
+	return owners
+
+# function that reads the dependencies of every installed package from the local database
+# dependencies on provided names and sonames are resolved to the packages that provide them
+def read_depends(root):
+	depends = {}
+	provides = {}
+	for desc in (root / "var/lib/pacman/local").glob("*/desc"):
+		fields = {}
+		for section in desc.read_text().split("\n\n"):
+			lines = section.strip().splitlines()
+			if lines and lines[0].startswith("%"):
+				fields[lines[0]] = lines[1:]
+		name = fields["%NAME%"][0]
+		depends[name] = [re.split(r"[<>=]",x,1)[0] for x in fields.get("%DEPENDS%",[])]
+		provides[name] = name
+		for x in fields.get("%PROVIDES%",[]):
+			provides.setdefault(re.split(r"[<>=]",x,1)[0],name)
+	return {name: {provides[x] for x in deps if x in provides} for name,deps in depends.items()}
+
+# function that assigns every installed package to the first group whose dependency
+# closure contains it. Groups are in the order they are installed, base first
+def group_closures(groups,depends):
+	claimed = {}
+	for group,packages in groups.items():
+		stack = [x for x in packages if x in depends]
+		while stack:
+			package = stack.pop()
+			if package in claimed:
+				continue
+			claimed[package] = group
+			stack.extend(depends[package])
+	return claimed
+
+# function that walks a system and yields the relative path and stat of every entry
+# directories are walked bottom up, so emptied directories can be removed after their contents
+def walk(root):
+	for path,dirs,names in os.walk(root,topdown=False):
+		for name in names + dirs:
+			full = os.path.join(path,name)
+			yield os.path.relpath(full,root),os.lstat(full)
+
+# function that turns rules into (rule, pattern) pairs and the patterns they must not match
+def make_patterns(names,keep_locales):
+	patterns = []
+	excludes = []
+	for name in names:
+		if name in rules:
+			patterns.extend((name,x) for x in rules[name])
+		elif "/" in name:
+			patterns.append((name,name.lstrip("/")))
+		else:
+			sys.exit("".join(("Unknown rule '",name,"', available rules: ",", ".join(rules))))
+	if "locale" in names:
+		excludes.append("usr/share/locale/locale.alias")
+		for x in keep_locales:
+			excludes.extend(("".join(("usr/share/locale/",x)),"".join(("usr/share/locale/",x,"/*"))))
+	return patterns,excludes
+
+# function that removes every entry matching the patterns, or only lists them for a dry run
+def slim(root,patterns,excludes,keep_packages,dry_run,listing=None):
+	owners = read_owners(root) if keep_packages else {}
+	seen = set()
+	removed = {}
+	kept = 0
+	for rel,stat in walk(root):
+		rule = next((name for name,x in patterns if fnmatch(rel,x)),None)
+		if rule is None or any(fnmatch(rel,x) for x in excludes):
+			continue
+		if owners.get(rel) in keep_packages:
+			kept += 1
+			continue
+		full = root / rel
+		if os.path.isdir(full) and not os.path.islink(full):
+			# only directories that are empty, or would be, are removed
+			if not dry_run:
+				try:
+					full.rmdir()
+				except OSError:
+					pass
+			continue
+		size = 0 if (stat.st_dev,stat.st_ino) in seen else stat.st_size
+		seen.add((stat.st_dev,stat.st_ino))
+		count,total = removed.get(rule,(0,0))
+		removed[rule] = (count + 1,total + size)
+		if listing:
+			listing.write("".join(("/",rel,"\t",str(size),"\n")))
+		if not dry_run:
+			full.unlink()
+
+	verb = "Would remove" if dry_run else "Removed"
+	for rule,(count,total) in removed.items():
+		print("".join((verb," ",str(count)," files matching ",rule,", ",human_size(total))))
+	if kept:
+		print("".join(("Kept ",str(kept)," matching files of kept packages")))
+	print("".join((verb," ",human_size(sum(x[1] for x in removed.values()))," in total")))
+
+# function that reads which copy_to_root source every path came from, later sources win
+def read_sources(files):
+	sources = {}
+	for f in files:
+		lines = Path(f).read_text().splitlines()
+		for line in lines[1:]:
+			sources[line.split("\t",1)[0]] = lines[0] # the path may be followed by its mode and owner
+	return sources
+
+# function that attributes the size of every file to its package, group and source
+def report(root,groups_file,source_files):
+	owners = read_owners(root)
+	sources = read_sources(source_files)
+	listed = {}
+	if groups_file:
+		for line in Path(groups_file).read_text().splitlines():
+			group,package = line.split(" ",1)
+			listed.setdefault(group,[]).append(package)
+	# a package listed by a group belongs to it, even when an earlier group depends on it
+	groups = {package: group for group,packages in reversed(listed.items()) for package in packages}
+	for package,group in group_closures(listed,read_depends(root)).items():
+		groups.setdefault(package,group)
+
+	packages = {}
+	by_group = {}
+	by_source = {}
+	seen = set()
+	total = 0
+	for rel,stat in walk(root):
+		if os.path.isdir(root / rel) and not os.path.islink(root / rel):
+			continue
+		if (stat.st_dev,stat.st_ino) in seen: # count hardlinks once
+			continue
+		seen.add((stat.st_dev,stat.st_ino))
+		size = stat.st_size
+		total += size
+		if rel in sources:
+			by_source[sources[rel]] = by_source.get(sources[rel],0) + size
+			continue
+		if rel in owners:
+			package = owners[rel]
+			packages[package] = packages.get(package,0) + size
+			group = groups.get(package,"dependencies") # installed, but no group depends on it
+		elif rel.startswith("usr/lib/modules/"):
+			group = "kernel" # the kernel is extracted without pacman
+		else:
+			group = "unowned"
+		by_group[group] = by_group.get(group,0) + size
+	return {
+		"total": total,
+		"groups": dict(sorted(by_group.items(),key=lambda x: -x[1])),
+		"sources": dict(sorted(by_source.items(),key=lambda x: -x[1])),
+		"packages": dict(sorted(packages.items(),key=lambda x: -x[1]))
+	}
+
+# function that prints a summary of a report
+def print_report(result,top):
+	print("".join(("\33[1mSystem size:\33[0m ",human_size(result["total"]))))
+	for title,key,limit in ("Package groups","groups",None),("copy_to_root sources","sources",None),("Largest packages","packages",top):
+		if not result[key]:
+			continue
+		print("".join(("\33[1m",title,":\33[0m")))
+		for name,size in list(result[key].items())[:limit]:
+			print("".join(("  ",human_size(size).rjust(10),"  ",name)))
+
+# ### MAIN ###
+def main():
+	args = parser.parse_args()
+	root = Path(args.root).expanduser().absolute()
+	if not root.is_dir():
+		sys.exit("".join(("Root '",str(root),"' is not a directory")))
+	if args.command == "slim":
+		patterns,excludes = make_patterns(args.rules,args.keep_locales)
+		if args.list:
+			with open(args.list,'w') as listing:
+				slim(root,patterns,excludes,set(args.keep_packages),args.dry_run,listing)
+		else:
+			slim(root,patterns,excludes,set(args.keep_packages),args.dry_run)
+	else:
+		result = report(root,args.groups,args.sources)
+		print_report(result,args.top)
+		if args.output:
+			with open(args.output,'w') as file:
+				json.dump(result,file,indent=2,allow_nan=False)
+
+if __name__ == "__main__":
+	main()
@@ -16,12 +16,18 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 # SOFTWARE.
 
-from argparse import ArgumentParser
+from argparse import ArgumentParser,ArgumentTypeError
+from dataclasses import dataclass
+from functools import cache
 import json
 from operator import itemgetter
 from pathlib import Path
+import os
+import re
 import subprocess
 import sys
+import threading
+import time
 
 class Placeholder:
 	pass
@@ -29,26 +35,50 @@ class Placeholder:
 class Switch:
 	pass
 
+# raised for invalid options and presets, the command line prints it and exits
+class ConfigError(Exception):
+	pass
+
 # ### ARGUMENTS ###
+# compressors of mksquashfs, the compression option may add options after them
+compressors = ("gzip","lzo","lz4","xz","zstd","lzma")
+
+# function that checks the compression option
+def compression_type(s):
+	if s != "auto" and s.split(" ",1)[0] not in compressors:
+		raise ArgumentTypeError("".join(("'",s,"' does not start with a compressor of mksquashfs (",", ".join(compressors),") and is not auto")))
+	return s
+
 ## Gather defaults
+# the defaults taken from the host are only read once a build needs them
 
 # get timezone
-etc_localtime = Path('/etc/localtime')
-if etc_localtime.is_symlink():
-	host_timezone = "/".join(etc_localtime.readlink().parts[4:])
-else:
-	host_timezone = "UTC"
+@cache
+def host_timezone():
+	etc_localtime = Path('/etc/localtime')
+	if etc_localtime.is_symlink():
+		return "/".join(etc_localtime.readlink().parts[4:])
+	return "UTC"
 
 # get hostname
-if Path('/etc/hostname').is_file():
-	with open('/etc/hostname') as file:
-		host_hostname=(file.read().strip())
-else:
-	host_hostname="recovery"
+@cache
+def host_hostname():
+	if Path('/etc/hostname').is_file():
+		with open('/etc/hostname') as file:
+			return file.read().strip()
+	return "recovery"
 
-## We might as well use a shell here since this is a wrapper for a shell script anyways
 # get keymap of parent system
-host_keymap = subprocess.run("cat /etc/vconsole.conf | grep KEYMAP= | sed 's/KEYMAP=//'",capture_output=True,shell=True).stdout.strip().decode('UTF')
+@cache
+def host_keymap():
+	try:
+		with open('/etc/vconsole.conf') as file:
+			for line in file:
+				if line.startswith("KEYMAP="):
+					return line[7:].strip()
+	except OSError:
+		pass
+	return ""
 
 parser = ArgumentParser(
 	prog='starchy.py',
@@ -79,15 +109,15 @@ parser.add_argument('-P','--no-root-passwd',
 )
 parser.add_argument('-t','--timezone',
 	type=str,
-	help="".join(("Timezone for system. (Default = ",host_timezone,")"))
+	help="Timezone for system. (Default = timezone of this system)"
 )
 parser.add_argument('-H','--hostname',
 	type=str,
-	help="".join(("Hostname of system (Default = ",host_hostname,")"))
+	help="Hostname of system (Default = hostname of this system)"
 )
 parser.add_argument('-k','--keymap',
 	type=str,
-	help="".join(("Keymap for the tty (Default = ",host_keymap,")"))
+	help="Keymap for the tty (Default = keymap of this system)"
 )
 parser.add_argument('-s','--shell',
 	type=str,
@@ -99,10 +129,24 @@ parser.add_argument('--root-shell',
 	help="Set a separate shell for the root user."
 )
 parser.add_argument('-c','--comp','--compression',
-	type=str,
-	help="What compression options to pass to mksquashfs (Default = zstd)",
+	type=compression_type,
+	help="What compression options to pass to mksquashfs. Set to auto to benchmark a sample of the system with sfsbench.py and use the best setting for --compression-goal (Default = zstd)",
 	dest="compression"
 )
+parser.add_argument('--compression-goal',
+	type=str,
+	help="What --compression auto optimises for: minimal size, fastest boot from USB or fastest copy_to_ram (Default = size)",
+	choices=("size","usb","ram")
+)
+parser.add_argument('--image-format',
+	type=str,
+	help="Filesystem of the image: squashfs (system.sfs) or erofs (system.erofs). The squashfs hook can boot both (Default = squashfs)",
+	choices=("squashfs","erofs")
+)
+parser.add_argument('--erofs-compression',
+	type=str,
+	help="What compression to pass to mkfs.erofs -z, e.g. lz4, lz4hc,12 or lzma (Default = lz4hc)"
+)
 parser.add_argument('-e','--systemd-enable',
 	nargs="*",
 	type=str,
@@ -161,6 +205,51 @@ parser.add_argument('-C','--copy-to-root','--copy-to-root',
 	metavar="SOURCES",
 	dest="copy_to_root_arr"
 )
+parser.add_argument('--hw-profile','--hardware-profiles',
+	nargs='*',
+	type=str,
+	help="Hardware profiles collected with hwprofile.sh on the target machines. Modules and firmware that none of them need are removed from the system and the initramfs.",
+	metavar="PROFILES",
+	dest="hw_profiles_arr"
+)
+parser.add_argument('--keep-modules',
+	nargs='*',
+	type=str,
+	help="Modules to keep, with their dependencies, when pruning for hardware profiles. The modules of the squashfs hook and --mkinitcpio-modules are always kept.",
+	metavar="MODULES",
+	dest="keep_modules_arr"
+)
+parser.add_argument('--slim-rules',
+	nargs='*',
+	type=str,
+	help="Rules of sfsslim.py for removing files before squashing: man, info, doc, locale, static, headers, pycache, guile_cache or a pattern relative to the root like usr/share/fonts/* (Default = locale guile_cache)",
+	metavar="RULES",
+	dest="slim_rules_arr"
+)
+parser.add_argument('--keep-locales',
+	nargs='*',
+	type=str,
+	help="Locales the locale rule keeps (Default = en en_US)",
+	metavar="LOCALES",
+	dest="keep_locales_arr"
+)
+parser.add_argument('--keep-packages',
+	nargs='*',
+	type=str,
+	help="Packages whose files the slimming rules never remove",
+	metavar="PACKAGES",
+	dest="keep_packages_arr"
+)
+parser.add_argument('--slim-dry-run',
+	action='store_const',
+	const=Switch,
+	help="Only report what the slimming rules would remove and how much that would save"
+)
+parser.add_argument('--no-hardlink',
+	action='store_const',
+	const=Switch,
+	help="Do not replace identical files under /usr with hardlinks"
+)
 parser.add_argument('-M','-I','--mkinitcpio','--initramfs',
 	action='store_const',
 	const=Switch,
@@ -220,6 +309,24 @@ parser.add_argument('--MD','--mkinitcpio-dir',
 	metavar="MKINITCPIO_DIR",
 	dest="mkinitcpio_dir"
 )
+parser.add_argument('--MV','--initramfs-variants',
+	nargs="*",
+	type=str,
+	help="Additional initramfs images to build at the same time as initramfs-NAME.img. Every variant is a name followed by comma seperated options: compression=COMPRESSION, kernel=PATH_OR_VERSION, no_passwd and no_blacklist, e.g. fallback,compression=xz",
+	metavar="VARIANT",
+	dest="initramfs_variants_arr"
+)
+parser.add_argument('--initramfs-cache',
+	type=str,
+	help="Directory in which initramfs images are cached by a hash of the kernel, configuration and hooks (Default = /var/cache/starchy/initramfs)",
+	metavar="INITRAMFS_CACHE_DIR",
+	dest="initramfs_cache_dir"
+)
+parser.add_argument('--initramfs-cache-keep',
+	type=int,
+	help="How many initramfs images to keep in the cache; least recently used images are removed first (Default = 10)",
+	metavar="COUNT"
+)
 parser.add_argument('--no-patch',
 	action='store_const',
 	const=Switch,
@@ -230,14 +337,142 @@ parser.add_argument('-X','--skip-system','--only-initramfs',
 	const=Switch,
 	help="Skip building the system and go straight to initramfs generation"
 )
+parser.add_argument('--no-cache',
+	action='store_const',
+	const=Switch,
+	help="Do not restore or store the cached package layer (the system right after pacstrap and kernel extraction) and cached initramfs images"
+)
+parser.add_argument('--rebuild-layer',
+	action='store_const',
+	const=Switch,
+	help="Ignore a matching cached package layer and replace it with a freshly installed one"
+)
+parser.add_argument('--layer-cache',
+	type=str,
+	help="Directory in which package layers are cached (Default = /var/cache/starchy/layers)",
+	metavar="LAYER_CACHE_DIR",
+	dest="layer_cache_dir"
+)
+parser.add_argument('--layer-cache-size',
+	type=str,
+	help="Maximum size of the layer cache; least recently used layers are removed first (Default = 20G)",
+	metavar="SIZE"
+)
+parser.add_argument('--package-pool',
+	type=str,
+	help="Directory of downloaded packages shared by all builds, used by pacstrap as its cache (Default = /var/cache/starchy/packages)",
+	metavar="DIR"
+)
+parser.add_argument('--pool-keep',
+	type=str,
+	help="How many versions of every package to keep in the package pool (Default = 2)",
+	metavar="N"
+)
+parser.add_argument('--parallel-downloads',
+	type=str,
+	help="How many packages pacman downloads at the same time (Default = 10)",
+	metavar="N"
+)
+parser.add_argument('--offline',
+	action='store_const',
+	const=Switch,
+	help="Only install packages from the package pool, served as a local repository. Builds without network access and with repeatable versions."
+)
+parser.add_argument('--incremental',
+	type=str,
+	help="Output directory of a previous build. Its image is reused when the system is unchanged or only gained new top-level entries, otherwise a full image is built. A manifest of the system is written next to the new image for the next incremental build.",
+	metavar="PREVIOUS_OUTPUT_DIR"
+)
+parser.add_argument('--delta-base',
+	type=str,
+	help="Output directory of an earlier build. A layer with the changes since that build is written to delta.sfs, which the patch hook stacks on the earlier image with patch_layers",
+	metavar="PREVIOUS_OUTPUT_DIR"
+)
+parser.add_argument('--chunk-index',
+	action='store_const',
+	const=Switch,
+	help="Write a chunk index next to the image, so machines can update from an older image with sfsdelta.py update and only download the chunks that changed"
+)
+parser.add_argument('--chunk-store',
+	type=str,
+	help="Directory in which the chunks of indexed images are stored, may be shared by builds (Default = system.chunks in the output directory)",
+	metavar="DIR"
+)
+parser.add_argument('--verity',
+	type=str,
+	help="Write a dm-verity hash tree of the image to <image>.verity, or append it to the image, and its root hash to <image>.roothash. The squashfs hook verifies every block when it is first read when booted with sfs_verity=<root hash> (Default = none)",
+	choices=("none","sidecar","append")
+)
+parser.add_argument('--verity-embed',
+	action='store_const',
+	const=Switch,
+	help="Build the initramfs after the image with its root hash in the squashfs hook, so the image can not be swapped for another one"
+)
+parser.add_argument('--workspace',
+	type=str,
+	help="Where to build the system: on the disk in the build directory, or in memory in a tmpfs or a zram backed ext4 when its estimated size fits in the available memory. tmpfs falls back to zram and both fall back to the disk with a warning. ./cleanup.sh releases the memory (Default = disk)",
+	choices=("disk","tmpfs","zram")
+)
+parser.add_argument('--workspace-reserve',
+	type=str,
+	help="How much memory to leave free when choosing a workspace in memory (Default = 2G)",
+	metavar="SIZE"
+)
+parser.add_argument('--workload-size',
+	type=str,
+	help="How much writable space the system needs while running. Used to plan the overlay, zram swap and copy_to_ram for the RAM of the machine it boots on, see sfsplan.py (Default = 512M)",
+	metavar="SIZE"
+)
+parser.add_argument('--boot-trace',
+	type=str,
+	help="Boot access trace recorded by booting with sfs_profile. The files in it are stored first in the image, in the order they were read, which reduces seeking on slow boot media.",
+	metavar="FILE"
+)
+parser.add_argument('-j','--jobs',
+	type=str,
+	help="How many build stages (yay, copy_to_root extraction, initramfs) may run at the same time as the main build (Default = number of CPUs)"
+)
 #parser.add_argument('-b','--path',
 #	type=str,
 #	help="Path of the build script (Default = ./starchy.sh)"
 #)
+parser.add_argument('--kernel-source',
+	type=str,
+	choices=("pacman","copy"),
+	help="Where to get the kernel from without asking, pacman or a copy of a kernel of this system"
+)
+parser.add_argument('--passwd-file',
+	type=str,
+	help="File of user:hash lines (see chpasswd -e) used instead of asking for passwords",
+	metavar="FILE"
+)
 parser.add_argument('-p','--preset',
 	default=None,
 	type=str,
-	help="TOML preset files"
+	nargs='+',
+	help="TOML preset files, every preset is built in a directory of its own inside the build directory when more than one is given"
+)
+parser.add_argument('--matrix',
+	default=None,
+	type=str,
+	help="JSON file with options shared by all builds and the options or preset file of every build, which are run at the same time",
+	metavar="FILE"
+)
+parser.add_argument('--parallel-builds',
+	default=None,
+	type=int,
+	help="How many builds of a matrix may run at the same time (Default = all)",
+	metavar="N"
+)
+parser.add_argument('--squash-slots',
+	type=str,
+	help="How many builds may compress their image at the same time (Default = 1)",
+	metavar="N"
+)
+parser.add_argument('--download-slots',
+	type=str,
+	help="How many builds may download packages at the same time (Default = 2)",
+	metavar="N"
 )
 parser.add_argument('--export',
 	type=str,
@@ -253,23 +488,62 @@ parser.add_argument('--export-settings',
 	help="Export settings as json file. (--build-dir, --output-dir, --path)"
 )
 
-args = parser.parse_args()
+# function that returns the options as they are when nothing is given on the command line
+def blank_options():
+	return vars(parser.parse_args([]))
+
+# the arguments of the parser by the name they have in a preset
+actions = {x.dest: x for x in parser._actions}
+
+# function that checks a value of a preset or of validate like the command line would
+# raises ConfigError, numbers are accepted where the command line takes a string
+def check_option(key,value):
+	action = actions.get(key)
+	if action is None or value is None:
+		return
+	if action.nargs == 0: # switches
+		if type(value) is not bool:
+			raise ConfigError("".join(('Option "',key,'" must be true or false')))
+		return
+	if action.nargs in ("*","+"):
+		if type(value) is not list:
+			raise ConfigError("".join(('Option "',key,'" must be a list')))
+		values = value
+	elif type(value) is list:
+		raise ConfigError("".join(('Option "',key,'" must be a single value, not a list')))
+	else:
+		values = [value]
+	for x in values:
+		if type(x) not in (str,int,float):
+			raise ConfigError("".join(('Option "',key,'" contains an invalid value: ',repr(x))))
+		if action.type is int:
+			try:
+				int(str(x))
+			except ValueError:
+				raise ConfigError("".join(('Option "',key,'" must be a whole number, not ',repr(x)))) from None
+		elif action.type not in (None,str):
+			try:
+				action.type(str(x))
+			except ArgumentTypeError as err:
+				raise ConfigError("".join(('Option "',key,'": ',str(err)))) from None
+		if action.choices and str(x) not in action.choices:
+			raise ConfigError("".join(('Option "',key,'" must be one of ',", ".join(action.choices),', not ',repr(x))))
 
 # ### MAIN FUNCTIONS ###
-# function for checking illegal characters
+# function for checking illegal characters, raises ConfigError
 def validate_opt(i,n):
 	if type(n) is list: # parse all options in list
 		for x in n:
 			validate_opt(i,x)
 	elif type(n) is not str:
-		sys.exit("".join(('Key "',i,'" contains illegal data type!')))
+		raise ConfigError("".join(('Key "',i,'" contains illegal data type!')))
 	elif not (set(i).isdisjoint('$()[]|;<>') and set((n)).isdisjoint('$()[]|;<>')):
-		sys.exit("".join(("Following pair contains illegal characters: ",i,'="',n,'"')))
+		raise ConfigError("".join(("Following pair contains illegal characters: ",i,'="',n,'"')))
 	return n
 
 # functions for reading json file
 def reject_constant(x):
-	sys.exit("".join(("JSON decode error: constant ",x," is not allowed!")))
+	raise ConfigError("".join(("JSON decode error: constant ",x," is not allowed!")))
 
 # function to read json file
 def json_file(f):
@@ -277,8 +551,7 @@ def json_file(f):
 		try:
 			return json.load(file,parse_constant=reject_constant)
 		except json.decoder.JSONDecodeError as err:
-			print("JSON decode error:",err)
-			sys.exit(1)
+			raise ConfigError("".join(("JSON decode error: ",str(err))))
 
 # continue prompt
 def prompt_continue(q="Continue"):
@@ -342,6 +615,9 @@ default_opts = {
 	"user_shell": "/usr/bin/bash",
 	"root_shell": None,
 	"compression": "zstd",
+	"compression_goal": "size",
+	"image_format": "squashfs",
+	"erofs_compression": "lz4hc",
 	"sd_enable_arr": [],
 	"sd_disable_arr": [],
 	"sd_mask_arr": ["hibernate.target"],
@@ -349,8 +625,15 @@ default_opts = {
 	"flags": [],
 	"install": ["base", "texteditors"],
 	"scripts_arr": [],
-	"firmware": ["linux-firmware"],
+	"firmware_arr": ["linux-firmware"],
 	"copy_to_root_arr": [],
+	"hw_profiles_arr": [],
+	"keep_modules_arr": [],
+	"slim_rules_arr": ["locale","guile_cache"],
+	"keep_locales_arr": ["en","en_US"],
+	"keep_packages_arr": [],
+	"slim_dry_run": False,
+	"no_hardlink": False,
 	"mkinitcpio": False,
 	"mkinitcpio_modules": [],
 	"mkinitcpio_binaries": [],
@@ -361,7 +644,33 @@ default_opts = {
 	"mkinitcpio_compression": "zstd",
 	"skip_system": False,
 	"mkinitcpio_dir": "./initcpio",
+	"initramfs_variants_arr": [],
+	"initramfs_cache_dir": "/var/cache/starchy/initramfs",
+	"initramfs_cache_keep": "10",
 	"no_patch": False,
+	"no_cache": False,
+	"rebuild_layer": False,
+	"layer_cache_dir": "/var/cache/starchy/layers",
+	"layer_cache_size": "20G",
+	"package_pool": "/var/cache/starchy/packages",
+	"pool_keep": "2",
+	"parallel_downloads": "10",
+	"offline": False,
+	"incremental": "",
+	"boot_trace": "",
+	"delta_base": "",
+	"chunk_index": False,
+	"chunk_store": "",
+	"workload_size": "512M",
+	"verity": "none",
+	"verity_embed": False,
+	"workspace": "disk",
+	"workspace_reserve": "2G",
+	"jobs": "",
+	"kernel_source": "",
+	"passwd_file": "",
+	"squash_slots": "1",
+	"download_slots": "2",
 
 	"build_dir": "/tmp/recovery",
 	"output_dir": "",
@@ -371,120 +680,284 @@ default_opts = {
 	"export_bash": ""
 }
 
-opts=args.__dict__ # make args accessible as dict
-
-sources=[] # list for storing options sources
-
-## preset
-if args.preset:
-	# check that preset exists
-	preset_file=Path(args.preset).expanduser().absolute()
-	if not preset_file.is_file():
-		sys.exit("".join(("Preset file '",str(preset_file),"' not found")))
-
-	# load preset
-	args.preset = Path(args.preset).expanduser().absolute()
-	if not args.preset.is_file():
-		sys.exit("".join(('Preset file "',str(args.preset),'" does not exist')))
-	preset=json_file(args.preset) # read preset file
-	sources.append(preset) # add preset as source
-sources.append(default_opts) # add default options as source
-
-# process options
-for source in sources:
-	for key,item in source.items():
-		if key in opts:
-			if opts[key] is Placeholder:
-				opts[key]=item
-			elif opts[key] is Switch:
-				opts[key]=bool(item)^bool(opts[key])
-
-# create dictionary with unexpanded paths for export-bash feature
-paths = ["build_dir","output_dir","export","export_bash","copy_to_root_arr","scripts_arr","mkinitcpio_dir"]
-unexpanded=getitems(opts,*paths)
-
-# expand paths
-for x in paths:
-	opts.update({x: expandpaths(opts[x])})
-
-# create settings dictionary and remove those values from opts
-settings_keys = ("build_dir","output_dir","preset","export","export_bash","export_settings","mkinitcpio_dir")
-settings = getitems(opts,*settings_keys)
-delkeys(opts,*settings_keys)
-
-# ### WARNING ###
-print("WARNING: This is a python wrapper that runs shell scripts on basis of USER INPUT as ROOT.")
-print("It is very easy for malicious input to cause harm to your system!")
-print("Do not enter any commands or run any scripts from people you do not trust!")
-print("Once you press enter, all user input will be displayed for inspection.")
-print("It is still a good idea to look through preset and script files.")
-print()
-print("This program is licenced under GPLv3 (C) LightDig")
-print("Go to <https://github.com/LightDig/Starchy/wiki/Running-starchy.py>")
-print()
-prompt_continue()
-
-path_checker = {1: "is_file", 2: "is_dir", 3: "exists"}
-
-# check that paths exist
-for path_list,mode in zip(getitems(opts,"scripts_arr","copy_to_root_arr").values(),(1,2)):
-	for x in path_list:
-		if not x.__getattribute__(path_checker[mode])():
-			sys.exit("".join(("Path '",str(x),"' does not exist")))
-
-# replace dashes with underscores in flags and install
-for x in "flags","install":
-	opts[x] = [x.replace('-','_') for x in opts[x]]
-
 # list of flags that may not be set using the -f or -i options
 illegal_flags = {"wdir","odir","mdir","yay","user","no_root_passwd","timezone","hostname","keymap",
-	"user_shell","root_shell","compression","sd_enable_arr","sd_disable_arr","sd_mask_arr","root"
+	"user_shell","root_shell","compression","compression_goal","image_format","erofs_compression","sd_enable_arr","sd_disable_arr","sd_mask_arr","root",
 	"extra_packages_arr","scripts_arr","firmware_arr","copy_to_root_arr","sd_enable",
 	"sd_disable","sd_mask","extra_packages","scripts","firmware","copy_to_root","warning","quit",
-	"mkinitcpio_conf","wrapper"
+	"mkinitcpio_conf","wrapper","no_cache","rebuild_layer","layer_cache_dir","layer_cache_size",
+	"layer","kernel","kernel_source","incremental","appended","boot_trace","workload_size",
+	"package_pool","pool_keep","parallel_downloads","offline","passwd_file",
+	"hw_profiles","hw_profiles_arr","keep_modules","keep_modules_arr","hook_modules","moduleroot",
+	"slim_rules","slim_rules_arr","keep_locales","keep_locales_arr","keep_packages","keep_packages_arr",
+	"slim_dry_run","no_hardlink","slim_opts","sources","source_dir",
+	"chunk_index","chunk_store","image","delta_base",
+	"lock_dir","squash_slots","download_slots","workspace","workspace_reserve",
+	"verity","verity_embed","verity_roothash",
+	"initramfs_variants","initramfs_variants_arr","initramfs_cache_dir","initramfs_cache_keep","mkinitcpio_passwd_hash",
+	"jobs","initramfs_later","stage_pid","yay_deps","span_path"
 }
 
-# ensure no illegal flags or package groups are present
-# ensure no illegal flags are present
-quit=False
-for i,n in zip(("flags","install"),("Flag","Package group name")):
-	for x in opts[i]:
-		if x in illegal_flags or x.count(" "):
-			print("".join((n,': "',x,'" is not allowed!')))
-			quit=True
-		elif x[:8] in ("install_","pkgroup_"):
-			if i == "flags":
-				print("".join(('Flag: "',x,'" is not allowed!')))
-				quit=True
-
-if quit:
-	sys.exit(1)
-
-# ### SYSTEM CONFIG PROCESSING ###
-# add prefix to all install flags
-opts.update({"install": ["".join(("install_",x)) for x in args.install]})
-
-# make sure at least one user will have a password
-if args.no_root_passwd and not args.user:
-	sys.exit("You have no unprivileged user account, yet root password is disabled!")
-
-# if root-shell is not set, make the same as shell
-if opts["root_shell"] is None:
-	opts["root_shell"] = opts["user_shell"]
-
-# if skip-system is enabled, force mkinitcpio
-if args.skip_system:
-	args.mkinitcpio = True
+path_checker = {1: "is_file", 2: "is_dir", 3: "exists"}
 
-# ### SHOW OPTIONS ###
-# print the directory in which all the work will be done
-print("".join(("\33[1mBuilding squashfs with directory:\33[0m \33[33m","".join(('"',str(settings["build_dir"]),'"\33[0m')))))
+# options that only concern the wrapper and are not passed on to the build
+wrapper_keys = ("matrix","parallel_builds")
 
-# if a preset is given, show the location of the preset
-if settings["preset"]:
-	print("".join(('\33[1mFrom preset:\33[0m \33[33m"',str(settings["preset"]),'"\33[0m')))
-print()
+# options whose default is read from the host, see host_timezone
+host_defaults = ("timezone","hostname","keymap")
 
+# function to load a preset file, returns its path and its options
+def load_preset(f):
+	preset_file=Path(f).expanduser().absolute()
+	if not preset_file.is_file():
+		raise ConfigError("".join(("Preset file '",str(preset_file),"' not found")))
+	return preset_file,json_file(preset_file)
+
+# function that lists the builds to run as (name, preset file, preset)
+# a matrix file contains options shared by all builds and the options or preset file of every build:
+# {"common": {...}, "builds": {"name": {...}, "other": "other.json"}}
+def load_builds(args):
+	builds = []
+	if args.matrix:
+		matrix_file,matrix = load_preset(args.matrix)
+		common = matrix.get("common",{})
+		for name,item in matrix.get("builds",{}).items():
+			if type(item) is str: # preset file, relative to the matrix file
+				preset_file,preset = load_preset(matrix_file.parent / item)
+			else:
+				preset_file,preset = matrix_file,item
+			builds.append((name,preset_file,{**common,**preset}))
+		if not builds:
+			raise ConfigError("".join(("Matrix file '",str(matrix_file),"' contains no builds")))
+	elif args.preset:
+		for x in args.preset:
+			preset_file,preset = load_preset(x)
+			builds.append((preset_file.stem,preset_file,preset))
+	else:
+		builds.append(("","",None))
+
+	names = [x[0] for x in builds]
+	for x in names:
+		if names.count(x) > 1:
+			raise ConfigError("".join(('Build name "',x,'" is used more than once')))
+		if not set(x).isdisjoint('/$()[]|;<> '):
+			raise ConfigError("".join(('Build name "',x,'" contains illegal characters')))
+	return builds
+
+# function that merges the command line, a preset and the default options into the options of one build
+# returns the options, the unexpanded paths and the settings of the wrapper
+def resolve_options(args,preset=None,preset_file="",build_dir=None):
+	opts = {x: y for x,y in args.items() if x not in wrapper_keys}
+	opts["preset"] = preset_file
+
+	sources=[] # list for storing options sources
+	if preset:
+		for key,item in preset.items():
+			check_option(key,item)
+		sources.append(preset) # add preset as source
+	sources.append(default_opts) # add default options as source
+
+	# process options
+	for source in sources:
+		for key,item in source.items():
+			if key in opts:
+				if opts[key] is Placeholder:
+					opts[key]=item
+				elif opts[key] is Switch:
+					opts[key]=bool(item)^bool(opts[key])
+
+	# read the defaults of the host that are still needed
+	for x in host_defaults:
+		if callable(opts[x]):
+			opts[x] = opts[x]()
+
+	# builds of a matrix each get their own directory
+	if build_dir is not None:
+		opts["build_dir"] = build_dir
+
+	# create dictionary with unexpanded paths for export-bash feature
+	paths = ["build_dir","output_dir","export","export_bash","copy_to_root_arr","scripts_arr","mkinitcpio_dir","layer_cache_dir","package_pool","incremental","boot_trace","passwd_file","hw_profiles_arr","chunk_store","delta_base","initramfs_cache_dir"]
+	unexpanded=getitems(opts,*paths)
+
+	# expand paths
+	for x in paths:
+		opts.update({x: expandpaths(opts[x])})
+
+	# create settings dictionary and remove those values from opts
+	settings_keys = ("build_dir","output_dir","preset","export","export_bash","export_settings","mkinitcpio_dir")
+	settings = getitems(opts,*settings_keys)
+	delkeys(opts,*settings_keys)
+
+	# check that paths exist
+	for path_list,mode in zip(getitems(opts,"scripts_arr","copy_to_root_arr","hw_profiles_arr").values(),(1,2,1)):
+		for x in path_list:
+			if not x.__getattribute__(path_checker[mode])():
+				raise ConfigError("".join(("Path '",str(x),"' does not exist")))
+
+	# replace dashes with underscores in flags and install
+	for x in "flags","install":
+		opts[x] = [x.replace('-','_') for x in opts[x]]
+
+	# ensure no illegal flags or package groups are present
+	errors=[]
+	for i,n in zip(("flags","install"),("Flag","Package group name")):
+		for x in opts[i]:
+			if x in illegal_flags or x.count(" "):
+				errors.append("".join((n,': "',x,'" is not allowed!')))
+			elif x[:8] in ("install_","pkgroup_"):
+				if i == "flags":
+					errors.append("".join(('Flag: "',x,'" is not allowed!')))
+
+	if errors:
+		raise ConfigError("\n".join(errors))
+
+	# ### SYSTEM CONFIG PROCESSING ###
+	# add prefix to all install flags
+	opts.update({"install": ["".join(("install_",x)) for x in opts["install"]]})
+
+	# make sure at least one user will have a password
+	if opts["no_root_passwd"] and not opts["user"]:
+		raise ConfigError("You have no unprivileged user account, yet root password is disabled!")
+
+	# if root-shell is not set, make the same as shell
+	if opts["root_shell"] is None:
+		opts["root_shell"] = opts["user_shell"]
+
+	# if skip-system is enabled, force mkinitcpio
+	if opts["skip_system"]:
+		opts["mkinitcpio"] = True
+
+	return opts,unexpanded,settings
+
+# ### API ###
+# a build with its options resolved, as passed to the build scripts
+# the properties give the resolved options typed, option() reads any other one
+@dataclass
+class BuildConfig:
+	opts: dict
+	unexpanded: dict
+	settings: dict
+	name: str = ""
+
+	# the environment variables the build scripts are run with
+	def env(self):
+		return make_env(self.opts,self.unexpanded)
+
+	# function that returns a resolved option by the name it has in a preset
+	def option(self,key):
+		if key in self.opts:
+			return self.opts[key]
+		if key in self.settings:
+			return self.settings[key]
+		raise ConfigError("".join(('Unknown option "',key,'"')))
+
+	@property
+	def build_dir(self) -> Path:
+		return self.settings["build_dir"]
+
+	# the build writes its images and reports here
+	@property
+	def output_dir(self) -> Path:
+		return self.settings["build_dir"] / "output"
+
+	@property
+	def preset(self) -> Path | None:
+		return self.settings["preset"] or None
+
+	@property
+	def image_format(self) -> str:
+		return self.opts["image_format"]
+
+	@property
+	def compression(self) -> str:
+		return self.opts["compression"]
+
+	# the package groups to install, without their install_ prefix
+	@property
+	def install(self) -> list[str]:
+		return [x.removeprefix("install_") for x in self.opts["install"]]
+
+	@property
+	def extra_packages(self) -> list[str]:
+		return list(self.opts["extra_packages_arr"])
+
+	@property
+	def firmware(self) -> list[str]:
+		return list(self.opts["firmware_arr"])
+
+	@property
+	def flags(self) -> list[str]:
+		return list(self.opts["flags"])
+
+	@property
+	def copy_to_root(self) -> list[Path]:
+		return list(self.opts["copy_to_root_arr"])
+
+	@property
+	def scripts(self) -> list[Path]:
+		return list(self.opts["scripts_arr"])
+
+	@property
+	def user(self) -> str:
+		return self.opts["user"]
+
+	@property
+	def hostname(self) -> str:
+		return self.opts["hostname"]
+
+	@property
+	def timezone(self) -> str:
+		return self.opts["timezone"]
+
+	@property
+	def keymap(self) -> str:
+		return self.opts["keymap"]
+
+	@property
+	def mkinitcpio(self) -> bool:
+		return bool(self.opts["mkinitcpio"])
+
+	@property
+	def mkinitcpio_hooks(self) -> list[str]:
+		return list(self.opts["mkinitcpio_hooks"])
+
+	@property
+	def offline(self) -> bool:
+		return bool(self.opts["offline"])
+
+	@property
+	def verity(self) -> str:
+		return self.opts["verity"]
+
+	@property
+	def workspace(self) -> str:
+		return self.opts["workspace"]
+
+# function that resolves a preset and options into a build without asking anything
+# options are given by the name they have in a preset, like build_dir or mkinitcpio_hooks,
+# and override the preset. Raises ConfigError for invalid options
+def validate(preset=None,preset_file="",name="",**options):
+	args = blank_options()
+	for key,x in options.items():
+		if key not in args or key in wrapper_keys:
+			raise ConfigError("".join(('Unknown option "',key,'"')))
+		check_option(key,x)
+		args[key] = x
+	return BuildConfig(*resolve_options(args,preset,preset_file),name=name)
+
+# ### WARNING ###
+def show_warning():
+	print("WARNING: This is a python wrapper that runs shell scripts on basis of USER INPUT as ROOT.")
+	print("It is very easy for malicious input to cause harm to your system!")
+	print("Do not enter any commands or run any scripts from people you do not trust!")
+	print("Once you press enter, all user input will be displayed for inspection.")
+	print("It is still a good idea to look through preset and script files.")
+	print()
+	print("This program is licenced under GPLv3 (C) LightDig")
+	print("Go to <https://github.com/LightDig/Starchy/wiki/Running-starchy.py>")
+	print()
+
+# ### SHOW OPTIONS ###
 # function to display each item properly in the confirmation prompt
 def display_item(i):
 	if i == "":
@@ -500,22 +973,20 @@ def display_item(i):
 	else:
 		return "".join(('"',str(i),'"'))
 
-# Show all options
-for i,x in opts.items():
-	print("".join(('\33[1m',i.capitalize().replace('_',' ').replace(' arr',''),':\33[0m ',display_item(x))))
-print()
-
-# add export message if export provided
-for i in settings["export"],settings["export_bash"]:
-	if i:
-		print("".join(('The above options will be exported to: "',str(i),'"')))
+# function to display the options of a build
+def show_options(opts,settings):
+	# print the directory in which all the work will be done
+	print("".join(("\33[1mBuilding squashfs with directory:\33[0m \33[33m","".join(('"',str(settings["build_dir"]),'"\33[0m')))))
 
-if settings["export_settings"]:
-	print("Build directory and export path will be exported to settings.json")
+	# if a preset is given, show the location of the preset
+	if settings["preset"]:
+		print("".join(('\33[1mFrom preset:\33[0m \33[33m"',str(settings["preset"]),'"\33[0m')))
+	print()
 
-if any((settings["export"],settings["export_bash"],settings["export_settings"])):
-	print("Execution will stop after the exports complete")
-prompt_continue()
+	# Show all options
+	for i,x in opts.items():
+		print("".join(('\33[1m',i.capitalize().replace('_',' ').replace(' arr',''),':\33[0m ',display_item(x))))
+	print()
 
 # ### EXPORT OPTIONS ###
 ## export functions
@@ -528,28 +999,43 @@ def parse_bash_object(i,x):
 	else:
 		return "".join(('"',str(x),'"'))
 
-if settings["export_settings"]:
-	settings_path=Path("settings.json").absolute()
-	prompt_overwrite(settings_path)
-	with open(settings_path,'w') as file:
-		json.dump(getitems(unexpanded,"build_dir","output_dir"),file,indent=2,allow_nan=False)
+# function to display where options will be exported to
+def show_exports(settings):
+	# add export message if export provided
+	for i in settings["export"],settings["export_bash"]:
+		if i:
+			print("".join(('The above options will be exported to: "',str(i),'"')))
+
+	if settings["export_settings"]:
+		print("Build directory and export path will be exported to settings.json")
+
+	if any((settings["export"],settings["export_bash"],settings["export_settings"])):
+		print("Execution will stop after the exports complete")
+
+# function that writes the options of a build as a preset
+def export_json(config,path):
+	json_export = config.opts.copy()
+	cpvalues(config.unexpanded,json_export,*[x for x in config.unexpanded if x in json_export]) # paths as they were given
+	json_export.update({"install": [x[8:] for x in config.opts["install"]]}) # strip install_ prefixes from pkgroups
+	with open(path,'w') as file: # write json file
+		json.dump(json_export,file,indent=2,allow_nan=False)
 
-if settings["export_bash"]:
-	prompt_overwrite(settings["export_bash"])
-	bash_export = opts.copy() # make a copy of the options
-	bash_export.update(unexpanded) # replace full paths with unexpanded paths
+# function that writes a bash script which runs starchy.sh with the options of a build
+def export_bash(config,path):
+	bash_export = config.opts.copy() # make a copy of the options
+	bash_export.update(config.unexpanded) # replace full paths with unexpanded paths
 	reassignkeys(bash_export,("build_dir","output_dir","mkinitcpio_dir"),("wdir","odir","mdir"))
 	delkeys(bash_export,"flags","install") # remove flags and pkgroups so they can be added seperately
 	delkeys(bash_export,"mkinitcpio","skip_system") # these should be determined by specifying system and initramfs as arguments
-	with open(settings["export_bash"],'w') as file: # start writing file
+	with open(path,'w') as file: # start writing file
 		file.write("#!/usr/bin/env bash\n") # write shebang
 		file.write("# this is a generated wrapper script for starchy.sh\n") # header comment
 		for i,x in bash_export.items(): # write all options as variable declarations
 			file.write("".join((i,'=',parse_bash_object(i,x),'\n')))
 		for category in "flags","install": # add flags and package groups seperately
-			if opts[category]: # if flags or install is provided at all
+			if config.opts[category]: # if flags or install is provided at all
 				file.write("".join(('\n# ',category,'\n'))) # write comment
-				for x in opts[category]: # write all flags as <value>=true
+				for x in config.opts[category]: # write all flags as <value>=true
 					file.write("".join((x,"=true\n")))
 		file.write("""
 # Run script
@@ -592,18 +1078,30 @@ elif [[ $mkinitcpio = true ]]; then
 	fi
 fi
 """)
-		settings["export_bash"].chmod(0o755)
-
-if settings["export"]:
-	prompt_overwrite(settings["export"])
-	json_export = opts.copy()
-	cpvalues(unexpanded,json_export,"scripts_arr","copy_to_root_arr")
-	json_export.update({"install": [x[8:] for x in opts["install"]]}) # strip install_ prefixes from pkgroups
-	with open(settings["export"],'w') as file: # write json file
-		json.dump(json_export,file,indent=2,allow_nan=False)
+	Path(path).chmod(0o755)
 
-if any((settings["export"],settings["export_bash"],settings["export_settings"])):
-	sys.exit()
+# function that writes the build directory and output directory of a build to settings.json
+def export_settings(config,path):
+	with open(path,'w') as file:
+		json.dump(getitems(config.unexpanded,"build_dir","output_dir"),file,indent=2,allow_nan=False)
+
+# function to export the options of a build after asking before overwriting, returns whether anything was exported
+def export_options(config):
+	settings = config.settings
+	if settings["export_settings"]:
+		settings_path=Path("settings.json").absolute()
+		prompt_overwrite(settings_path)
+		export_settings(config,settings_path)
+
+	if settings["export_bash"]:
+		prompt_overwrite(settings["export_bash"])
+		export_bash(config,settings["export_bash"])
+
+	if settings["export"]:
+		prompt_overwrite(settings["export"])
+		export_json(config,settings["export"])
+
+	return any((settings["export"],settings["export_bash"],settings["export_settings"]))
 
 # ### RUN PROGRAM ###
 # function that turns an array into a string seperated by 0x1b.
@@ -619,35 +1117,294 @@ def envify(x):
 	else:
 		return str(x)
 
-# create dictionary for environment variables
-env = {}
-
-# add flags and pkgroups
-for category in "flags","install":
-	for x in opts[category]:
-		env.update({x: "true"})
-
-# delete original lists
-delkeys(opts,"flags","install")
-
-# add unexpanded paths to environment variables
-env.update(unexpanded)
-
-# reassign keys to their script names
-reassignkeys(env,("build_dir","output_dir","mkinitcpio_dir"),("wdir","odir","mdir"))
-
-# tell the script that they are being run from a wrapper
-env.update({"wrapper":"true"})
-
-# turn values into environment variable strings
-for i,x in opts.items():
-	if i not in env:
-		env.update({i:envify(x)})
-	elif type(x) is list:
-		env[i] = envify(env[i])
+# function that turns the options of a build into environment variables for the scripts
+def make_env(opts,unexpanded):
+	opts = opts.copy()
+	env = {}
+
+	# add flags and pkgroups
+	for category in "flags","install":
+		for x in opts[category]:
+			env.update({x: "true"})
+
+	# delete original lists
+	delkeys(opts,"flags","install")
+
+	# add unexpanded paths to environment variables
+	env.update(unexpanded)
+
+	# reassign keys to their script names
+	reassignkeys(env,("build_dir","output_dir","mkinitcpio_dir"),("wdir","odir","mdir"))
+
+	# tell the script that they are being run from a wrapper
+	env.update({"wrapper":"true"})
+
+	# turn values into environment variable strings
+	for i,x in opts.items():
+		if i not in env:
+			env.update({i:envify(x)})
+		elif type(x) is list:
+			env[i] = envify(env[i])
+	return env
+
+# ### BUILD TRACE ###
+# function that returns the summed resident memory of a process and all of its descendants in KiB
+def tree_rss(pid):
+	children = {}
+	for stat in Path("/proc").glob("[0-9]*/stat"):
+		try:
+			ppid = int(stat.read_text().rsplit(")",1)[1].split()[1])
+		except (OSError,IndexError,ValueError):
+			continue
+		children.setdefault(ppid,[]).append(int(stat.parent.name))
+
+	rss = 0
+	todo = [pid]
+	while todo:
+		x = todo.pop()
+		todo.extend(children.get(x,()))
+		try:
+			rss += int(Path("".join(("/proc/",str(x),"/statm"))).read_text().split()[1])
+		except (OSError,IndexError,ValueError):
+			pass
+	return rss * os.sysconf("SC_PAGE_SIZE") // 1024
+
+# function that samples the memory of a running build until it exits
+def sample_rss(process,samples,interval=0.5):
+	while process.poll() is None:
+		samples.append((time.time(),tree_rss(process.pid)))
+		time.sleep(interval)
+
+# function that turns the events written by the shell scripts into spans
+def read_spans(events_file,samples):
+	ticks = os.sysconf("SC_CLK_TCK")
+	fields = ("time","cpu","rchar","wchar","read_bytes","write_bytes")
+	spans = []
+	open_spans = {}
+	with open(events_file) as file:
+		for line in file:
+			kind,path,pid,*values = line.rstrip("\n").split("\t")
+			values = dict(zip(fields,(float(x or 0) for x in values)))
+			if kind == "begin":
+				open_spans[(pid,path)] = values
+				continue
+			begin = open_spans.pop((pid,path),None)
+			if begin is None:
+				continue
+			spans.append({
+				"name": path.split(";")[-1],
+				"path": path,
+				"pid": int(pid),
+				"start": begin["time"],
+				"end": values["time"],
+				"wall": values["time"] - begin["time"],
+				"cpu": (values["cpu"] - begin["cpu"]) / ticks,
+				"peak_rss_kib": max((rss for t,rss in samples if begin["time"] <= t <= values["time"]),default=0),
+				"rchar": int(values["rchar"] - begin["rchar"]),
+				"wchar": int(values["wchar"] - begin["wchar"]),
+				"read_bytes": int(values["read_bytes"] - begin["read_bytes"]),
+				"write_bytes": int(values["write_bytes"] - begin["write_bytes"])
+			})
+	# spans that never ended belong to a failed build
+	for (pid,path),begin in open_spans.items():
+		spans.append({"name": path.split(";")[-1], "path": path, "pid": int(pid), "start": begin["time"], "end": None, "incomplete": True})
+	spans.sort(key=lambda x: x["start"])
+	return spans
+
+# function for formatting a number of bytes
+def human_size(n):
+	for unit in ("B","KiB","MiB","GiB"):
+		if abs(n) < 1024:
+			break
+		n /= 1024
+	return "".join((str(round(n,1)),unit))
+
+# print each span as a bar relative to the whole build, indented by nesting
+def print_trace(trace):
+	print()
+	print("\33[1mBuild trace:\33[0m")
+	width = 40
+	for span in trace["spans"]:
+		if span.get("incomplete"):
+			print("".join(("  "*span["path"].count(";"),span["name"]," \33[31mincomplete\33[0m")))
+			continue
+		offset = int((span["start"] - trace["start"]) / trace["wall"] * width) if trace["wall"] else 0
+		length = max(1,int(span["wall"] / trace["wall"] * width)) if trace["wall"] else 1
+		bar = "".join((" "*offset,"#"*length)).ljust(width)
+		print("".join((
+			"[",bar[:width],"] ",
+			"  "*span["path"].count(";"),span["name"],
+			" \33[33m",str(round(span["wall"],1)),"s\33[0m",
+			" cpu ",str(round(span["cpu"],1)),"s",
+			" rss ",human_size(span["peak_rss_kib"]*1024),
+			" read ",human_size(span["read_bytes"]),
+			" written ",human_size(span["write_bytes"])
+		)))
+
+# function that prints the output of a build prefixed with its name
+def prefix_output(process,name):
+	for line in process.stdout:
+		sys.stdout.write("".join(("[",name,"] ",line.decode(errors="replace"))))
+		sys.stdout.flush()
+
+# run a build script while recording its memory, then write and summarise the trace
+# builds of a matrix are given a name, they run without a terminal and their output is prefixed
+def run_traced(script,env,build_dir,name=None):
+	odir = build_dir / "output"
+	samples = []
+	start = time.time()
+	if name is None:
+		process = subprocess.Popen(("bash",script),env=env)
+	else:
+		process = subprocess.Popen(("bash",script),env=env,stdin=subprocess.DEVNULL,stdout=subprocess.PIPE,stderr=subprocess.STDOUT)
+		printer = threading.Thread(target=prefix_output,args=(process,name),daemon=True)
+		printer.start()
+	sampler = threading.Thread(target=sample_rss,args=(process,samples),daemon=True)
+	sampler.start()
+	process.wait()
+	sampler.join()
+	if name is not None:
+		printer.join()
+
+	events_file = odir / "build-trace.events"
+	if not events_file.is_file():
+		return process.returncode
+
+	trace = {
+		"script": str(script),
+		"returncode": process.returncode,
+		"start": start,
+		"wall": time.time() - start,
+		"peak_rss_kib": max((rss for t,rss in samples),default=0),
+		"spans": read_spans(events_file,samples)
+	}
+	with open(odir / "build-trace.json",'w') as file:
+		json.dump(trace,file,indent=2,allow_nan=False)
+	if name is None:
+		print_trace(trace)
+	print("".join(("[",name,"] " if name else "",'Trace written to "',str(odir / "build-trace.json"),'"')))
+	return process.returncode
+
+# function that returns the script a build runs
+def build_script(opts):
+	if opts["skip_system"]:
+		return Path("mkinitcpio.sh").absolute()
+	return Path("starchy.sh").absolute()
+
+# function that runs a build and returns the exit code of its script
+# named builds run without a terminal and do not ask for confirmation
+def build(config):
+	env = config.env()
+	if config.name:
+		env.update({"warning":"false"})
+	return run_traced(build_script(config.opts),env,config.settings["build_dir"],config.name or None)
+
+# ### MATRIX ###
+# function that runs one build of a matrix and records how it went
+def run_build(config,semaphore,results):
+	name = config.name
+	with semaphore:
+		start = time.time()
+		returncode = build(config)
+	odir = config.output_dir
+	try:
+		with open(odir / "build-trace.json") as file:
+			wall = json.load(file)["wall"]
+	except (OSError,KeyError,ValueError):
+		wall = time.time() - start
+	artifacts = {}
+	for x in "system.sfs","system.erofs","initramfs.img":
+		if (odir / x).is_file():
+			artifacts[x] = (odir / x).stat().st_size
+	results[name] = {"returncode": returncode, "wall": wall, "output_dir": str(odir), "artifacts": artifacts}
+
+# function that prints the combined summary of a matrix and writes it next to the builds
+def matrix_summary(results,base_dir):
+	print()
+	print("\33[1mMatrix summary:\33[0m")
+	for name,result in results.items():
+		status = "\33[32mok\33[0m" if result["returncode"] == 0 else "".join(("\33[31mfailed (",str(result["returncode"]),")\33[0m"))
+		artifacts = ", ".join(["".join((x," ",human_size(y))) for x,y in result["artifacts"].items()])
+		print("".join((name,": ",status," \33[33m",str(round(result["wall"],1)),"s\33[0m ",artifacts)))
+	with open(base_dir / "matrix-summary.json",'w') as file:
+		json.dump(results,file,indent=2,allow_nan=False)
+	print("".join(('Summary written to "',str(base_dir / "matrix-summary.json"),'"')))
+
+# ### RUN ###
+# function that runs the command line
+def run(args):
+	builds = load_builds(args)
+	args = vars(args)
+
+	if len(builds) == 1 and not args["matrix"]:
+		name,preset_file,preset = builds[0]
+		config = BuildConfig(*resolve_options(args,preset,preset_file))
+		show_options(config.opts,config.settings)
+		show_exports(config.settings)
+		prompt_continue()
+		if export_options(config):
+			return 0
+		return build(config)
+
+	# every build of a matrix gets a directory of its own inside the build directory
+	if args["build_dir"] is not Placeholder:
+		base_dir = args["build_dir"]
+	elif args["matrix"]:
+		base_dir = json_file(Path(args["matrix"]).expanduser()).get("common",{}).get("build_dir",default_opts["build_dir"])
+	else:
+		base_dir = default_opts["build_dir"]
+	base_dir = expandpaths(base_dir)
+
+	resolved = []
+	for name,preset_file,preset in builds:
+		config = BuildConfig(*resolve_options(args,preset,preset_file,str(Path(base_dir,name))),name=name)
+		if any((config.settings["export"],config.settings["export_bash"],config.settings["export_settings"])):
+			raise ConfigError("Options can not be exported from a matrix, export the builds one at a time")
+		if config.settings["output_dir"]:
+			raise ConfigError("Builds of a matrix can not share an output directory, their images are placed in <build dir>/<name>/output")
+		# builds of a matrix run without a terminal, so nothing may be asked for
+		if not config.opts["passwd_file"]:
+			raise ConfigError("".join(('Build "',config.name,'" needs a password file (--passwd-file), builds of a matrix can not ask for passwords')))
+		# --MP without a hash is given as None
+		if config.opts["mkinitcpio_passwd"] != "" and not re.fullmatch("[0-9a-f]{128}",str(config.opts["mkinitcpio_passwd"])):
+			raise ConfigError("".join(('Build "',config.name,'" needs the sha512sum of its boot password (--MP), builds of a matrix can not ask for it')))
+		resolved.append(config)
+
+	# show the first build in full and only what differs for the others
+	first = resolved[0]
+	print("".join(("\33[1mBuild ",first.name,"\33[0m")))
+	show_options(first.opts,first.settings)
+	for config in resolved[1:]:
+		print("".join(("\33[1mBuild ",config.name,"\33[0m")))
+		show_options({i: x for i,x in config.opts.items() if first.opts.get(i) != x},config.settings)
+	print("".join(("Running ",str(len(resolved))," builds, ",str(args["parallel_builds"] or len(resolved))," at a time")))
+	prompt_continue()
+
+	base_dir.mkdir(parents=True,exist_ok=True)
+	semaphore = threading.Semaphore(args["parallel_builds"] or len(resolved))
+	results = {}
+	threads = []
+	for config in resolved:
+		# the matrix was confirmed once for all builds
+		thread = threading.Thread(target=run_build,args=(config,semaphore,results))
+		thread.start()
+		threads.append(thread)
+	for thread in threads:
+		thread.join()
+
+	results = {x.name: results[x.name] for x in resolved} # keep the order of the matrix
+	matrix_summary(results,base_dir)
+	return max(int(x["returncode"] != 0) for x in results.values())
+
+# ### MAIN ###
+def main():
+	args = parser.parse_args()
+	show_warning()
+	prompt_continue()
+	try:
+		sys.exit(run(args))
+	except ConfigError as err:
+		sys.exit(str(err))
 
-# run script
-if settings["skip_system"]:
-	subprocess.run(("bash",Path("mkinitcpio.sh").absolute()),env=env)
-else:
-	subprocess.run(("bash",Path("starchy.sh").absolute()),env=env)
+if __name__ == "__main__":
+	main()
@@ -23,7 +23,7 @@
 # USE THIS SCRIPT AT YOUR OWN RISK
 # RUN AS ROOT
 # ALWAYS RUN WITH BASH OR RISK BREAKING YOUR SYSTEM
-# PRODUCES IMAGE AT ${odir}/system.sfs
+# PRODUCES IMAGE AT ${odir}/system.sfs (OR system.erofs)
 # READ THROUGH SCRIPT AND/OR DOCUMENTATION BEFORE RUNNING
 
 # it is recommended to use a wrapper, such as the provided python
@@ -51,12 +51,714 @@ register_package_group() {
 	eval "pkgroup_$name=(${*:2})"
 }
 
+# layer cache
+# the root filesystem as it is right after installing packages and the kernel
+# is stored as a tarball, named after a hash of the resolved package set. The
+# packages are resolved with freshly synced databases, so a layer is rebuilt as
+# soon as the repositories or the pool have newer versions of any of them
+layer_key() {
+	local dbpath="$wdir/layer-key" packages
+	mkdir -p "$dbpath/local"
+	pacman --config "$wdir/pacman.conf" --dbpath "$dbpath" -Sy &> /dev/null || { rm -rf "$dbpath"; return 1; }
+	packages=$(LC_ALL=C pacman --config "$wdir/pacman.conf" --dbpath "$dbpath" -Sp --noconfirm --print-format '%n %v' "${pacstrap[@]}" 2> /dev/null)
+	rm -rf "$dbpath"
+	[[ $packages ]] || return 1
+	{
+		sort -u <<< "$packages"
+		echo "kernel=$kernel_source:$kernel"
+	} | sha256sum | cut -d ' ' -f 1
+}
+
+restore_layer() {
+	touch "$1" # mark layer as recently used
+	tar -C "$root" --xattrs --acls -I 'zstd -d -T0' -xpf "$1"
+}
+
+store_layer() {
+	mkdir -p "$layer_cache_dir"
+	# write to a temporary file first so an interrupted build never leaves a broken layer
+	tar -C "$root" --xattrs --acls -I 'zstd -T0' -cpf "$1.part" . && mv "$1.part" "$1" || rm -f "$1.part"
+	evict_layers "$1"
+}
+
+# remove least recently used layers until the cache fits in $layer_cache_size
+# the layer passed as an argument is never removed
+evict_layers() {
+	local max total x
+	max=$(to_kib "$layer_cache_size")
+	total=$(du -sk "$layer_cache_dir" | cut -f 1)
+	for x in $(ls -tr "$layer_cache_dir"/*.tar.zst); do
+		[[ $total -le $max ]] && break
+		[[ $x = "$1" ]] && continue
+		echo "Evicting cached layer $(basename "$x")"
+		total=$((total - $(du -k "$x" | cut -f 1)))
+		rm -f "$x"
+	done
+	[[ $total -gt $max ]] && warn "layer cache exceeds $layer_cache_size"
+}
+
+# package pool
+# packages of every build are downloaded into one shared directory, which pacman
+# uses as its cache through a generated pacman.conf. With $offline set to true
+# the repositories are replaced by a local repository of the pool, so a build
+# installs exactly the versions in the pool without network access
+prepare_pool() {
+	mkdir -p "$package_pool"
+	if [[ $offline = true ]]; then
+		ls "$package_pool"/*.pkg.tar.zst &> /dev/null || err "package pool '$package_pool' is empty, can't build offline"
+		with_lock pool index_pool
+	fi
+	awk -v pool="$package_pool" -v jobs="$parallel_downloads" -v offline="$offline" '
+		/^[[:space:]]*(CacheDir|ParallelDownloads)[[:space:]]*=/ {next}
+		/^\[/ {section = $0}
+		offline == "true" && /^\[/ && section != "[options]" {skip = 1}
+		offline == "true" && section == "[options]" {skip = 0}
+		skip {next}
+		{print}
+		$0 == "[options]" {print "CacheDir = " pool "/"; print "ParallelDownloads = " jobs}
+		END {if (offline == "true") print "\n[starchy-pool]\nSigLevel = Optional TrustAll\nServer = file://" pool}
+	' /etc/pacman.conf > "$wdir/pacman.conf"
+	ls "$package_pool" > "$wdir/pool.before"
+}
+
+# index the newest version of every package in the pool as the repository starchy-pool
+# the database is built aside and moved into place, other builds may be reading it
+index_pool() {
+	local -A newest versions
+	local file base name version tmp
+	echo "Indexing package pool..."
+	for file in "$package_pool"/*.pkg.tar.zst; do
+		base=$(basename "$file" .pkg.tar.zst)
+		base=${base%-*} # strip the architecture
+		name=${base%-*-*}
+		version=${base#"$name"-}
+		if [[ -z ${versions[$name]} ]] || (($(vercmp "$version" "${versions[$name]}") > 0)); then
+			versions[$name]=$version
+			newest[$name]=$file
+		fi
+	done
+	tmp=$(mktemp -d "$package_pool/.index.XXXXXX")
+	repo-add -q -p "$tmp/starchy-pool.db.tar.zst" "${newest[@]}" || { rm -rf "$tmp"; err "failed to index package pool"; }
+	mv -f "$tmp"/starchy-pool.* "$package_pool"/ || err "failed to move the package pool index into place"
+	rmdir "$tmp"
+}
+
+# print how many packages of the system were already in the pool
+pool_report() {
+	local hits=0 misses=0 bytes=0 name version file
+	while read -r name version; do
+		for file in "$package_pool/$name-$version"-*.pkg.tar.zst; do
+			[[ -f $file ]] || continue
+			if grep -qxF "$(basename "$file")" "$wdir/pool.before"; then
+				((hits+=1))
+			else
+				((misses+=1))
+				bytes=$((bytes + $(stat -c %s "$file")))
+			fi
+			break
+		done
+	done < <(pacman -r "$root" -Q)
+	echo "Package pool: $hits hits, $misses downloaded ($((bytes / 1048576)) MiB)"
+}
+
+# keep the last $pool_keep versions of every package in the pool
+prune_pool() {
+	if command -v paccache &> /dev/null; then
+		paccache -q -r -k "$pool_keep" -c "$package_pool"
+	else
+		warn "paccache not found, install pacman-contrib to prune the package pool"
+	fi
+}
+
+# copy_to_root
+# every source is prepared while the packages are installed: tarballs are
+# extracted with a multi-threaded decompressor where there is one, and every
+# source is listed with the mode and owner its files get in the system.
+# Sources are applied in order afterwards, so later sources win
+
+# usage: decompressor <tarball>
+# prints nothing when tar should pick the decompressor itself
+decompressor() {
+	case $(od -An -t x1 -N 6 "$1" | tr -d ' \n') in
+		28b52ffd*) echo "zstd -d -T0" ;;
+		fd377a585a00) echo "xz -d -T0" ;;
+		1f8b*) command -v pigz > /dev/null && echo "pigz -d" ;;
+		425a68*) command -v lbzip2 > /dev/null && echo "lbzip2 -d" ;;
+	esac
+}
+
+# usage: tarball_size <tarball>
+# print the size of a tarball in KiB. xz records it in its index, other formats
+# are listed with the same decompressor the extraction uses
+tarball_size() {
+	local d
+	d=$(decompressor "$1")
+	if [[ $d = xz* ]]; then
+		xz --robot -l "$1" | awk '$1 == "totals" {printf "%d\n", $5 / 1024}'
+	else
+		tar ${d:+-I "$d"} -tvf "$1" | awk '{s += $3} END {printf "%d\n", s / 1024}'
+	fi
+}
+
+# usage: prepare_source <number> <source>
+prepare_source() {
+	local dir=$2 owner=0:0 d
+	if [[ -f $2 ]]; then
+		dir="$wdir/ingest/$1"
+		owner=%U:%G # tarballs keep their owners, directories are copied as root
+		mkdir -p "$dir"
+		d=$(decompressor "$2")
+		tar -C "$dir" ${d:+-I "$d"} -xf "$2" || return 1
+	fi
+	# the first line names the source, then <path> <mode> <owner> for every file
+	{
+		echo "$2"
+		(cd "$dir" && find . ! -type d -printf "%P\t%#m\t$owner\n")
+	} > "$wdir/sources/$(printf %04d "$1")"
+}
+
+# usage: apply_source <number> <source>
+# extracted tarballs are hard linked into the system when they are on the same
+# filesystem. Directories are copied, with reflinks where the filesystem supports
+# them, so changes to the system never reach the source
+apply_source() {
+	if [[ -f $2 ]]; then
+		if [[ $(stat -c %d "$wdir/ingest/$1") = "$(stat -c %d "$root")" ]]; then
+			cp -al --remove-destination "$wdir/ingest/$1"/. "$root/" || return 1
+		else
+			cp -a --reflink=auto --remove-destination "$wdir/ingest/$1"/. "$root/" || return 1
+		fi
+		rm -rf "$wdir/ingest/$1"
+	else
+		cp -a --no-preserve=ownership --reflink=auto --remove-destination "$2"/. "$root/"
+	fi
+}
+
+# workspace
+# the system can be built in memory instead of on the disk under $wdir, which
+# saves pacstrap and mksquashfs a lot of small-file I/O. The space it needs is
+# estimated from the installed size of the resolved packages, the kernel and
+# the copy_to_root sources, with a quarter and 256MiB extra for what the build adds
+estimate_system_size() {
+	local kib=0 pkgs=("${pacstrap[@]}") x
+	# resolve the packages against an empty local database, as the host already has most of them
+	mkdir -p "$wdir/estimate/local"
+	if [[ $offline = true ]]; then
+		pacman --config "$wdir/pacman.conf" --dbpath "$wdir/estimate" -Sy &> /dev/null
+	else
+		ln -s /var/lib/pacman/sync "$wdir/estimate/sync"
+	fi
+	if [[ $kernel_source -eq 1 ]]; then
+		pkgs+=(linux)
+	else
+		kib=$(du -sk "/usr/lib/modules/$kernel" | cut -f 1)
+	fi
+	mapfile -t pkgs < <(LC_ALL=C pacman --config "$wdir/pacman.conf" --dbpath "$wdir/estimate" -Sp --noconfirm --print-format '%r/%n' "${pkgs[@]}" 2> /dev/null)
+	[[ ${#pkgs[@]} -gt 0 ]] || { rm -rf "$wdir/estimate"; return 1; }
+	kib=$((kib + $(LC_ALL=C pacman --config "$wdir/pacman.conf" --dbpath "$wdir/estimate" -Si "${pkgs[@]}" | awk '
+		/^Installed Size/ {
+			split($0, a, ": *")
+			split(a[2], b, " ")
+			s += b[1] * (b[2] == "B" ? 1 / 1024 : b[2] == "KiB" ? 1 : b[2] == "MiB" ? 1024 : 1048576)
+		}
+		END {printf "%d\n", s}
+	')))
+	rm -rf "$wdir/estimate"
+	for x in "${copy_to_root[@]}"; do
+		if [[ -f $x ]]; then
+			kib=$((kib + $(tarball_size "$x")))
+		else
+			kib=$((kib + $(du -sk "$x" | cut -f 1)))
+		fi
+	done
+	echo $((kib * 5 / 4 + 262144))
+}
+
+# usage: mount_workspace <tmpfs|zram> <size in KiB>
+mount_workspace() {
+	local dev
+	if [[ $1 = tmpfs ]]; then
+		mount -t tmpfs -o "size=${2}k,mode=755" starchy-system "$root"
+	else
+		# a compressed ext4 in memory, discard returns the memory of removed files
+		modprobe zram || return 1
+		dev=$(zramctl --find --size "${2}K" --algorithm zstd) || return 1
+		echo "$dev" > "$wdir/workspace.zram" # for cleanup.sh
+		mkfs.ext4 -q -m 0 -O ^has_journal "$dev" && mount -o discard "$dev" "$root"
+	fi
+}
+
+# place $root in memory when there is enough of it, tmpfs falls back to zram
+# and both fall back to the disk
+setup_workspace() {
+	local need avail reserve mode
+	need=$(estimate_system_size) || { warn "could not estimate the size of the system, building on disk"; return; }
+	avail=$(awk '/^MemAvailable:/ {print $2}' /proc/meminfo)
+	reserve=$(to_kib "$workspace_reserve")
+	echo "Estimated size of the system: $((need / 1024)) MiB, available memory: $((avail / 1024)) MiB"
+	for mode in tmpfs zram disk; do
+		[[ $workspace = zram ]] && [[ $mode = tmpfs ]] && continue
+		case $mode in
+			tmpfs) [[ $((need + reserve)) -le $avail ]] || continue ;;
+			zram) [[ $((need * 2 / 5 + reserve)) -le $avail ]] || continue ;; # zstd compresses a system to about 40%
+			disk)
+				warn "not enough memory for a $workspace workspace, building on disk"
+				[[ $(df -k --output=avail "$wdir" | tail -n 1) -lt $need ]] && warn "$wdir may not have enough space either"
+				return
+			;;
+		esac
+		[[ $mode = "$workspace" ]] || warn "not enough memory for a $workspace workspace, using $mode"
+		if mount_workspace "$mode" "$need"; then
+			echo "Building the system in a $((need / 1024)) MiB $mode workspace"
+			return
+		fi
+		warn "failed to set up a $mode workspace"
+	done
+}
+
+# manifests
+# write a manifest of every path in a directory, one line per path:
+# path, type, mode, owner, size, mtime and a sha256 or symlink target
+write_manifest() {
+	(
+		cd "$1" || exit 1
+		# hash regular files in parallel
+		find . -xdev -type f -print0 | xargs -0 -r -P "$(nproc)" -n 256 sha256sum \
+			| sed -E 's/^([0-9a-f]+)  \.\//\1\t/' > "$2.hashes"
+		find . -xdev -mindepth 1 -printf '%P\t%y\t%m\t%U:%G\t%s\t%T@\t%l\n' \
+			| awk -F '\t' -v OFS='\t' 'NR==FNR {hash[$2]=$1; next}
+				$2 == "d" {$5=0} # directory sizes depend on the filesystem
+				$2 == "f" {$7=hash[$1]}
+				{print}' "$2.hashes" - | LC_ALL=C sort > "$2"
+		rm "$2.hashes"
+	)
+}
+
+# compare two manifests, ignoring modification times
+# prints the path and size of every entry prefixed with + (added), - (removed) or ~ (changed)
+diff_manifests() {
+	awk -F '\t' -v OFS='\t' 'NR==FNR {old[$1]=$2 FS $3 FS $4 FS $5 FS $7; size[$1]=$5; next}
+		{
+			if (!($1 in old)) print "+", $1, $5
+			else if (old[$1] != $2 FS $3 FS $4 FS $5 FS $7) print "~", $1, $5
+			delete old[$1]
+		}
+		END {for (x in old) print "-", x, size[x]}' "$1" "$2"
+}
+
+# delta layers
+# usage: delta_hidden <path>
+# whether a path is below a whiteout or a file in the delta layer, like the
+# contents of a removed directory or of a directory that was replaced by a file
+delta_hidden() {
+	local dir=$1
+	while [[ $dir = */* ]]; do
+		dir=${dir%/*}
+		if [[ -e $wdir/delta/$dir ]] || [[ -L $wdir/delta/$dir ]]; then
+			[[ ! -d $wdir/delta/$dir ]] || [[ -L $wdir/delta/$dir ]]
+			return
+		fi
+	done
+	return 1
+}
+
+# usage: delta_parents <path>
+# create the parent directories of a path in the delta layer with the
+# permissions and owner they have in the system
+delta_parents() {
+	local dir=${1%/*}
+	[[ $dir = "$1" ]] || [[ -d $wdir/delta/$dir ]] && return
+	delta_parents "$dir"
+	mkdir "$wdir/delta/$dir"
+	chmod --reference="$root/$dir" "$wdir/delta/$dir"
+	chown --reference="$root/$dir" "$wdir/delta/$dir"
+}
+
+# build a layer with everything that changed since the build in $delta_base,
+# using overlayfs whiteouts (0/0 character devices) for removed paths.
+# stacked on the image of that build with patch_layers it gives this system
+build_delta_layer() {
+	local base="$delta_base/system.manifest" manifest="$odir/system.manifest" delta="$wdir/delta"
+	local image kind path size n_changed=0 n_removed=0
+	# the manifest of the base is written by incremental and delta builds,
+	# otherwise it is made from the base image
+	if [[ ! -f $base ]]; then
+		image="$delta_base/system.sfs"
+		[[ -f $image ]] || image="$delta_base/system.erofs"
+		[[ -f $image ]] || err "no image in delta base '$delta_base'"
+		mkdir -p "$wdir/delta_base"
+		mount -o ro "$image" "$wdir/delta_base" || err "failed to mount '$image'"
+		write_manifest "$wdir/delta_base" "$wdir/base.manifest"
+		umount "$wdir/delta_base"
+		base="$wdir/base.manifest"
+	fi
+	[[ -f $manifest ]] || write_manifest "$root" "$manifest"
+
+	rm -rf "$delta"
+	mkdir "$delta"
+	# sorted by path, so a removed or replaced directory comes before its contents
+	while IFS=$'\t' read -r kind path size; do
+		# a whiteout or a file hides everything that was below it
+		delta_hidden "$path" && continue
+		case $kind in
+			-)
+				delta_parents "$path"
+				mknod "$delta/$path" c 0 0 || err "failed to write the whiteout of '$path'"
+				((n_removed+=1))
+			;;
+			*)
+				delta_parents "$path"
+				if [[ -d $root/$path ]] && [[ ! -L $root/$path ]]; then
+					mkdir -p "$delta/$path" || err "failed to add '$path' to the delta layer"
+					chmod --reference="$root/$path" "$delta/$path"
+					chown --reference="$root/$path" "$delta/$path"
+				else
+					cp -a "$root/$path" "$delta/$path" || err "failed to add '$path' to the delta layer"
+				fi
+				((n_changed+=1))
+			;;
+		esac
+	done < <(diff_manifests "$base" "$manifest" | LC_ALL=C sort -t $'\t' -k 2,2)
+
+	if [[ $image_format = erofs ]]; then
+		mkfs.erofs -z"$erofs_compression" -Ededupe,ztailpacking "$odir/delta.erofs" "$delta"
+		image="$odir/delta.erofs"
+	else
+		mksquashfs "$delta"/ "$odir/delta.sfs" -comp $compression -noappend
+		image="$odir/delta.sfs"
+	fi
+	echo "Delta layer: $n_changed added or changed and $n_removed removed paths, $(($(stat -c %s "$image") / 1048576)) MiB"
+	rm -rf "$delta"
+}
+
+# usage: make_sort_file <trace> <sort file>
+# turn a boot access trace (one path per line, in the order the files were
+# read) into a priority list for mksquashfs -sort, so files read early are
+# stored first and in order. Paths missing from the system are skipped.
+# priorities stay above the 0 of untraced files, so at most 32767 files are placed
+make_sort_file() {
+	local path n=0
+	while IFS= read -r path; do
+		[[ $path = /* ]] && [[ $path != *[[:space:]]* ]] || continue
+		[[ -f $root$path ]] && [[ ! -L $root$path ]] || continue
+		echo "$root$path $((32767 - n))"
+		((n+=1))
+		[[ $n -ge 32767 ]] && break
+	done < <(awk '!seen[$0]++' "$1") > "$2"
+	echo "$n"
+}
+
+# usage: estimate_seeks <sort file>
+# print how often reading the traced files in order jumps to a file that is not
+# stored directly after the previous one, without and with the sort file.
+# mksquashfs stores files in directory order, which sorting the paths approximates.
+# with the sort file, files are stored by falling priority and in directory
+# order among equal priorities, which is the order of the sort file, then the rest
+estimate_seeks() {
+	local x
+	find "$root" -type f | LC_ALL=C sort > "$wdir/layout"
+	sed -E 's/ -?[0-9]+$//' "$1" > "$wdir/layout.sorted"
+	awk 'NR == FNR {sorted[$0] = 1} NR != FNR && !($0 in sorted)' "$wdir/layout.sorted" "$wdir/layout" >> "$wdir/layout.sorted"
+	for x in "$wdir/layout" "$wdir/layout.sorted"; do
+		awk 'NR == FNR {pos[$0] = NR; next}
+			{sub(/ -?[0-9]+$/, ""); if (pos[$0] != prev + 1) seeks++; prev = pos[$0]}
+			END {print seeks + 0}' "$x" "$1"
+	done | paste -sd ' '
+	rm -f "$wdir/layout" "$wdir/layout.sorted"
+}
+
+# hardware profiles
+# a profile is collected on a target machine with hwprofile.sh and lists the
+# loaded modules ("module <name>") and the modaliases of its devices ("alias <modalias>")
+
+# usage: profile_modules <profile>...
+# print the modules that the devices and loaded modules of the profiles need
+profile_modules() {
+	local kind value
+	cat "$@" | while read -r kind value; do
+		case $kind in
+			module) echo "$value" ;;
+			alias) modprobe -d "$root" -S "$kernel" -R "$value" 2> /dev/null ;;
+		esac
+	done
+}
+
+# usage: module_closure <module>...
+# print the files of the modules and of everything they depend on,
+# relative to the module directory of the kernel. Builtin modules have no file
+module_closure() {
+	local x
+	for x in "$@"; do
+		modprobe -d "$root" -S "$kernel" -D "$x" 2> /dev/null || warn "module $x not found"
+	done | awk '$1 == "insmod" {print $2}' | sed "s|.*/$kernel/||" | sort -u
+}
+
+# remove the modules and firmware that no hardware profile needs
+# the modules of the squashfs hook, $mkinitcpio_modules and $keep_modules are always kept
+prune_hardware() {
+	local moddir="$root/usr/lib/modules/$kernel" fwdir="$root/usr/lib/firmware"
+	local keep=() initcpio_modules=() before after x f n_mod=0 n_fw=0
+	local -A kept fw_kept
+	before=$(du -sb "$moddir" "$fwdir" 2> /dev/null | awk '{n += $1} END {print n + 0}')
+
+	# mkinitcpio fails on modules that are missing, the default is the one of mkinitcpio.sh
+	IFS=$' \e' read -ra initcpio_modules <<< "${mkinitcpio_modules:-vfat}"
+	mapfile -t keep < <(module_closure $(profile_modules "${hw_profiles[@]}") "${hook_modules[@]}" "${initcpio_modules[@]}" "${keep_modules[@]}")
+	[[ ${#keep[@]} -eq 0 ]] && err "the hardware profiles do not match any module of kernel $kernel"
+	for x in "${keep[@]}"; do
+		kept[$x]=1
+	done
+
+	# firmware requested by the kept modules, names may contain wildcards
+	while IFS= read -r x; do
+		for f in "$fwdir"/$x "$fwdir"/$x.zst "$fwdir"/$x.xz; do
+			[[ -e $f ]] || continue
+			fw_kept[${f#"$fwdir"/}]=1
+			[[ -L $f ]] && fw_kept[$(realpath --relative-to="$fwdir" "$f")]=1
+		done
+	done < <(for x in "${keep[@]}"; do modinfo -F firmware "$moddir/$x"; done | sort -u)
+
+	while IFS= read -r -d '' x; do
+		[[ ${kept[$x]} ]] && continue
+		rm "$moddir/$x"
+		((n_mod+=1))
+	done < <(cd "$moddir" && find . -name '*.ko*' -printf '%P\0')
+	find "$moddir" -mindepth 1 -type d -empty -delete
+	depmod -b "$root" "$kernel"
+
+	if [[ -d $fwdir ]]; then
+		while IFS= read -r -d '' x; do
+			[[ ${fw_kept[$x]} ]] && continue
+			rm "$fwdir/$x"
+			((n_fw+=1))
+		done < <(cd "$fwdir" && find . \( -type f -o -type l \) -printf '%P\0')
+		find "$fwdir" -mindepth 1 -type d -empty -delete
+	fi
+
+	after=$(du -sb "$moddir" "$fwdir" 2> /dev/null | awk '{n += $1} END {print n + 0}')
+	echo "Kept ${#keep[@]} modules for ${#hw_profiles[@]} hardware profiles"
+	echo "Pruned $n_mod modules and $n_fw firmware files, saving $(((before - after) / 1048576)) MiB"
+}
+
+# build an EROFS image of the system
+# identical compressed extents are stored once and small file tails are
+# packed into the inode, which keeps random reads to a single block
+build_erofs() {
+	[[ $compression = auto ]] && warn "compression benchmark only supports squashfs, ignoring"
+	[[ $boot_trace ]] && warn "boot ordering only supports squashfs, ignoring boot_trace"
+	[[ $incremental ]] && warn "incremental builds only support squashfs, building full image"
+	mkfs.erofs -z"$erofs_compression" -Ededupe,ztailpacking "$odir/system.erofs" "$root"
+}
+
+# squash the system, reusing the image in $incremental where possible
+# mksquashfs can only reuse compressed data by appending to an image and it
+# only merges entries at the root of the image, so an image is reused when the
+# tree is unchanged or only gained new top-level entries
+squash_system() {
+	local image="$odir/system.sfs" manifest="$odir/system.manifest" options="$odir/system.options" total changed mode=full
+	local ignored
+	local sort_opts=() traced before after
+	if [[ $compression = auto ]]; then
+		echo "Benchmarking compression settings for goal '$compression_goal'..."
+		compression=$(python3 ./sfsbench.py "$root" --goal "$compression_goal" --tmp "$wdir" \
+			--output "$odir/compression-benchmark.json" --select) || err "compression benchmark failed"
+		echo "Using compression: $compression"
+	fi
+
+	if [[ $boot_trace ]]; then
+		[[ -f $boot_trace ]] || err "boot trace '$boot_trace' does not exist"
+		traced=$(make_sort_file "$boot_trace" "$wdir/boot.sort")
+		if [[ $traced -gt 0 ]]; then
+			read -r before after < <(estimate_seeks "$wdir/boot.sort")
+			echo "Placing $traced files from the boot trace first"
+			echo "Estimated seeks while booting: $before without ordering, $after with ordering"
+			sort_opts=(-sort "$wdir/boot.sort")
+		else
+			warn "no file of the boot trace exists in the system, not reordering the image"
+		fi
+	fi
+
+	if [[ ! $incremental ]]; then
+		mksquashfs "$root"/ "$image" -comp $compression "${sort_opts[@]}"
+		return
+	fi
+
+	echo "Writing manifest of system..."
+	write_manifest "$root" "$manifest"
+	total=$(awk -F '\t' '$2 == "f" {s+=$5} END {print s+0}' "$manifest")
+	changed=$total
+	# the options the image is built with, the sort file without the build directory
+	{
+		echo "comp $compression"
+		[[ ${#sort_opts[@]} -gt 0 ]] && echo "sort $(awk -v n=${#root} '{print substr($0, n + 1)}' "$wdir/boot.sort" | sha256sum | cut -d' ' -f1)"
+		mksquashfs -version | head -n 1
+	} > "$options"
+
+	if [[ -f $incremental/system.sfs ]] && [[ -f $incremental/system.manifest ]] && ! cmp -s "$incremental/system.options" "$options"; then
+		echo "Previous image was built with other options, building full image"
+	elif [[ -f $incremental/system.sfs ]] && [[ -f $incremental/system.manifest ]]; then
+		# the update timestamps of systemd and the build id of sfsplan.py change every
+		# build, keep those of the previous image. The rest of the plan is compared
+		ignored='etc/.updated|var/.updated'
+		if diff -q <(unsquashfs -cat "$incremental/system.sfs" etc/starchy/image.conf | grep -v '^build_id=') \
+			<(grep -v '^build_id=' "$root/etc/starchy/image.conf") > /dev/null; then
+			ignored="etc/starchy/image.conf|$ignored"
+		fi
+		diff_manifests "$incremental/system.manifest" "$manifest" | grep -Ev $'\t('"$ignored"$')\t' > "$wdir/manifest.diff"
+		if [[ ! -s $wdir/manifest.diff ]]; then
+			mode=reuse
+		elif ! grep -q '^[~-]' "$wdir/manifest.diff" \
+			&& awk -F '\t' '$2 !~ "/" {top[$2]=1} {split($2, p, "/"); if (!(p[1] in top)) exit 1}' "$wdir/manifest.diff"; then
+			mode=append
+		fi
+	else
+		warn "no previous image and manifest in '$incremental', building full image"
+	fi
+
+	case $mode in
+		reuse)
+			echo "System is unchanged, reusing previous image"
+			cp --reflink=auto "$incremental/system.sfs" "$image"
+			changed=0
+		;;
+		append)
+			echo "Appending new entries to previous image"
+			cp --reflink=auto "$incremental/system.sfs" "$image"
+			mapfile -t appended < <(awk -F '\t' -v root="$root" '$2 !~ "/" {print root "/" $2}' "$wdir/manifest.diff")
+			mksquashfs "${appended[@]}" "$image" -keep-as-directory
+			changed=$(awk -F '\t' '{s+=$3} END {print s+0}' "$wdir/manifest.diff")
+		;;
+		*)
+			[[ -s $wdir/manifest.diff ]] && echo "Files were changed or removed, building full image"
+			mksquashfs "$root"/ "$image" -comp $compression "${sort_opts[@]}"
+		;;
+	esac
+	# a reused image keeps the plan of the previous build
+	[[ $mode = full ]] || unsquashfs -cat "$image" etc/starchy/image.conf > "$odir/system.plan"
+
+	echo "Recompressed $changed bytes, reused $((total - changed)) of $total bytes"
+}
+
+# usage: image_bytes <image>
+# size of an image according to its superblock, like the squashfs hook reads it
+image_bytes() {
+	if [[ $image_format = erofs ]]; then
+		# block count << block size bits
+		echo $(($(od -An -t u4 -j 1060 -N 4 "$1") << $(od -An -t u1 -j 1036 -N 1 "$1")))
+	else
+		od -An -t u8 -j 40 -N 8 "$1" | tr -d ' '
+	fi
+}
+
+# usage: build_verity <image>
+# write the dm-verity hash tree of an image to <image>.verity, or append it after
+# the last 4KiB block of the image, and its root hash to <image>.roothash.
+# the squashfs hook finds the hash tree in either place and verifies every
+# block of the image when it is first read
+build_verity() {
+	local image=$1 offset
+	offset=$((($(image_bytes "$image") + 4095) / 4096 * 4096))
+	rm -f "$image.verity" "$image.roothash"
+	if [[ $verity = append ]]; then
+		# an incremental build copies the hash tree along with the previous image
+		truncate -s "$offset" "$image"
+		veritysetup format "$image" "$image" --data-blocks=$((offset / 4096)) --hash-offset="$offset" \
+			--root-hash-file="$image.roothash" || return 1
+	else
+		veritysetup format "$image" "$image.verity" --root-hash-file="$image.roothash" || return 1
+	fi
+	echo "Root hash of the image: $(cat "$image.roothash")"
+}
+
+# runtime caches
+# the image is read-only, so every cache the running system generates ends up
+# in the overlay, costing boot time and memory on every boot. They are
+# generated at build time instead
+
+# usage: in_root <command> [argument]...
+# run a command of the system inside it, if the system has that command
+in_root() {
+	[[ -x $root/usr/bin/$1 ]] || return 0
+	chroot "$root" "$@" || warn "'$*' failed in the system"
+}
+
+# usage: precompute_caches
+precompute_caches() {
+	local x
+	in_root ldconfig
+	in_root systemd-hwdb --usr update # /etc/udev/hwdb.bin is a trigger of systemd-hwdb-update.service
+	in_root journalctl --update-catalog
+	in_root fc-cache -s
+	in_root update-mime-database /usr/share/mime
+	[[ -d $root/usr/share/glib-2.0/schemas ]] && in_root glib-compile-schemas /usr/share/glib-2.0/schemas
+	[[ -d $root/usr/lib/gio/modules ]] && in_root gio-querymodules /usr/lib/gio/modules
+	in_root gdk-pixbuf-query-loaders --update-cache
+	in_root gtk-query-immodules-3.0 --update-cache
+	in_root update-desktop-database -q
+	for x in "$root"/usr/share/icons/*/index.theme; do
+		[[ -f $x ]] && in_root gtk-update-icon-cache -q -t -f "${x%/index.theme}"
+	done
+	in_root mandb -q
+}
+
+# usage: mark_updated
+# systemd runs ldconfig, the hwdb and the journal catalog update on boot when
+# /usr is newer than /etc/.updated or /var/.updated (ConditionNeedsUpdate=),
+# which is every boot of an image without them. The images store whole
+# seconds, so the time of /usr is rounded down first
+mark_updated() {
+	local t x
+	t=$(stat -c %Y "$root/usr")
+	touch -d "@$t" "$root/usr"
+	for x in etc var; do
+		cat <<EOF > "$root/$x/.updated"
+# This file was created by starchy.sh. Its only purpose is to hold a
+# timestamp of the time this directory was updated.
+# See man:systemd-update-done.service(8).
+TIMESTAMP_NSEC=${t}000000000
+EOF
+		touch -d "@$t" "$root/$x/.updated"
+	done
+}
+
+# usage: check_first_boot
+# warn about units that would still have work to do on every boot
+check_first_boot() {
+	local unit dir x cache n=0
+	for unit in "$root"/usr/lib/systemd/system/*.service; do
+		dir=$(sed -n 's/^ConditionNeedsUpdate=|\?//p' "$unit" | head -n 1)
+		[[ $dir = /* ]] || continue # not set or negated
+		((n+=1))
+		[[ "$root/usr" -nt "$root$dir/.updated" ]] && warn "$(basename "$unit") will run on every boot"
+	done
+	# <command> <cache it writes>
+	while read -r x cache; do
+		[[ -x $root/usr/bin/$x ]] && [[ ! -e $root/$cache ]] && warn "$x did not write /$cache"
+	done <<EOF
+ldconfig etc/ld.so.cache
+systemd-hwdb usr/lib/udev/hwdb.bin
+journalctl var/lib/systemd/catalog/database
+fc-cache var/cache/fontconfig
+update-mime-database usr/share/mime/mime.cache
+mandb var/cache/man/index.db
+EOF
+	if [[ ! -s $root/etc/machine-id ]] || [[ $(< "$root/etc/machine-id") = uninitialized ]]; then
+		warn "/etc/machine-id is not set, units with ConditionFirstBoot= run on every boot"
+	fi
+	echo "Checked $n units that update caches on boot"
+}
+
 # ### CONTINUE CHECKS ###
 
 # set a warning for running this script
 
 # check dependencies
-check_dependencies arch-install-scripts squashfs-tools
+if [[ $image_format = erofs ]]; then
+	check_dependencies arch-install-scripts erofs-utils
+else
+	check_dependencies arch-install-scripts squashfs-tools
+fi
+[[ $verity = sidecar ]] || [[ $verity = append ]] && check_dependencies cryptsetup
 
 if ! opt_dependency mkinitcpio; then
 	warn "command 'mkinitcpio' not present on system. Initramfs generation will be skipped!"
@@ -86,7 +788,97 @@ default root_shell /usr/bin/bash
 
 ## compression options
 # available algorithms: gzip, lzo, lz4, xz, zstd
+# auto benchmarks a sample of the system with sfsbench.py and picks the best
+# setting for compression_goal: size, usb (fastest boot from USB) or ram (fastest copy_to_ram)
 default compression zstd
+default compression_goal size
+
+## image format
+# squashfs or erofs. The squashfs hook detects the format of the image when booting
+# erofs_compression is passed to mkfs.erofs -z, e.g. lz4, lz4hc,12 or lzma
+default image_format squashfs
+default erofs_compression lz4hc
+
+## package pool options
+# every build shares one directory of downloaded packages
+# set offline to true to only install packages that are already in the pool
+# pool_keep is how many versions of every package are kept
+default package_pool /var/cache/starchy/packages
+default pool_keep 2
+default parallel_downloads 10
+
+## workspace
+# set workspace to tmpfs or zram to build the system in memory when the
+# estimated size plus workspace_reserve fits in the available memory.
+# tmpfs falls back to zram, and both fall back to the disk under $wdir
+default workspace disk
+default workspace_reserve 2G
+
+## non-interactive options
+# set kernel_source to pacman or copy to skip the kernel prompt
+# set passwd_file to a file of user:hash lines (see chpasswd -e) to skip the password prompts
+# default kernel_source pacman
+# default passwd_file /path/to/passwords
+
+## layer cache options
+# set no_cache to true to neither restore nor store package layers
+# set rebuild_layer to true to ignore a cached layer and replace it
+default layer_cache_dir /var/cache/starchy/layers
+default layer_cache_size 20G
+
+## incremental builds
+# set incremental to the output directory of a previous build to reuse its
+# image where possible. A manifest is written next to the new image.
+# default incremental /tmp/recovery-previous/output
+
+## memory planning
+# how much writable space the system needs while running, used to plan the
+# overlay, zram swap and copy_to_ram for the RAM of the machine it boots on
+default workload_size 512M
+
+## boot ordering
+# set boot_trace to a trace recorded by booting with sfs_profile to store the
+# files read while booting first and in order, reducing seeks on slow media
+# default boot_trace /path/to/boot-access.trace
+
+## hardware profiles
+# set hw_profiles to profiles collected with hwprofile.sh on the target machines
+# to remove every module and firmware file they do not need from the image and
+# the initramfs. keep_modules and mkinitcpio_modules are kept as well, together
+# with their dependencies
+# default_arr hw_profiles /path/to/machine.profile
+# default_arr keep_modules usb-storage uas
+hook_modules=(squashfs erofs overlay loop zram dm-crypt dm-mod dm-clone dm-verity brd vfat ext4)
+
+## integrity
+# set verity to sidecar or append to write a dm-verity hash tree of the image,
+# either to <image>.verity or after the image itself, and the root hash to
+# <image>.roothash. Boot with sfs_verity=<root hash>, or set verity_embed to
+# true to build the initramfs after the image with the root hash in it
+default verity none
+default verity_embed false
+
+## delta layers
+# set delta_base to the output directory of an earlier build to also build
+# delta.sfs, a layer with the changes since that build for patch_layers
+# default delta_base /tmp/recovery-previous/output
+
+## delta updates
+# set chunk_index to true to write <image>.index and store the chunks of the
+# image in chunk_store, which can be shared by builds and served over http
+# default chunk_index true
+# default chunk_store /srv/starchy/chunks
+
+## slimming
+# rules of sfsslim.py that remove files before squashing: man, info, doc,
+# locale, static, headers, pycache and guile_cache, or patterns relative to the
+# root such as usr/share/fonts/*. Files of keep_packages are never removed.
+# set slim_dry_run to true to only report what would be removed and
+# no_hardlink to true to not link identical files under /usr
+default_arr slim_rules locale guile_cache
+default_arr keep_locales en en_US
+# default_arr keep_packages python
+default slim_dry_run false
 
 # Whether to build initramfs
 # uncomment to enable by default
@@ -95,9 +887,10 @@ default compression zstd
 ## ARRAYS
 # process arrays from python wrapper
 AD=$(echo -e "\e")
-arrays=(sd_enable sd_disable sd_mask extra_packages scripts firmware copy_to_root)
+arrays=(sd_enable sd_disable sd_mask extra_packages scripts firmware copy_to_root hw_profiles keep_modules slim_rules keep_locales keep_packages)
 for x in "${arrays[@]}"; do
 	DA="$x"_arr
+	[[ -v $DA ]] || continue # keep the defaults when not run from the wrapper
 	IFS=$AD read -ra "${x?}" <<< "${!DA}"
 done
 
@@ -125,15 +918,20 @@ if [[ $yay ]] && [[ ! $(compgen -u) =~ ^"$yay"$ ]]; then
 fi
 
 # build yay if user is set for building
+# it only depends on the host, so it is built while the system is being installed
 if [[ $yay ]]; then
 	mkdir -m 770 "$wdir/yay"
 	chown "$yay":root "$wdir/yay"
-	sudo -u "$yay" bash -c "cd $wdir/yay && git clone https://aur.archlinux.org/yay && cd yay && makepkg -s"
+	sudo -u "$yay" git -C "$wdir/yay" clone https://aur.archlinux.org/yay
+	# install the build dependencies up front, as stages are not able to prompt
+	yay_deps=($(cd "$wdir/yay/yay" && sudo -u "$yay" makepkg --printsrcinfo | awk '/^\t(make)?depends = / {print $3}'))
+	[[ ${yay_deps[*]} ]] && pacman -S --needed --asdeps "${yay_deps[@]}"
+	stage yay sudo -u "$yay" bash -c "cd $wdir/yay/yay && makepkg"
 fi
 
 # ### START BUILDING ###
 
-pre_run
+span pre_run pre_run
 
 ## package groups for the installation
 # you are encouraged to modify these lists to your needs
@@ -146,6 +944,8 @@ default install_texteditors true # install by default, unless explicitly disable
 pkgroup_texteditors=(vim nano)
 
 default_arr pkgroup_recovery arch-install-scripts efibootmgr squashfs-tools btrfs-progs e2fsprogs dosfstools exfatprogs ntfs-3g grub mokutil sbsigntools mkinitcpio
+# the tools to inspect and rebuild an erofs image when the system is one
+[[ $image_format = erofs ]] && pkgroup_recovery+=(erofs-utils)
 
 # network packages
 default_arr pkgroup_network networkmanager dhcpcd
@@ -157,107 +957,216 @@ default_arr pkgroup_media ristretto vlc vlc-plugin-ffmpeg
 default_arr pkgroup_yay base-devel
 
 # create package array
+# the groups of the packages are listed for the size report
 for i in "${package_groups[@]}"; do
 	name=install_$i
-	[[ ${!name} ]] && eval "pacstrap+=(\${pkgroup_$i[@]})"
-done
+	[[ ${!name} ]] || continue
+	eval "pacstrap+=(\${pkgroup_$i[@]})"
+	eval "printf '$i %s\n' \${pkgroup_$i[@]}"
+done > "$wdir/package-groups"
 
 pacstrap+=("${firmware[@]}")
+printf 'firmware %s\n' "${firmware[@]}" >> "$wdir/package-groups"
 
-# install system packages
-pacstrap "$root" "${pacstrap[@]}" # install packages
+# ### PACKAGE POOL ###
+span pool prepare_pool
 
-# fetch kernel
-# this will do an "improper" installation and extract the kernel from the package
-# as updating the linux kernel package is not possible in a read-only system
+# ### KERNEL SELECTION ###
+# the kernel is chosen before installing any packages, since
+# its version is part of the key of the cached package layer
 
 # Ask if kernel should be copied or downloaded
 echo "Would you like to copy your kernel modules over or pull the latest kernel from pacman?"
-echo "Fetching with pacman will put the kernel in your local system's cache."
-echo "You will be given the option to remove it if you wish."
+echo "Fetching with pacman will put the kernel in the package pool."
 echo "1) Pacman (recommended)"
 echo "2) Copy"
 echo "Default = 1"
 echo
-while true; do # ask until valid input
-	read -rp '> ' prompt
-	[[ $prompt =~ [12] ]] && break
-	[[ -z $prompt ]] && prompt=1 && break
-done
-
-if [[ $prompt -eq 1 ]]; then # if kernel should be downloaded
+case $kernel_source in
+	pacman) kernel_source=1 ;;
+	copy) kernel_source=2 ;;
+	*)
+		while true; do # ask until valid input
+			read -rp '> ' prompt
+			[[ $prompt =~ [12] ]] && break
+			[[ -z $prompt ]] && prompt=1 && break
+		done
+		kernel_source=$prompt
+	;;
+esac
+
+if [[ $kernel_source -eq 1 ]] && [[ $offline = true ]]; then # if kernel should be taken from the pool
+	kernel=$(ls "$package_pool" | sed -nE 's/^linux-([0-9][^-]*-[0-9]+)-x86_64\.pkg\.tar\.zst$/\1/p' | sort -V | tail -n 1)
+	[[ $kernel ]] || err "no kernel package in package pool"
+elif [[ $kernel_source -eq 1 ]]; then # if kernel should be downloaded
 	kernel=$(pacman -Ss ^linux$ --noconfirm | grep -Eo '([0-9.-]|arch)+') # fetch latest kernel name
-	pacman -Sddw linux # download kernel package to cache
-	# install kernel on child system
-	# extract the kernel into the root filesystem
-	(cd "$root" && tar -xf /var/cache/pacman/pkg/linux-"$kernel"*.pkg.tar.zst usr/lib/modules)
-	read -rp "Remove kernel from cache? [y/N]> " prompt
-	[[ ${prompt:0:1} =~ y|Y ]] && rm /var/cache/pacman/pkg/linux-"$kernel"*.pkg.tar.zst*
 else # if kernel should be copied
 	kernels=(/usr/lib/modules/*)
-	if [[ ${#kernels} -gt 1 ]]; then
+	kernels=("${kernels[@]##*/}") # only keep the kernel versions
+	if [[ ${#kernels[@]} -gt 1 ]] && [[ ! -t 0 ]]; then
+		# without a terminal, prefer the running kernel, otherwise the newest
+		if [[ -d /usr/lib/modules/$(uname -r) ]]; then
+			kernel=$(uname -r)
+		else
+			kernel=$(printf '%s\n' "${kernels[@]}" | sort -V | tail -n 1)
+		fi
+	elif [[ ${#kernels[@]} -gt 1 ]]; then
 		echo "Multiple kernels found!"
 		echo "Which one would you like to copy over?"
 		echo
 		i=1
 		for x in "${kernels[@]}"; do
-			echo "$i) $(basename "$x")"
+			echo "$i) $x"
 			((i+=1))
 		done
 		while true; do
-			read -rp '> ' prompt
-			if [[ $prompt =~ [0-9]+ ]]; then
+			read -rp '> ' prompt || err "no kernel selected"
+			if [[ $prompt =~ ^[0-9]+$ ]]; then
 				((prompt-=1))
-				[[ $prompt -lt ${#kernels} ]] && kernel="${kernels[$prompt]}" && break
+				[[ $prompt -ge 0 ]] && [[ $prompt -lt ${#kernels[@]} ]] && kernel="${kernels[$prompt]}" && break
 			fi
-		cp -r "/usr/lib/modules/$kernel" "$root/usr/lib/modules/"
 		done
 	else
 		kernel="${kernels[0]}" # store kernel for later
-		cp -r "/usr/lib/modules/$kernel" "$root/usr/lib/modules/"
 	fi
-	kernel_folders=(/usr/lib/modules/$kernel/*/)
-	echo "Additional folders have been copied over."
-	echo "These are likely not necessary. Would you like to remove them?"
-	echo
-	for x in "${kernel_folders[@]}"; do
-		[[ $x != kernel ]] && echo "${x/$root/}" # print path of folders within the system to be removed
-	done
-	echo
-	read -rp "[Y/n] > " prompt # prompt to remove the unnecessary folders
-	[[ ! $prompt =~ n|N ]] && (cd "$root/usr/lib/modules/$kernel" && rm -rf !(kernel)/)
+fi
+
+# ### WORKSPACE ###
+[[ $workspace = disk ]] || span workspace setup_workspace
+
+# prepare copy_to_root sources while the packages are being installed
+n=0
+rm -rf "$wdir/sources"
+mkdir -p "$wdir/sources"
+for i in "${copy_to_root[@]}"; do
+	stage "copy_to_root_$n" prepare_source "$n" "$i"
+	((n+=1))
+done
+
+# ### PACKAGE LAYER ###
+
+layer="$layer_cache_dir/$(layer_key).tar.zst" || err "failed to resolve the packages of the system"
+
+# builds of the same package set wait for each other, so the layer is only built once
+install_layer() {
+	if [[ ! $no_cache = true ]] && [[ ! $rebuild_layer = true ]] && [[ -f $layer ]]; then
+		echo "Restoring cached package layer $(basename "$layer")..."
+		span restore_layer restore_layer "$layer"
+	else
+		# install system packages
+		span pacstrap with_slot download "$download_slots" pacstrap -C "$wdir/pacman.conf" -c "$root" "${pacstrap[@]}" # install packages
+
+		# fetch kernel
+		# this will do an "improper" installation and extract the kernel from the package
+		# as updating the linux kernel package is not possible in a read-only system
+		span_begin kernel
+		if [[ $kernel_source -eq 1 ]]; then # if kernel should be downloaded
+			# download kernel package to the pool
+			[[ $offline = true ]] || with_slot download "$download_slots" pacman --config "$wdir/pacman.conf" -Sddw --noconfirm linux
+			# install kernel on child system
+			# extract the kernel into the root filesystem
+			(cd "$root" && tar -xf "$package_pool/linux-$kernel"-*.pkg.tar.zst usr/lib/modules)
+		else # if kernel should be copied
+			mkdir -p "$root/usr/lib/modules"
+			cp -r "/usr/lib/modules/$kernel" "$root/usr/lib/modules/"
+			kernel_folders=("$root/usr/lib/modules/$kernel"/*/)
+			echo "Additional folders have been copied over."
+			echo "These are likely not necessary. Would you like to remove them?"
+			echo
+			for x in "${kernel_folders[@]}"; do
+				[[ $(basename "$x") != kernel ]] && echo "${x/$root/}" # print path of folders within the system to be removed
+			done
+			echo
+			read -rp "[Y/n] > " prompt # prompt to remove the unnecessary folders
+			[[ ! $prompt =~ n|N ]] && (cd "$root/usr/lib/modules/$kernel" && rm -rf !(kernel)/)
+		fi
+		span_end
+
+		# store the layer so later builds with the same packages can skip pacstrap
+		if [[ ! $no_cache = true ]]; then
+			echo "Storing package layer $(basename "$layer")..."
+			span store_layer store_layer "$layer"
+		fi
+	fi
+}
+with_lock "layer-$(basename "$layer" .tar.zst)" install_layer
+
+# ### HARDWARE PROFILES ###
+[[ ${#hw_profiles[@]} -gt 0 ]] && span prune_hardware prune_hardware
+
+# the initramfs takes its modules from the system, so they match the kernel and the pruning
+moduleroot=$root
+
+# ### INITRAMFS ###
+# the initramfs only needs the kernel, so it is built alongside the rest of the
+# system, unless the boot password still has to be entered or the root hash of
+# the image goes into it
+if [[ $mkinitcpio = true ]]; then
+	if [[ $mkinitcpio_passwd ]] && [[ ! $mkinitcpio_passwd =~ ^[0-9a-f]{128}$ ]]; then
+		initramfs_later=true
+	elif [[ $verity_embed = true ]] && [[ $verity != none ]]; then
+		initramfs_later=true # the root hash is only known once the image is built
+	else
+		stage initramfs source ./mkinitcpio.sh "$root/usr/lib/modules/$kernel/vmlinuz"
+	fi
 fi
 
 # copy yay package files into system
-[[ $yay ]] && bash -c "cd $yay && cp *.pkg\.tar\.zst $root/."
+if [[ $yay ]]; then
+	wait_stage yay
+	cp "$wdir"/yay/yay/*.pkg.tar.zst "$root/"
+fi
 
 # copy tarball or folder into the root directory before running chroot
+# sources have already been prepared, but are applied in order
+span_begin copy_to_root
+n=0
 for i in "${copy_to_root[@]}"; do
+	wait_stage "copy_to_root_$n" || err "failed to prepare $i"
 	echo "copying $i to root directory..."
-	if [[ -f "$i" ]]; then
-		(cd "$root" && tar -xf "$i")
-	else
-		cp -r "$i"/* "$root/"
-	fi
+	apply_source "$n" "$i" || err "failed to copy $i to the root directory"
+	((n+=1))
 done
+rm -rf "$wdir/ingest"
+# the root directory takes the mode and owner of a source copied onto it
+chmod 755 "$root"
+chown 0:0 "$root"
+# which source provided every file, later sources win
+if [[ $n -gt 0 ]]; then
+	awk -F '\t' '
+		FNR == 1 {source = $0; next}
+		{file[$1] = $2 "\t" $3 "\t" source}
+		END {for (x in file) print x "\t" file[x]}
+	' "$wdir"/sources/* | sort > "$odir/copy_to_root.manifest"
+fi
+span_end
 
 # ### SYSTEM SETUP ###
 
 # This used to be handled in a proper chroot but that
 # caused some issues
 
-pre_chroot # There is no more proper chroot but the idea remains
-
-if [[ ! $no_root_passwd = true ]]; then
-	echo "Changing password of user root"
-	while true; do passwd -R "$root" && break; done # set root password
-fi
+span pre_chroot pre_chroot # There is no more proper chroot but the idea remains
+
+span_begin passwd
+[[ $user ]] && useradd -R "$root" -mG wheel "$user"
+if [[ $passwd_file ]]; then
+	# set passwords from hashes, so the build doesn't prompt
+	chpasswd -R "$root" -e < "$passwd_file" || err "failed to set passwords from '$passwd_file'"
+else
+	# without a terminal passwd would fail forever
+	[[ -t 0 ]] || err "no terminal to ask for passwords, set passwd_file"
+	if [[ ! $no_root_passwd = true ]]; then
+		echo "Changing password of user root"
+		while true; do passwd -R "$root" && break; done # set root password
+	fi
 
-if [[ $user ]]; then
-	useradd -R "$root" -mG wheel "$user"
-	echo "Changing password of user $user"
-	while true; do passwd -R "$root" "$user" && break; done # set user password
+	if [[ $user ]]; then
+		echo "Changing password of user $user"
+		while true; do passwd -R "$root" "$user" && break; done # set user password
+	fi
 fi
+span_end
 
 # update locale.gen to include American English
 sed -Ei "s/^#(en_US.UTF-8)/\1/" "$root/etc/locale.gen"
@@ -265,17 +1174,19 @@ echo -e "LANG=en_US.UTF-8\nLC_ALL=en_US.UTF-8" > "$root/etc/locale.conf"
 
 # Generate english locales
 #I18NPATH="$root/usr/share/i18n/" localedef --prefix="$root" -i en_US -f UTF-8 "$root/usr/share/locale/en_US"
-chroot "$root" locale-gen
+span locale_gen chroot "$root" locale-gen
 
+span_begin systemctl
 [[ $systemd_enable ]] && systemctl --root "$root" enable ${systemd_enable[@]}
 [[ $systemd_disable ]] && systemctl --root "$root" disable ${systemd_disable[@]}
 [[ $systemd_mask ]] && systemctl --root "$root" mask ${systemd_mask}
 
 systemctl --root "$root" mask tmp.mount
 [[ $autologin ]] && systemctl --root "$root" enable greetd
+span_end
 
 # install yay
-[[ $yay ]] && pacman -r "$root" -U yay-*.pkg.tar.zst
+[[ $yay ]] && pacman -r "$root" -U "$root"/yay-*.pkg.tar.zst
 
 # Change user shell
 sed -Ei "s/(^$user:x:.*)\/usr\/bin\/bash/\1$(sed 's/\//\\\//g' <<< "$user_shell")/" "$root/etc/passwd"
@@ -301,7 +1212,7 @@ if ! ls "$root/usr/share/zoneinfo/$timezone" &> /dev/null; then
 	echo If you\'d like, you may type in a new time zone and check if it is valid.
 	echo Alternatively type \"continue\" to leave it as is.
 	while true; do
-		read -rp '> ' timezone
+		read -rp '> ' timezone || break
 		if [[ "$timezone" = continue ]]; then
 			break
 		elif ls "$root/usr/share/zoneinfo/$timezone" &> /dev/null; then
@@ -363,20 +1274,44 @@ EOF
 
 # ### POST-CHROOT ###
 
-post_chroot
+span post_chroot post_chroot
 
 # Set all files in home folder to be owned by unprivileged user
 [[ $user ]] && chown -R 1000:1000 "$root/home/$user"
 
 # clear pacman cache as well as yay package files
-rm "$root"/var/cache/pacman/pkg/*
+rm -f "$root"/var/cache/pacman/pkg/*
 [[ $yay ]] && rm "$root"/yay-*
 
-# remove guile cache
-[[ ! $no_rm_guile_cache = true ]] && rm -rf "$root"/usr/lib/guile/*/ccache/*
+# ### SLIMMING ###
+# remove the files matching the slimming rules
+if [[ $no_rm_guile_cache = true ]]; then
+	for i in "${!slim_rules[@]}"; do
+		[[ ${slim_rules[$i]} = guile_cache ]] && unset "slim_rules[$i]"
+	done
+fi
+if [[ ${#slim_rules[@]} -gt 0 ]]; then
+	slim_opts=(--rules "${slim_rules[@]}" --keep-locales "${keep_locales[@]}" --list "$odir/slim.list")
+	[[ ${keep_packages[*]} ]] && slim_opts+=(--keep-packages "${keep_packages[@]}")
+	[[ $slim_dry_run = true ]] && slim_opts+=(--dry-run)
+	span slim python3 ./sfsslim.py slim "$root" "${slim_opts[@]}" || err "failed to slim the system"
+fi
+
+# generate the caches the system would otherwise write to the overlay on every boot
+span caches precompute_caches
+
+# store identical files under /usr once, which saves space in the build root and
+# in unpacked copies of the system. The image barely shrinks, mksquashfs and
+# mkfs.erofs already store identical data once. Timestamps are ignored
+if [[ ! $no_hardlink = true ]] && command -v hardlink &> /dev/null; then
+	span hardlink hardlink --ignore-time $([[ $slim_dry_run = true ]] && echo --dry-run) "$root/usr"
+fi
 
-# remove all locales except en and en_US
-sh -c "cd $root/usr/share/locale && rm -rf \$(ls | grep -vE \"^en$|^en_US$|^locale\.alias$\")"
+# attribute the size of the system to packages, package groups and copy_to_root sources
+sources=("$wdir"/sources/*)
+[[ -e ${sources[0]} ]] || sources=()
+span size_report python3 ./sfsslim.py report "$root" --groups "$wdir/package-groups" \
+	--sources "${sources[@]}" --output "$odir/size-report.json" || warn "failed to write the size report"
 
 # create pacman hook to clear cache after every install
 # This doesn't work in its current form because it causes problems with yay
@@ -395,9 +1330,52 @@ EOF
 # delete pacman mkinitcpio hooks in case mkinitcpio has been installed on system
 rm -f "$root"/usr/share/libalpm/*/*mkinitcpio*
 
+# nothing may change /usr after this, or ConditionNeedsUpdate= units run again
+span_begin first_boot
+mark_updated
+check_first_boot
+span_end
+
 # ### SQUASH SYSTEM ###
 
-mksquashfs "$root"/ "$odir/system.sfs" -comp $compression
+# plan overlay, zram and copy_to_ram settings for the squashfs hook
+span plan python3 ./sfsplan.py write "$root" --workload-size "$workload_size" || err "failed to plan memory settings"
+cp "$root/etc/starchy/image.conf" "$odir/system.plan"
+
+if [[ $image_format = erofs ]]; then
+	span mkfs_erofs with_slot squash "$squash_slots" build_erofs
+else
+	span mksquashfs with_slot squash "$squash_slots" squash_system
+fi
+
+# write the hash tree before the image is indexed, so an appended tree is indexed too
+if [[ $verity = sidecar ]] || [[ $verity = append ]]; then
+	image="$odir/system.sfs"
+	[[ $image_format = erofs ]] && image="$odir/system.erofs"
+	span verity build_verity "$image" || err "failed to write the hash tree of the image"
+	[[ $verity_embed = true ]] && verity_roothash=$(cat "$image.roothash") # for mkinitcpio.sh
+fi
+
+# build a layer with the changes since an earlier build
+[[ $delta_base ]] && span delta_layer build_delta_layer
+
+# index the image into chunks, so machines can update from an older image
+# with sfsdelta.py update and only download the chunks they are missing
+if [[ $chunk_index = true ]]; then
+	image="$odir/system.sfs"
+	[[ $image_format = erofs ]] && image="$odir/system.erofs"
+	span chunk_index python3 ./sfsdelta.py index "$image" ${chunk_store:+--store "$chunk_store"} || err "failed to index the image"
+fi
+
+# wait for the remaining stages, then build the initramfs if it needed a password
+# or the root hash of the image
+wait_stages || err "a build stage failed"
+[[ $initramfs_later = true ]] && span initramfs source ./mkinitcpio.sh "$root/usr/lib/modules/$kernel/vmlinuz"
+
+# ### PACKAGE POOL ###
+pool_report
+span prune_pool with_lock pool prune_pool
 
 # ### DONE ###
+mountpoint -q "$root" && echo "The system is still held in memory, run ./cleanup.sh to release it"
 echo "FINISHED -- GOTO $odir/"
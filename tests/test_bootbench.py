@@ -0,0 +1,78 @@
+#!/usr/bin/python3
+
+# Copyright (C) 2025 LightDig
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+# SOFTWARE.
+
+# tests of the qemu commands bootbench.py --dry-run generates
+# usage: python3 -m unittest discover tests
+
+from pathlib import Path
+import shlex
+import subprocess
+import sys
+import tempfile
+import unittest
+
+bootbench = Path(__file__).resolve().parent.parent / "bootbench.py"
+
+class DryRunTest(unittest.TestCase):
+	def setUp(self):
+		self.tmp = tempfile.TemporaryDirectory()
+		self.dir = Path(self.tmp.name)
+		for x in "vmlinuz","initramfs.img","system.sfs":
+			(self.dir / x).touch()
+
+	def tearDown(self):
+		self.tmp.cleanup()
+
+	def dry_run(self,*args):
+		return subprocess.run((sys.executable,str(bootbench),str(self.dir),"--dry-run",*args),capture_output=True,text=True)
+
+	# function that returns the -append and -drive arguments of every printed command
+	def commands(self,output):
+		commands = []
+		for line in output.splitlines():
+			command = shlex.split(line.split("] ",1)[1])
+			commands.append({x: command[command.index(x) + 1] for x in ("-append","-drive")})
+		return commands
+
+	def test_combinations(self):
+		process = self.dry_run("-O","sfs_overlay","tmpfs","1G zstd","-O","sfs_copy","-","auto","-b","virtio","-r","30M","-a","quiet")
+		self.assertEqual(process.returncode,0,process.stderr)
+		self.assertEqual([x["-append"] for x in self.commands(process.stdout)],[
+			"console=ttyS0 squashfs=/dev/vda sfs_report_upper systemd.show_status=1 sfs_overlay=tmpfs quiet",
+			"console=ttyS0 squashfs=/dev/vda sfs_report_upper systemd.show_status=1 sfs_overlay=tmpfs sfs_copy=auto quiet",
+			'console=ttyS0 squashfs=/dev/vda sfs_report_upper systemd.show_status=1 sfs_overlay="1G zstd" quiet',
+			'console=ttyS0 squashfs=/dev/vda sfs_report_upper systemd.show_status=1 sfs_overlay="1G zstd" sfs_copy=auto quiet'
+		])
+		for x in self.commands(process.stdout):
+			self.assertIn("throttling.bps-read=31457280",x["-drive"])
+		# systemd prints the status line of multi-user.target despite quiet
+		for x in self.commands(process.stdout):
+			self.assertIn("systemd.show_status=1",x["-append"].split())
+		# the options are read by the squashfs hook
+		self.assertEqual(process.stderr,"")
+
+	def test_invalid(self):
+		process = self.dry_run("-O","sfs_overlay",'1G"','-O',"sfs_nonexistent","1","-a","x" * 2048)
+		self.assertNotEqual(process.returncode,0)
+		self.assertIn("no initcpio hook reads the option 'sfs_nonexistent'",process.stderr)
+		self.assertIn("the value of sfs_overlay",process.stderr)
+		self.assertIn("the command line is",process.stderr)
+		self.assertIn("2 problems found",process.stderr)
+
+if __name__ == "__main__":
+	unittest.main()
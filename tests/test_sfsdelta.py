@@ -0,0 +1,143 @@
+#!/usr/bin/python3
+
+# Copyright (C) 2025 LightDig
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+# SOFTWARE.
+
+# tests of sfsdelta.py index and update against a local http.server
+# usage: python3 -m unittest discover tests
+
+from contextlib import redirect_stdout
+from functools import partial
+from http.server import SimpleHTTPRequestHandler,ThreadingHTTPServer
+import hashlib
+import io
+import json
+from pathlib import Path
+import random
+import re
+import subprocess
+import sys
+import tempfile
+import threading
+import unittest
+
+sys.path.insert(0,str(Path(__file__).resolve().parent.parent))
+import sfsdelta
+
+# function that makes incompressible data with a chunk marker every few KiB, like a compressed image
+def image_data(seed,size):
+	rand = random.Random(seed)
+	data = bytearray(rand.randbytes(size))
+	for x in range(0,size - 2,rand.randint(20000,40000)):
+		data[x:x + 2] = sfsdelta.marker
+	return bytes(data)
+
+# http.server without its log lines
+class QuietHandler(SimpleHTTPRequestHandler):
+	def log_message(self,*args):
+		pass
+
+class DeltaTest(unittest.TestCase):
+	def setUp(self):
+		self.tmp = tempfile.TemporaryDirectory()
+		self.dir = Path(self.tmp.name)
+		self.server = ThreadingHTTPServer(("127.0.0.1",0),partial(QuietHandler,directory=str(self.dir)))
+		threading.Thread(target=self.server.serve_forever,daemon=True).start()
+		self.url = "".join(("http://127.0.0.1:",str(self.server.server_port),"/"))
+
+		# the new image shares its start and end with the old one
+		self.old = image_data(1,2000000)
+		self.new = b"".join((self.old[:800000],image_data(2,300000),self.old[1200000:]))
+		(self.dir / "old.sfs").write_bytes(self.old)
+		(self.dir / "out").mkdir()
+		(self.dir / "out/system.sfs").write_bytes(self.new)
+
+	def tearDown(self):
+		self.server.shutdown()
+		self.server.server_close()
+		self.tmp.cleanup()
+
+	def index(self,store,store_url=None):
+		with redirect_stdout(io.StringIO()):
+			sfsdelta.index_image(self.dir / "out/system.sfs",self.dir / "out/system.sfs.index",store,store_url)
+		with open(self.dir / "out/system.sfs.index") as file:
+			return json.load(file)
+
+	def update(self,index,output,store=None):
+		log = io.StringIO()
+		with redirect_stdout(log):
+			sfsdelta.update_image(index,output,[str(self.dir / "old.sfs")],store)
+		return log.getvalue()
+
+	def test_update_over_http(self):
+		index = self.index(self.dir / "out/system.chunks")
+		self.assertEqual(index["store"],"system.chunks")
+		output = self.dir / "updated.sfs"
+		log = self.update("".join((self.url,"out/system.sfs.index")),output)
+		self.assertEqual(output.read_bytes(),self.new)
+		# most of the image is reused from the old one
+		self.assertGreater(float(re.search(r"Reused .*\(([0-9.]+)%\)",log).group(1)),60)
+
+	def test_resume(self):
+		self.index(self.dir / "out/system.chunks")
+		output = self.dir / "updated.sfs"
+		# an interrupted update left the start of the image and some garbage
+		Path("".join((str(output),".part"))).write_bytes(b"".join((self.new[:500000],b"garbage")))
+		log = self.update("".join((self.url,"out/system.sfs.index")),output)
+		self.assertEqual(output.read_bytes(),self.new)
+		self.assertIn("Resumed after",log)
+
+	def test_shared_store(self):
+		# a store outside the directory of the index is recorded by its URL
+		store = self.dir / "shared/chunks"
+		index = self.index(store,"".join((self.url,"shared/chunks")))
+		self.assertEqual(index["store"],"".join((self.url,"shared/chunks")))
+		output = self.dir / "updated.sfs"
+		self.update("".join((self.url,"out/system.sfs.index")),output)
+		self.assertEqual(output.read_bytes(),self.new)
+
+		# or by its absolute path, which an index served over http can not use
+		index = self.index(store)
+		self.assertEqual(index["store"],str(store))
+		self.update(str(self.dir / "out/system.sfs.index"),self.dir / "local.sfs")
+		self.assertEqual((self.dir / "local.sfs").read_bytes(),self.new)
+		with self.assertRaises(SystemExit):
+			self.update("".join((self.url,"out/system.sfs.index")),self.dir / "failed.sfs")
+
+	def test_concurrent_index(self):
+		# builds index images into one store at the same time
+		sfsdelta_py = Path(sfsdelta.__file__)
+		for attempt in range(3):
+			store = self.dir / "".join(("shared/chunks",str(attempt)))
+			processes = []
+			for n in range(4):
+				image = self.dir / "".join(("image",str(attempt),"-",str(n),".sfs"))
+				image.write_bytes(self.new)
+				processes.append(subprocess.Popen((sys.executable,str(sfsdelta_py),"index","-s",str(store),str(image)),stdout=subprocess.DEVNULL,stderr=subprocess.PIPE))
+			for process in processes:
+				self.assertEqual(process.wait(),0,process.stderr.read().decode())
+				process.stderr.close()
+			# every chunk is whole and no temporary file is left
+			self.assertEqual(list(store.rglob("*.tmp")),[])
+			for path in store.rglob("*"):
+				if path.is_file():
+					self.assertEqual(hashlib.sha256(path.read_bytes()).hexdigest(),path.name)
+		output = self.dir / "updated.sfs"
+		self.update(str(self.dir / "image0-0.sfs.index"),output)
+		self.assertEqual(output.read_bytes(),self.new)
+
+if __name__ == "__main__":
+	unittest.main()
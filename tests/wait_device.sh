@@ -0,0 +1,122 @@
+#!/usr/bin/bash
+
+# Copyright (C) 2025 LightDig
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+# SOFTWARE.
+
+# test harness for initcpio/lib/wait_device
+# simulates devices arriving in a temporary /dev/disk/by-* tree and checks that
+# wait_devices wakes up early, times out and waits for every device, both when
+# it polls and when it calls udevadm wait.
+# runs the library with busybox ash when it is installed, otherwise with sh
+# usage: tests/wait_device.sh
+
+lib="$(dirname "${BASH_SOURCE[0]}")/../initcpio/lib/wait_device"
+shell=sh
+command -v busybox > /dev/null && shell="busybox ash"
+dev=$(mktemp -d -p /dev/shm 2> /dev/null || mktemp -d)
+mkdir -p "$dev/disk/by-uuid" "$dev/disk/by-partuuid" "$dev/bin" "$dev/node"
+touch "$dev/node/sda1"
+trap 'rm -rf "$dev"' EXIT
+
+# udevadm wait only knows real devices, hide it so the links are polled
+printf '#!/bin/sh\nexit 1\n' > "$dev/bin/udevadm"
+chmod +x "$dev/bin/udevadm"
+bin="$dev/bin"
+
+# an udevadm that records how it is called and, like udev, creates the links it
+# waits for after 0.3 seconds. sleep records whether wait_devices polls
+mkdir -p "$dev/udev"
+cat > "$dev/udev/udevadm" << EOF
+#!/bin/sh
+echo "\$*" >> "$dev/udevadm.log"
+[ "\$1" = wait ] || exit 0
+shift
+$(command -v sleep) 0.3
+for x in "\$@"; do
+	case \$x in
+		--*) ;;
+		*) ln -s "$dev/node/sda1" "\$x" ;;
+	esac
+done
+EOF
+cat > "$dev/udev/sleep" << EOF
+#!/bin/sh
+echo "\$*" >> "$dev/sleep.log"
+exec $(command -v sleep) "\$@"
+EOF
+chmod +x "$dev/udev/udevadm" "$dev/udev/sleep"
+
+failed=0
+
+# usage: arrive <seconds> <link>
+# create a link to a device node after a delay, like udev does
+arrive() {
+	(sleep "$1"; ln -s "$dev/node/sda1" "$2") &
+}
+
+# usage: check <name> <expected status> <minimum ms> <maximum ms> <timeout> <device>...
+check() {
+	local name=$1 expected=$2 min=$3 max=$4 start status ms
+	shift 4
+	start=$(date +%s%N)
+	PATH="$bin:$PATH" $shell -c '. "$1"; shift; wait_devices "$@"' - "$lib" "$@"
+	status=$?
+	ms=$((($(date +%s%N) - start) / 1000000))
+	wait # for the links still being created
+	if [[ $status -eq $expected ]] && [[ $ms -ge $min ]] && [[ $ms -le $max ]]; then
+		echo "ok   $name (status $status after ${ms}ms)"
+	else
+		echo "FAIL $name (status $status after ${ms}ms, expected $expected within ${min}-${max}ms)"
+		failed=1
+	fi
+	rm -f "$dev"/disk/by-*/*
+}
+
+# a device that is already there returns at once
+ln -s "$dev/node/sda1" "$dev/disk/by-uuid/present"
+check "present device" 0 0 300 5 "$dev/disk/by-uuid/present"
+
+# a device that arrives after 0.5 seconds wakes the wait long before the timeout
+arrive 0.5 "$dev/disk/by-uuid/late"
+check "early wake-up" 0 400 1500 10 "$dev/disk/by-uuid/late"
+
+# a device that never arrives times out
+check "timeout" 1 1000 2000 1 "$dev/disk/by-uuid/missing"
+
+# every device is waited for, the wait ends when the last one arrives
+arrive 0.3 "$dev/disk/by-uuid/first"
+arrive 0.8 "$dev/disk/by-partuuid/second"
+check "multiple devices" 0 700 2000 10 "$dev/disk/by-uuid/first" "$dev/disk/by-partuuid/second"
+
+# one of two devices arriving is not enough
+arrive 0.3 "$dev/disk/by-uuid/first"
+check "multiple devices, one missing" 1 1000 2500 1 "$dev/disk/by-uuid/first" "$dev/disk/by-partuuid/second"
+
+# with udev, udevadm wait is called with the timeout and every device and
+# wait_devices returns when it does, without polling
+bin="$dev/udev"
+check "udevadm wait" 0 200 1500 7 "$dev/disk/by-uuid/first" "$dev/disk/by-partuuid/second"
+expected="wait --timeout=7 $dev/disk/by-uuid/first $dev/disk/by-partuuid/second"
+if grep -qxF -- "$expected" "$dev/udevadm.log" 2> /dev/null && [[ ! -s $dev/sleep.log ]]; then
+	echo "ok   udevadm wait arguments"
+else
+	echo "FAIL udevadm wait arguments (expected '$expected', called with:"
+	cat "$dev/udevadm.log" "$dev/sleep.log" 2> /dev/null
+	echo ")"
+	failed=1
+fi
+
+exit $failed